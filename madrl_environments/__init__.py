@@ -146,23 +146,34 @@ class WrappedAgent(Agent):
 
 
 class ObservationBuffer(AbstractMAEnv):
+    """Stacks each agent's last `buffer_size` observations along a trailing axis.
 
-    def __init__(self, env, buffer_size):
+    Histories live in a ring buffer of twice the history length: every observation is written at
+    `head` and `head + buffer_size`, so the current history is always the contiguous window
+    starting at `head + 1`. By default the windows of all agents are copied once into a fresh
+    (n_agents, D, buffer_size) array. With `readonly_views=True` the window itself is returned as a
+    read-only view, which is only valid until the next `step` or `reset`.
+    """
+
+    def __init__(self, env, buffer_size, readonly_views=False):
         self._unwrapped = env
         self._buffer_size = buffer_size
+        self._readonly_views = readonly_views
         assert all([len(agent.observation_space.shape) == 1 for agent in env.agents])  # XXX
-        bufshapes = [tuple(agent.observation_space.shape) + (buffer_size,) for agent in env.agents]
-        self._buffer = [np.zeros(bufshape) for bufshape in bufshapes]
-        self.reward_mech = self._unwrapped.reward_mech
+        obshapes = set(tuple(agent.observation_space.shape) for agent in env.agents)
+        assert len(obshapes) == 1, 'All agents need the same observation shape'
+        self._bufshape = obshapes.pop() + (buffer_size,)
+        self._buffer = np.zeros((len(env.agents),) + self._bufshape[:-1] + (2 * buffer_size,))
+        self._head = 0
 
     @property
     def agents(self):
         aglist = []
         for agid, agent in enumerate(self._unwrapped.agents):
             if isinstance(agent.observation_space, spaces.Box):
-                newobservation_space = spaces.Box(low=ent.observation_space.low[0],
+                newobservation_space = spaces.Box(low=agent.observation_space.low[0],
                                                   high=agent.observation_space.high[0],
-                                                  shape=self._buffer[agid].shape)
+                                                  shape=self._bufshape)
             # elif isinstance(agent.observation_sapce, spaces.Discrete):
             else:
                 raise NotImplementedError()
@@ -178,26 +189,27 @@ class ObservationBuffer(AbstractMAEnv):
     def seed(self, seed=None):
         return self._unwrapped.seed(seed)
 
+    def _bufobs(self):
+        bufobs = self._buffer[..., self._head + 1:self._head + 1 + self._buffer_size]
+        if self._readonly_views:
+            bufobs = bufobs.view()
+            bufobs.flags.writeable = False
+            return bufobs
+        return bufobs.copy()
+
     def step(self, action):
         obs, rew, done, info = self._unwrapped.step(action)
-        for agid, agid_obs in enumerate(obs):
-            self._buffer[agid][..., 0:self._buffer_size - 1] = self._buffer[agid][
-                ..., 1:self._buffer_size].copy()
-            self._buffer[agid][..., -1] = agid_obs
-
-        bufobs = [buf.copy() for buf in self._buffer]
-        return bufobs, rew, done, info
+        self._head = (self._head + 1) % self._buffer_size
+        obs = np.asarray(obs)
+        self._buffer[..., self._head] = obs
+        self._buffer[..., self._head + self._buffer_size] = obs
+        return self._bufobs(), rew, done, info
 
     def reset(self):
         obs = self._unwrapped.reset()
-
-        assert isinstance(obs, list)
-        for agid, agid_obs in enumerate(obs):
-            for i in range(self._buffer_size):
-                self._buffer[agid][..., i] = agid_obs
-
-        bufobs = [buf.copy() for buf in self._buffer]
-        return bufobs
+        self._head = 0
+        self._buffer[...] = np.asarray(obs)[..., None]
+        return self._bufobs()
 
     def render(self, *args, **kwargs):
         return self._unwrapped.render(*args, **kwargs)
@@ -219,22 +231,24 @@ class StandardizedEnv(AbstractMAEnv, EzPickle):
         self._obs_alpha = obs_alpha
         self._rew_alpha = rew_alpha
         self._eps = eps
-        self._flatobs_shape = [None for _ in env.agents]
-        self._obs_mean = [None for _ in env.agents]
-        self._obs_var = [None for _ in env.agents]
-        self._rew_mean = [None for _ in env.agents]
-        self._rew_var = [None for _ in env.agents]
 
-        for agid, agent in enumerate(env.agents):
+        flatobs_shapes = set()
+        for agent in env.agents:
             if isinstance(agent.observation_space, spaces.Box):
-                self._flatobs_shape[agid] = np.prod(agent.observation_space.shape)
-            elif isinstance(env.observation_space, spaces.Discrete):
-                self._flatobs_shape[agid] = agent.observation_space.n
-
-            self._obs_mean[agid] = np.zeros(self._flatobs_shape[agid])
-            self._obs_var[agid] = np.ones(self._flatobs_shape[agid])
-            self._rew_mean[agid] = 0.
-            self._rew_var[agid] = 1.
+                flatobs_shapes.add(int(np.prod(agent.observation_space.shape)))
+            elif isinstance(agent.observation_space, spaces.Discrete):
+                flatobs_shapes.add(agent.observation_space.n)
+        assert len(flatobs_shapes) == 1, 'All agents need the same observation size'
+        n_agents = len(env.agents)
+        self._flatobs_shape = flatobs_shapes.pop()
+
+        # Per-agent running statistics, one row per agent
+        self._obs_mean = np.zeros((n_agents, self._flatobs_shape))
+        self._obs_var = np.ones((n_agents, self._flatobs_shape))
+        self._rew_mean = np.zeros(n_agents)
+        self._rew_var = np.ones(n_agents)
+        self._obs_buf = np.empty((n_agents, self._flatobs_shape))
+        self._rew_buf = np.empty(n_agents)
 
     @property
     def reward_mech(self):
@@ -245,35 +259,52 @@ class StandardizedEnv(AbstractMAEnv, EzPickle):
         return self._unwrapped.agents
 
     def update_obs_estimate(self, observations):
-        for agid, obs in enumerate(observations):
-            flatobs = np.asarray(obs).flatten()
-            self._obs_mean[agid] = (1 - self._obs_alpha
-                                   ) * self._obs_mean[agid] + self._obs_alpha * flatobs
-            self._obs_var[agid] = (
-                1 - self._obs_alpha
-            ) * self._obs_var[agid] + self._obs_alpha * np.square(flatobs - self._obs_mean[agid])
+        flatobs = np.asarray(observations, dtype=self._obs_mean.dtype).reshape(
+            self._obs_mean.shape)
+        _update_estimate(self._obs_mean, self._obs_var, flatobs, self._obs_alpha, self._obs_buf)
+        return flatobs
 
     def update_rew_estimate(self, rewards):
-        for agid, reward in enumerate(rewards):
-            self._rew_mean[agid] = (1 - self._rew_alpha
-                                   ) * self._rew_mean[agid] + self._rew_alpha * reward
-            self._rew_var[agid] = (
-                1 - self._rew_alpha
-            ) * self._rew_var[agid] + self._rew_alpha * np.square(reward - self._rew_mean[agid])
+        rewards = np.asarray(rewards, dtype=self._rew_mean.dtype).reshape(self._rew_mean.shape)
+        _update_estimate(self._rew_mean, self._rew_var, rewards, self._rew_alpha, self._rew_buf)
+        return rewards
 
     def standardize_obs(self, observation):
-        assert isinstance(observation, list)
-        self.update_obs_estimate(observation)
-        return [(obs - obsmean) / (np.sqrt(obsvar) + self._eps)
-                for (obs, obsmean, obsvar) in zip(observation, self._obs_mean, self._obs_var)]
+        flatobs = self.update_obs_estimate(observation)
+        stdobs = np.subtract(flatobs, self._obs_mean)
+        np.sqrt(self._obs_var, out=self._obs_buf)
+        self._obs_buf += self._eps
+        stdobs /= self._obs_buf
+        return stdobs.reshape(np.shape(observation))
 
     def standardize_rew(self, reward):
         assert isinstance(reward, (list, np.ndarray))
-        self.update_rew_estimate(reward)
-        return [
-            rew / (np.sqrt(rewvar) + self._eps)
-            for (rew, rewmean, rewvar) in zip(reward, self._rew_mean, self._rew_var)
-        ]
+        reward = self.update_rew_estimate(reward)
+        return reward / (np.sqrt(self._rew_var) + self._eps)
+
+    def get_stats(self):
+        return dict(obs_mean=self._obs_mean.copy(), obs_var=self._obs_var.copy(),
+                    rew_mean=self._rew_mean.copy(), rew_var=self._rew_var.copy())
+
+    def set_stats(self, stats):
+        self._obs_mean[...] = stats['obs_mean']
+        self._obs_var[...] = stats['obs_var']
+        self._rew_mean[...] = stats['rew_mean']
+        self._rew_var[...] = stats['rew_var']
+
+    @staticmethod
+    def merge_stats(stats_list):
+        """Merges the running statistics of several copies of the env (e.g. one per sampler
+        worker), treating each copy's estimate as an equally weighted mixture component.
+        """
+        merged = {}
+        for name in ('obs', 'rew'):
+            means = np.array([stats[name + '_mean'] for stats in stats_list])
+            variances = np.array([stats[name + '_var'] for stats in stats_list])
+            mean = means.mean(axis=0)
+            merged[name + '_mean'] = mean
+            merged[name + '_var'] = (variances + np.square(means - mean)).mean(axis=0)
+        return merged
 
     def seed(self, seed=None):
         return self._unwrapped.seed(seed)
@@ -299,12 +330,17 @@ class StandardizedEnv(AbstractMAEnv, EzPickle):
         d = EzPickle.__getstate__(self)
         d['_obs_mean'] = self._obs_mean
         d['_obs_var'] = self._obs_var
+        d['_rew_mean'] = self._rew_mean
+        d['_rew_var'] = self._rew_var
         return d
 
     def __setstate__(self, d):
         EzPickle.__setstate__(self, d)
-        self._obs_mean = d['_obs_mean']
-        self._obs_var = d['_obs_var']
+        self._obs_mean = np.asarray(d['_obs_mean'], dtype=float).reshape(self._obs_mean.shape)
+        self._obs_var = np.asarray(d['_obs_var'], dtype=float).reshape(self._obs_var.shape)
+        if '_rew_mean' in d:
+            self._rew_mean = d['_rew_mean']
+            self._rew_var = d['_rew_var']
 
     def __str__(self):
         return "Normalized {}".format(self._unwrapped)
@@ -394,5 +430,17 @@ class DiagnosticsWrapper(AbstractMAEnv, EzPickle):
         self._unwrapped.set_param_values(lut)
 
 
+def _update_estimate(mean, var, x, alpha, buf):
+    """In-place exponential moving estimate of mean and variance; `buf` is scratch space"""
+    np.multiply(x, alpha, out=buf)
+    mean *= 1 - alpha
+    mean += buf
+    np.subtract(x, mean, out=buf)
+    np.square(buf, out=buf)
+    buf *= alpha
+    var *= 1 - alpha
+    var += buf
+
+
 def _discount_sum(x, discount):
     return np.sum(x * (discount**np.arange(len(x))))
@@ -48,6 +48,22 @@ ROBOT_REL_POS = np.array([[0.3, 0.1], [0.1, 0.1], [-0.1, 0.1], [-0.3, 0.1], [-0.
                           [0.3, -0.033], [0.3, 0.033]])
 
 
+def _friction_grid():
+    """Cell centers (body frame) of the grid the object's base is divided into for friction"""
+    divide_x = LENGTH * 100
+    divide_y = WIDTH * 100
+    offset_x = LENGTH / divide_x / 2
+    offset_y = WIDTH / divide_y / 2
+    x, y = np.meshgrid(
+        np.arange(int(divide_x)) / divide_x * LENGTH,
+        np.arange(int(divide_y)) / divide_y * WIDTH, indexing='ij')
+    grid = (-LENGTH / 2) + np.c_[x.ravel(), y.ravel()] + np.array([offset_x, offset_y])
+    return grid, divide_x * divide_y
+
+
+FRIC_GRID_G_2, FRIC_GRID_CELLS = _friction_grid()
+
+
 class OdeObj(object):
 
     def __new__(cls, *args, **kwargs):
@@ -291,26 +307,14 @@ class BoxCarrying(AbstractMAEnv):
             return
 
         self.result_torque = 0
-        robot_torque = 0
-        fric_torque = 0
 
-        for i in range(self.n_robots):
-            f_body = self.obj.body.vectorFromWorld((force_NR_2[i, 0], force_NR_2[i, 1], 0))
-            r = np.array([ROBOT_REL_POS[i, 0], ROBOT_REL_POS[i, 1], 0])
-            f = np.array([f_body[0], f_body[1]])
-            c = np.cross(r, f)
-            t = c[2]
-            robot_torque += t
+        # Robot forces rotated into the body frame: R^T f
+        rot = np.array(self.obj.body.getRotation()).reshape(3, 3)
+        f_body = force_NR_2[:, 0:1] * rot[0, :2] + force_NR_2[:, 1:2] * rot[1, :2]
+        robot_torque = np.sum(ROBOT_REL_POS[:, 0] * f_body[:, 1] -
+                              ROBOT_REL_POS[:, 1] * f_body[:, 0])
 
         # Torque by friction
-
-        divide_x = LENGTH * 100
-        #20.0;
-        divide_y = WIDTH * 100
-        #20.0;
-        offset_x = LENGTH / divide_x / 2
-        offset_y = WIDTH / divide_y / 2
-
         cur_speed = np.linalg.norm(self.objv[-1])
         if cur_speed < 0.3:
             kp = 3
@@ -319,25 +323,17 @@ class BoxCarrying(AbstractMAEnv):
         else:
             kp = 1
 
-        fric_sum = np.zeros(2)
-        for x in range(int(divide_x)):
-            for y in range(int(divide_y)):
-                body_point = (-LENGTH / 2) + np.array(
-                    [x / divide_x * LENGTH, y / divide_y * WIDTH]) + np.array([offset_x, offset_y])
-                body_point_vel = np.array(
-                    list(self.obj.body.getRelPointVel((body_point[0], body_point[1], 0))))
-                f_world = -kp * FRIC / divide_x / divide_y * body_point_vel / np.linalg.norm(
-                    body_point_vel)
-                f_body = self.obj.body.vectorFromWorld((f_world[0], f_world[1], 0))
-
-                r = np.array([body_point[0], body_point[1], 0])
-                f = np.array([f_body[0], f_body[1], 0])
-                c = np.cross(r, f)
-                fric_torque += c[2]
-
-                fric_sum += f_world[:2]
-
-            # Viscous torque
+        # Velocity of every grid cell: v + w x (R p)
+        point_world_G_3 = FRIC_GRID_G_2.dot(rot[:, :2].T)
+        point_vel_G_3 = np.array(self.obj.body.getLinearVel()) + np.cross(
+            np.array(self.obj.body.getAngularVel()), point_world_G_3)
+        f_world_G_3 = -kp * FRIC / FRIC_GRID_CELLS * point_vel_G_3 / np.linalg.norm(
+            point_vel_G_3, axis=1)[:, None]
+        f_body_G_2 = f_world_G_3[:, 0:1] * rot[0, :2] + f_world_G_3[:, 1:2] * rot[1, :2]
+        fric_torque = np.sum(FRIC_GRID_G_2[:, 0] * f_body_G_2[:, 1] - FRIC_GRID_G_2[:, 1] *
+                             f_body_G_2[:, 0])
+
+        # Viscous torque
         ang_vel = self.obj.body.getAngularVel()
         vis_torque = -0.05 * ang_vel[2]
 
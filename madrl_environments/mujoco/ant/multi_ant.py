@@ -1,4 +1,5 @@
 import copy
+import hashlib
 import math
 import sys
 import os
@@ -16,6 +17,10 @@ from madrl_environments import AbstractMAEnv, Agent
 
 from rltools.util import EzPickle
 
+# Attributes set by MujocoEnv.__init__ that belong to one compiled model
+_MODEL_ATTRS = ('model', 'data', 'init_qpos', 'init_qvel', 'action_space', 'observation_space',
+                '_obs_idx')
+
 
 class AntLeg(Agent):
 
@@ -94,13 +99,14 @@ class MultiAnt(EzPickle, mujoco_env.MujocoEnv):
         self.force_noise = force_noise
 
         self.legs = None
+        self.viewer = None
+        self._model_key = None
+        self._model_cache = {}
+        self._obs_idx = None
         self.out_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), self.out_file)
         self.base_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), self.base_file)
 
-        self.gen_xml(out_file=self.out_file_path, og_file=self.base_file_path)
-
-        mujoco_env.MujocoEnv.__init__(self, self.out_file_path, 5)
-        self.legs = [AntLeg(self.model, i, n_legs, pos_noise=pos_noise, vel_noise=vel_noise, force_noise=force_noise) for i in range(self.n_legs)]
+        self.load_model()
 
 
     @property
@@ -120,14 +126,51 @@ class MultiAnt(EzPickle, mujoco_env.MujocoEnv):
 
     def setup(self):
         self.seed()
+        self.load_model()
 
-        self.gen_xml(out_file=self.out_file_path, og_file=self.base_file_path)
 
-        mujoco_env.MujocoEnv.__init__(self, self.out_file_path, 5)
+    def load_model(self):
+        """Load the model for the current (n_legs, leg_length).
+        The model is only compiled the first time a configuration is seen; afterwards the
+        already loaded model is swapped back in.
+        """
+        key = (self.n_legs, self.leg_length)
+        self._obs_noise = self.obs_noise()
+        if key != self._model_key:
+            self.legs = None
+            self._obs_idx = None
+            if key in self._model_cache:
+                for attr, val in self._model_cache[key].items():
+                    setattr(self, attr, val)
+                if self.viewer is not None:
+                    self.viewer.set_model(self.model)
+            else:
+                mujoco_env.MujocoEnv.__init__(self, self.model_file(), 5)
+                self._model_cache[key] = {attr: getattr(self, attr) for attr in _MODEL_ATTRS}
+            self._model_key = key
         self.legs = [AntLeg(self.model, i, self.n_legs, pos_noise=self.pos_noise, vel_noise=self.vel_noise,
             force_noise=self.force_noise) for i in range(self.n_legs)]
 
 
+    def model_file(self):
+        """Path of the generated .xml file for the current (n_legs, leg_length).
+        File names carry a hash of the base file and the configuration, so the file is only
+        written if no worker has generated it yet.
+        """
+        with open(self.base_file_path, 'rb') as f:
+            content = f.read()
+        config = repr((self.n_legs, float(self.leg_length))).encode('utf-8')
+        digest = hashlib.sha1(content + config).hexdigest()[:16]
+        root, ext = os.path.splitext(self.out_file_path)
+        path = '{}_{}{}'.format(root, digest, ext)
+        if not os.path.exists(path):
+            # Write then rename so concurrent workers never read a partial file
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            self.gen_xml(out_file=tmp_path, og_file=self.base_file_path)
+            os.rename(tmp_path, path)
+        return path
+
+
     def _step(self, a):
         xposbefore = self.get_body_com("torso")[0]
         self.do_simulation(a, self.frame_skip)
@@ -150,8 +193,41 @@ class MultiAnt(EzPickle, mujoco_env.MujocoEnv):
             reward_survive=survive_reward)
 
     def _get_obs(self):
-        obs = [l.get_observation() for l in self.legs] if self.legs else np.random.rand(self.n_legs, 32)
-        return np.array(obs)
+        if self._obs_idx is None:
+            self._obs_idx = self.obs_index()
+        state = np.concatenate([
+            self.model.data.qpos.flat,
+            self.model.data.qvel.flat,
+            np.clip(self.model.data.cfrc_ext, -1, 1).flat
+        ])
+        obs = state[self._obs_idx]
+        obs += self._obs_noise * np.random.randn(*obs.shape)
+        return obs
+
+    def obs_index(self):
+        """Indices of each leg's observation into [qpos, qvel, cfrc_ext], shape (n_legs, obs_dim).
+        Same layout as AntLeg.get_observation.
+        """
+        nq, nv = self.model.nq, self.model.nv
+        legs = np.arange(self.n_legs)
+        neighbors = [legs, np.roll(legs, 1), np.roll(legs, -1)]
+        leg_idx = []
+        for n in neighbors:
+            leg_idx.append(7 + 2 * n[:, None] + np.arange(2))
+            leg_idx.append(nq + 6 + 2 * n[:, None] + np.arange(2))
+        return np.concatenate([
+            np.tile(np.arange(2, 7), (self.n_legs, 1)),
+            np.tile(nq + np.arange(6), (self.n_legs, 1))
+        ] + leg_idx + [nq + nv + 6 * (3 * legs[:, None] + 2) + np.arange(18)], axis=1)
+
+    def obs_noise(self):
+        """Standard deviation of the observation noise for each entry of a leg's observation"""
+        return np.concatenate([
+            np.repeat(self.pos_noise, 5),
+            np.repeat(self.vel_noise, 6),
+            np.tile(np.repeat([self.pos_noise, self.vel_noise], 2), 3),
+            np.repeat(self.force_noise, 18)
+        ])
 
     def reset_model(self):
         qpos = self.init_qpos + self.np_random.uniform(size=self.model.nq,low=-.1,high=.1)
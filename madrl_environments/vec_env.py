@@ -0,0 +1,145 @@
+import multiprocessing as mp
+
+import numpy as np
+from gym import spaces
+from six.moves import cPickle
+
+from madrl_environments import AbstractMAEnv
+
+
+class VecMAEnv(AbstractMAEnv):
+    """Steps `n_envs` copies of a multi-agent env in worker processes.
+
+    Observations, actions, rewards and done flags are exchanged through preallocated shared-memory
+    arrays of shape (n_envs, n_agents, ...); the pipes to the workers only carry commands and the
+    (usually empty) info dicts. Envs that are done, or have run for `max_traj_len` steps, are reset
+    by their worker, so the observation returned for them is the first one of the next episode.
+    All agents need the same observation and action spaces.
+    """
+
+    def __init__(self, env, n_envs, n_workers=None, max_traj_len=None):
+        self._unwrapped = env
+        self.n_envs = n_envs
+        self.max_traj_len = max_traj_len
+        n_agents = len(env.agents)
+        obs_space = env.agents[0].observation_space
+        act_space = env.agents[0].action_space
+        obs_shape = tuple(obs_space.shape)
+        act_shape = (1,) if isinstance(act_space, spaces.Discrete) else tuple(act_space.shape)
+
+        self._shared = dict(
+            obs=(mp.RawArray('d', n_envs * n_agents * int(np.prod(obs_shape))),
+                 (n_envs, n_agents) + obs_shape),
+            actions=(mp.RawArray('d', n_envs * n_agents * int(np.prod(act_shape))),
+                     (n_envs, n_agents) + act_shape),
+            rewards=(mp.RawArray('d', n_envs * n_agents), (n_envs, n_agents)),
+            dones=(mp.RawArray('d', n_envs), (n_envs,)))
+        self._obs, self._actions, self._rewards, self._dones = _shared_arrays(self._shared)
+
+        n_workers = min(n_workers or mp.cpu_count(), n_envs)
+        env_str = cPickle.dumps(env, protocol=-1)
+        self._remotes, self._workers = [], []
+        for env_ids in np.array_split(np.arange(n_envs), n_workers):
+            remote, worker_remote = mp.Pipe()
+            worker = mp.Process(target=_worker, args=(worker_remote, remote, env_str, list(env_ids),
+                                                      self._shared, max_traj_len))
+            worker.daemon = True
+            worker.start()
+            worker_remote.close()
+            self._remotes.append(remote)
+            self._workers.append(worker)
+        self._closed = False
+
+    @property
+    def agents(self):
+        return self._unwrapped.agents
+
+    @property
+    def reward_mech(self):
+        return self._unwrapped.reward_mech
+
+    def _call(self, cmd, data=None):
+        for remote in self._remotes:
+            remote.send((cmd, data))
+        return [remote.recv() for remote in self._remotes]
+
+    def seed(self, seed=None):
+        return sum(self._call('seed', seed), [])
+
+    def reset(self):
+        self._call('reset')
+        return self._obs.copy()
+
+    def step(self, actions):
+        """Takes (n_envs, n_agents, ...) actions and returns (n_envs, n_agents, ...) observations,
+        (n_envs, n_agents) rewards, (n_envs,) done flags and a list of per-env infos.
+        """
+        self._actions[...] = np.reshape(actions, self._actions.shape)
+        infos = sum(self._call('step'), [])
+        return self._obs.copy(), self._rewards.copy(), self._dones.astype(bool), infos
+
+    def set_param_values(self, lut):
+        self._unwrapped.set_param_values(lut)
+        self._call('set_param_values', lut)
+
+    def close(self):
+        if self._closed:
+            return
+        for remote in self._remotes:
+            remote.send(('close', None))
+        for worker in self._workers:
+            worker.join()
+        self._closed = True
+
+    def __del__(self):
+        self.close()
+
+
+def _shared_arrays(shared):
+    return [
+        np.frombuffer(shared[name][0], dtype=np.float64).reshape(shared[name][1])
+        for name in ('obs', 'actions', 'rewards', 'dones')
+    ]
+
+
+def _worker(remote, parent_remote, env_str, env_ids, shared, max_traj_len):
+    parent_remote.close()
+    envs = [cPickle.loads(env_str) for _ in env_ids]
+    obs, actions, rewards, dones = _shared_arrays(shared)
+    discrete = isinstance(envs[0].agents[0].action_space, spaces.Discrete)
+    ts = np.zeros(len(envs), dtype=int)
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            infos = []
+            for i, (idx, env) in enumerate(zip(env_ids, envs)):
+                action = actions[idx, :, 0].astype(int) if discrete else actions[idx]
+                o, r, done, info = env.step(action)
+                ts[i] += 1
+                done = done or (max_traj_len is not None and ts[i] >= max_traj_len)
+                if done:
+                    o = env.reset()
+                    ts[i] = 0
+                obs[idx] = o
+                rewards[idx] = r
+                dones[idx] = done
+                infos.append(info)
+            remote.send(infos)
+        elif cmd == 'reset':
+            for idx, env in zip(env_ids, envs):
+                obs[idx] = env.reset()
+            ts[:] = 0
+            dones[env_ids] = False
+            remote.send(None)
+        elif cmd == 'seed':
+            remote.send([env.seed(None if data is None else data + idx)
+                         for idx, env in zip(env_ids, envs)])
+        elif cmd == 'set_param_values':
+            for env in envs:
+                env.set_param_values(data)
+            remote.send(None)
+        elif cmd == 'close':
+            remote.close()
+            break
+        else:
+            raise NotImplementedError(cmd)
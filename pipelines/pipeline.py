@@ -211,12 +211,16 @@ def eval_snapshot(envname, checkptfile, last_snapshot_idx, n_trajs, mode):
     bestidx = 0
     bestret = -np.inf
     bestevr = {}
+    pool = None
     for idx in range((last_snapshot_idx - 10), (last_snapshot_idx + 1)):
         tf.reset_default_graph()
         minion = Evaluator(env, args, args['max_traj_len'] if mode == 'rltools' else
                            args['max_path_length'], n_trajs, False, mode)
         if mode == 'rltools':
-            evr = minion(checkptfile, file_key='snapshots/iter%07d' % idx)
+            # All snapshots share the architecture, only weights are swapped into the workers
+            if pool is None:
+                pool = minion.rollout_pool()
+            evr = minion(checkptfile, file_key='snapshots/iter%07d' % idx, pool=pool)
         elif mode == 'rllab':
             evr = minion(os.path.join(checkptfile, 'itr_{}.pkl'.format(idx)))
 
@@ -224,6 +228,8 @@ def eval_snapshot(envname, checkptfile, last_snapshot_idx, n_trajs, mode):
             bestret = np.mean(evr['ret'])
             bestevr = evr
             bestidx = idx
+    if pool is not None:
+        pool.close()
     return bestevr, bestidx
 
 
@@ -1,4 +1,5 @@
 from rllab.algos.base import RLAlgorithm
+from rllab.algos.util import SumTree
 from rllab.misc.overrides import overrides
 from rllab.misc import special
 from rllab.misc import ext
@@ -40,6 +41,7 @@ class SimpleReplayPool(object):
         self._bottom = 0
         self._top = 0
         self._size = 0
+        self._batch_buffers = dict()
 
     def add_sample(self, observation, action, reward, terminal):
         self._observations[self._top] = observation
@@ -53,28 +55,30 @@ class SimpleReplayPool(object):
             self._size += 1
 
     def random_batch(self, batch_size):
+        """
+        The returned arrays are reused by the next call with the same batch size.
+        """
         assert self._size > batch_size
-        indices = np.zeros(batch_size, dtype='uint64')
-        transition_indices = np.zeros(batch_size, dtype='uint64')
-        count = 0
-        while count < batch_size:
-            index = np.random.randint(self._bottom, self._bottom + self._size) % self._max_pool_size
-            # make sure that the transition is valid: if we are at the end of the pool, we need to discard
-            # this sample
-            if index == self._size - 1 and self._size <= self._max_pool_size:
-                continue
-            # if self._terminals[index]:
-            #     continue
-            transition_index = (index + 1) % self._max_pool_size
-            indices[count] = index
-            transition_indices[count] = transition_index
-            count += 1
+        # the newest sample has no stored successor yet, so it cannot start a transition
+        last = (self._top - 1) % self._max_pool_size
+        indices = _sample_indices(self._bottom, self._size, self._max_pool_size, batch_size,
+                                  invalid=last)
+        transition_indices = (indices + 1) % self._max_pool_size
+        buffers = _batch_buffers(self._batch_buffers, batch_size, dict(
+            observations=self._observations,
+            actions=self._actions,
+            next_observations=self._observations,
+        ))
+        np.take(self._observations, indices, axis=0, out=buffers["observations"])
+        np.take(self._actions, indices, axis=0, out=buffers["actions"])
+        np.take(self._observations, transition_indices, axis=0,
+                out=buffers["next_observations"])
         return dict(
-            observations=self._observations[indices],
-            actions=self._actions[indices],
+            observations=buffers["observations"],
+            actions=buffers["actions"],
             rewards=self._rewards[indices],
             terminals=self._terminals[indices],
-            next_observations=self._observations[transition_indices]
+            next_observations=buffers["next_observations"],
         )
 
     @property
@@ -102,42 +106,49 @@ class MAReplayPool(object):
         self._bottom = 0
         self._top = 0
         self._size = 0
+        self._batch_buffers = dict()
+
+    def _next_slots(self, observation):
+        """
+        Slots that add_sample(observation, ...) writes: one for a single (observation_dim,)
+        sample, n for a batch of shape (n, observation_dim), e.g. all agents of one env step.
+        """
+        n = len(observation) if np.ndim(observation) > 1 else 1
+        return (self._top + np.arange(n)) % self._max_pool_size
 
     def add_sample(self, observation, action, reward, next_observation, terminal):
-        self._observations[self._top] = observation
-        self._next_observations[self._top] = next_observation
-        self._actions[self._top] = action
-        self._rewards[self._top] = reward
-        self._terminals[self._top] = terminal
-        self._top = (self._top + 1) % self._max_pool_size
-        if self._size >= self._max_pool_size:
-            self._bottom = (self._bottom + 1) % self._max_pool_size
-        else:
-            self._size += 1
+        slots = self._next_slots(observation)
+        n = len(slots)
+        self._observations[slots] = np.reshape(observation, (n, -1))
+        self._next_observations[slots] = np.reshape(next_observation, (n, -1))
+        self._actions[slots] = np.reshape(action, (n, -1))
+        self._rewards[slots] = reward
+        self._terminals[slots] = terminal
+        self._top = (self._top + n) % self._max_pool_size
+        overflow = max(self._size + n - self._max_pool_size, 0)
+        self._bottom = (self._bottom + overflow) % self._max_pool_size
+        self._size += n - overflow
 
     def random_batch(self, batch_size):
+        """
+        The returned arrays are reused by the next call with the same batch size.
+        """
         assert self._size > batch_size
-        indices = np.zeros(batch_size, dtype='uint64')
-        transition_indices = np.zeros(batch_size, dtype='uint64')
-        count = 0
-        while count < batch_size:
-            index = np.random.randint(self._bottom, self._bottom + self._size) % self._max_pool_size
-            # make sure that the transition is valid: if we are at the end of the pool, we need to discard
-            # this sample
-            if index == self._size - 1 and self._size <= self._max_pool_size:
-                continue
-            # if self._terminals[index]:
-            #     continue
-            transition_index = (index + 1) % self._max_pool_size
-            indices[count] = index
-            transition_indices[count] = transition_index
-            count += 1
+        indices = _sample_indices(self._bottom, self._size, self._max_pool_size, batch_size)
+        buffers = _batch_buffers(self._batch_buffers, batch_size, dict(
+            observations=self._observations,
+            actions=self._actions,
+            next_observations=self._next_observations,
+        ))
+        np.take(self._observations, indices, axis=0, out=buffers["observations"])
+        np.take(self._actions, indices, axis=0, out=buffers["actions"])
+        np.take(self._next_observations, indices, axis=0, out=buffers["next_observations"])
         return dict(
-            observations=self._observations[indices],
-            actions=self._actions[indices],
+            observations=buffers["observations"],
+            actions=buffers["actions"],
             rewards=self._rewards[indices],
             terminals=self._terminals[indices],
-            next_observations=self._observations[indices]
+            next_observations=buffers["next_observations"],
         )
 
     @property
@@ -145,6 +156,72 @@ class MAReplayPool(object):
         return self._size
 
 
+def _sample_indices(bottom, size, max_pool_size, batch_size, invalid=None):
+    """
+    Draws batch_size pool slots uniformly in one go, redrawing only the ones that hit `invalid`.
+    """
+    indices = (bottom + np.random.randint(size, size=batch_size)) % max_pool_size
+    if invalid is not None:
+        mask = indices == invalid
+        while mask.any():
+            indices[mask] = (bottom + np.random.randint(size, size=mask.sum())) % max_pool_size
+            mask = indices == invalid
+    return indices
+
+
+def _batch_buffers(buffers, batch_size, sources):
+    if batch_size not in buffers:
+        buffers[batch_size] = {
+            k: np.empty((batch_size,) + v.shape[1:], dtype=v.dtype) for k, v in sources.items()
+        }
+    return buffers[batch_size]
+
+
+class PrioritizedMAReplayPool(MAReplayPool):
+    """
+    MAReplayPool sampling transitions with probability proportional to priority ** alpha, the
+    priority being the last absolute TD error (plus eps). New samples get the highest priority seen
+    so far. Batches also carry the importance sampling weights (normalized by their max) and the
+    sampled indices to pass back to update_priorities.
+    """
+
+    def __init__(
+            self, max_pool_size, observation_dim, action_dim, alpha=0.6, beta=0.4, eps=1e-6):
+        super(PrioritizedMAReplayPool, self).__init__(max_pool_size, observation_dim, action_dim)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self._tree = SumTree(max_pool_size)
+        self._max_priority = 1.
+
+    def add_sample(self, observation, action, reward, next_observation, terminal):
+        self._tree.update(self._next_slots(observation), self._max_priority ** self.alpha)
+        super(PrioritizedMAReplayPool, self).add_sample(observation, action, reward,
+                                                        next_observation, terminal)
+
+    def random_batch(self, batch_size):
+        assert self._size > batch_size
+        total = self._tree.total
+        # stratified: one draw in each of batch_size equal slices of the priority mass
+        values = (np.arange(batch_size) + np.random.rand(batch_size)) * (total / batch_size)
+        indices = np.minimum(self._tree.find(values), self._size - 1)
+        weights = (self._size * self._tree[indices] / total) ** -self.beta
+        return dict(
+            observations=self._observations[indices],
+            actions=self._actions[indices],
+            rewards=self._rewards[indices],
+            terminals=self._terminals[indices],
+            next_observations=self._next_observations[indices],
+            weights=weights / weights.max(),
+            indices=indices,
+        )
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(td_errors) + self.eps
+        self._max_priority = max(self._max_priority, priorities.max())
+        self._tree.update(indices, priorities ** self.alpha)
+
+
 class DDPG(RLAlgorithm):
     """
     Deep Deterministic Policy Gradient.
@@ -177,7 +254,11 @@ class DDPG(RLAlgorithm):
             include_horizon_terminal_transitions=False,
             plot=False,
             pause_for_plot=False,
-            mode='centralized'):
+            mode='centralized',
+            prioritized_replay=False,
+            priority_alpha=0.6,
+            priority_beta=0.4,
+            priority_eps=1e-6):
         """
         :param env: Environment
         :param policy: Policy
@@ -204,6 +285,10 @@ class DDPG(RLAlgorithm):
         horizon was reached. This might make the Q value back up less stable for certain tasks.
         :param plot: Whether to visualize the policy performance after each eval_interval.
         :param pause_for_plot: Whether to pause before continuing when plotting.
+        :param prioritized_replay: Whether to sample the replay pool proportionally to TD errors.
+        :param priority_alpha: How much prioritization is used (0 is uniform sampling).
+        :param priority_beta: Initial importance sampling correction, annealed to 1 over training.
+        :param priority_eps: Added to the absolute TD errors so that no transition has zero priority.
         :return:
         """
         self.env = env
@@ -252,6 +337,11 @@ class DDPG(RLAlgorithm):
 
         self.mode = mode
 
+        self.prioritized_replay = prioritized_replay
+        self.priority_alpha = priority_alpha
+        self.priority_beta = priority_beta
+        self.priority_eps = priority_eps
+
     def start_worker(self):
         #parallel_sampler.populate_task(self.env, self.policy)
         ma_sampler.populate_task(self.env, self.policy, self.mode)
@@ -261,11 +351,21 @@ class DDPG(RLAlgorithm):
     @overrides
     def train(self):
         # This seems like a rather sequential method
-        pool = MAReplayPool(
-            max_pool_size=self.replay_pool_size,
-            observation_dim=self.env.observation_space.flat_dim,
-            action_dim=self.env.action_space.flat_dim,
-        )
+        if self.prioritized_replay:
+            pool = PrioritizedMAReplayPool(
+                max_pool_size=self.replay_pool_size,
+                observation_dim=self.env.observation_space.flat_dim,
+                action_dim=self.env.action_space.flat_dim,
+                alpha=self.priority_alpha,
+                beta=self.priority_beta,
+                eps=self.priority_eps,
+            )
+        else:
+            pool = MAReplayPool(
+                max_pool_size=self.replay_pool_size,
+                observation_dim=self.env.observation_space.flat_dim,
+                action_dim=self.env.action_space.flat_dim,
+            )
         self.start_worker()
 
         self.init_opt()
@@ -320,14 +420,14 @@ class DDPG(RLAlgorithm):
                                 terminal
                             )
                         elif self.mode == 'decentralized':
-                            for o, a, r, op in zip(observation, action, reward, next_observation):
-                                pool.add_sample(
-                                    self.env.observation_space.flatten(o),
-                                    self.env.action_space.flatten(a),
-                                    r * self.scale_reward,
-                                    self.env.observation_space.flatten(op),
-                                    terminal
-                                )
+                            # all agents of the step in one write
+                            pool.add_sample(
+                                self.env.observation_space.flatten_n(observation),
+                                self.env.action_space.flatten_n(action),
+                                np.asarray(reward) * self.scale_reward,
+                                self.env.observation_space.flatten_n(next_observation),
+                                terminal
+                            )
                         else:
                             raise NotImplementedError()
                 else:
@@ -340,23 +440,26 @@ class DDPG(RLAlgorithm):
                             terminal
                         )
                     elif self.mode == 'decentralized':
-                        for o, a, r, op in zip(observation, action, reward, next_observation):
-                            pool.add_sample(
-                                self.env.observation_space.flatten(o),
-                                self.env.action_space.flatten(a),
-                                r * self.scale_reward,
-                                self.env.observation_space.flatten(op),
-                                terminal
-                            )
+                        # all agents of the step in one write
+                        pool.add_sample(
+                            self.env.observation_space.flatten_n(observation),
+                            self.env.action_space.flatten_n(action),
+                            np.asarray(reward) * self.scale_reward,
+                            self.env.observation_space.flatten_n(next_observation),
+                            terminal
+                        )
                     else:
                         raise NotImplementedError()
                 observation = next_observation
 
                 if pool.size >= self.min_pool_size:
+                    if self.prioritized_replay:
+                        pool.beta = self.priority_beta + (1. - self.priority_beta) * \
+                            float(itr) / (self.n_epochs * self.epoch_length)
                     for update_itr in range(self.n_updates_per_sample):
                         # Train policy
                         batch = pool.random_batch(self.batch_size)
-                        self.do_training(itr, batch)
+                        self.do_training(itr, batch, pool)
                     sample_policy.set_param_values(self.policy.get_param_values())
 
                 itr += 1
@@ -396,6 +499,8 @@ class DDPG(RLAlgorithm):
             extra_dims=1,
         )
         yvar = TT.vector('ys')
+        # importance sampling weights of prioritized replay, ones otherwise
+        weights = TT.vector('weights')
 
         qf_weight_decay_term = 0.5 * self.qf_weight_decay * \
                                sum([TT.sum(TT.square(param)) for param in
@@ -403,7 +508,7 @@ class DDPG(RLAlgorithm):
 
         qval = self.qf.get_qval_sym(obs, action)
 
-        qf_loss = TT.mean(TT.square(yvar - qval))
+        qf_loss = TT.mean(weights * TT.square(yvar - qval))
         qf_reg_loss = qf_loss + qf_weight_decay_term
 
         policy_weight_decay_term = 0.5 * self.policy_weight_decay * \
@@ -423,7 +528,7 @@ class DDPG(RLAlgorithm):
             policy_reg_surr, self.policy.get_params(trainable=True))
 
         f_train_qf = ext.compile_function(
-            inputs=[yvar, obs, action],
+            inputs=[yvar, obs, action, weights],
             outputs=[qf_loss, qval],
             updates=qf_updates
         )
@@ -441,7 +546,7 @@ class DDPG(RLAlgorithm):
             target_policy=target_policy,
         )
 
-    def do_training(self, itr, batch):
+    def do_training(self, itr, batch, pool=None):
 
         obs, actions, rewards, next_obs, terminals = ext.extract(
             batch,
@@ -461,7 +566,10 @@ class DDPG(RLAlgorithm):
         f_train_qf = self.opt_info["f_train_qf"]
         f_train_policy = self.opt_info["f_train_policy"]
 
-        qf_loss, qval = f_train_qf(ys, obs, actions)
+        weights = batch.get("weights", np.ones_like(ys))
+        qf_loss, qval = f_train_qf(ys, obs, actions, weights)
+        if "indices" in batch:
+            pool.update_priorities(batch["indices"], ys - qval)
 
         policy_surr = f_train_policy(obs)
 
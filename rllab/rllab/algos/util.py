@@ -265,6 +265,48 @@ class ReplayPool(Serializable):
         )
 
 
+class SumTree(object):
+    """
+    Binary tree of sums over `capacity` non-negative leaf values, stored in a flat array where node
+    i has children 2i and 2i+1 and the leaves start at `self._n`. Updates and prefix-sum lookups
+    cost O(log N) and are vectorized over arrays of leaves.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._n = 1
+        while self._n < capacity:
+            self._n *= 2
+        self._tree = np.zeros(2 * self._n)
+
+    @property
+    def total(self):
+        return self._tree[1]
+
+    def __getitem__(self, leaf_idx):
+        return self._tree[self._n + np.asarray(leaf_idx)]
+
+    def update(self, leaf_idx, values):
+        idx = self._n + np.atleast_1d(leaf_idx)
+        self._tree[idx] = values
+        while idx[0] > 1:
+            idx = np.unique(idx // 2)
+            self._tree[idx] = self._tree[2 * idx] + self._tree[2 * idx + 1]
+
+    def find(self, values):
+        """
+        For each value in [0, total), return the leaf whose prefix-sum interval contains it.
+        """
+        values = np.array(values, dtype=float)
+        idx = np.ones(len(values), dtype=int)
+        while idx[0] < self._n:
+            left = self._tree[2 * idx]
+            go_right = values >= left
+            values -= left * go_right
+            idx = 2 * idx + go_right
+        return idx - self._n
+
+
 # TESTING CODE BELOW THIS POINT...
 
 def simple_tests():
@@ -1,12 +1,21 @@
 from rllab.baselines.base import Baseline
 from rllab.misc.overrides import overrides
 import numpy as np
+import scipy.linalg
 
 
 class LinearFeatureBaseline(Baseline):
-    def __init__(self, env_spec, reg_coeff=1e-5):
+    def __init__(self, env_spec, reg_coeff=1e-5, chunk_size=4096):
+        """
+        :param reg_coeff: Ridge regularization, increased tenfold while the fit fails.
+        :param chunk_size: Approximate number of rows of features multiplied at once when accumulating the normal
+        equations, which bounds the memory of the fit.
+        """
         self._coeffs = None
         self._reg_coeff = reg_coeff
+        self._chunk_size = chunk_size
+        # Features computed by predict, reused by the fit on the same paths
+        self._feature_cache = dict()
 
     @overrides
     def get_param_values(self, **tags):
@@ -17,24 +26,60 @@ class LinearFeatureBaseline(Baseline):
         self._coeffs = val
 
     def _features(self, path):
+        cached = self._feature_cache.get(id(path))
+        if cached is not None and cached[0] is path:
+            return cached[1]
         o = np.clip(path["observations"], -10, 10)
+        o = o.reshape(len(o), -1)
         l = len(path["rewards"])
-        al = np.arange(l).reshape(-1, 1) / 100.0
-        return np.concatenate([o, o ** 2, al, al ** 2, al ** 3, np.ones((l, 1))], axis=1)
+        al = np.arange(l) / 100.0
+        d = o.shape[1]
+        feat = np.empty((l, 2 * d + 4))
+        feat[:, :d] = o
+        np.square(o, out=feat[:, d:2 * d])
+        feat[:, 2 * d] = al
+        feat[:, 2 * d + 1] = al ** 2
+        feat[:, 2 * d + 2] = al ** 3
+        feat[:, 2 * d + 3] = 1.
+        self._feature_cache[id(path)] = (path, feat)
+        return feat
+
+    def _normal_equations(self, paths):
+        """
+        Accumulates featmat.T.dot(featmat) and featmat.T.dot(returns) over chunks of paths, without forming the
+        features of the whole batch.
+        """
+        gram, featret = 0., 0.
+        chunk_feats, chunk_returns, chunk_rows = [], [], 0
+        for i, path in enumerate(paths):
+            chunk_feats.append(self._features(path))
+            chunk_returns.append(path["returns"])
+            chunk_rows += len(path["returns"])
+            if chunk_rows >= self._chunk_size or i == len(paths) - 1:
+                featmat = np.concatenate(chunk_feats)
+                gram = gram + featmat.T.dot(featmat)
+                featret = featret + featmat.T.dot(np.concatenate(chunk_returns))
+                chunk_feats, chunk_returns, chunk_rows = [], [], 0
+        return gram, featret
 
     @overrides
     def fit(self, paths):
-        featmat = np.concatenate([self._features(path) for path in paths])
-        returns = np.concatenate([path["returns"] for path in paths])
+        gram, featret = self._normal_equations(paths)
+        self._feature_cache = dict()
+        identity = np.identity(gram.shape[0])
         reg_coeff = self._reg_coeff
         for _ in range(5):
-            self._coeffs = np.linalg.lstsq(
-                featmat.T.dot(featmat) + reg_coeff * np.identity(featmat.shape[1]),
-                featmat.T.dot(returns)
-            )[0]
-            if not np.any(np.isnan(self._coeffs)):
+            try:
+                coeffs = scipy.linalg.cho_solve(scipy.linalg.cho_factor(gram + reg_coeff * identity), featret)
+            except np.linalg.LinAlgError:
+                # not numerically positive definite
+                coeffs = None
+            if coeffs is not None and not np.any(np.isnan(coeffs)):
                 break
             reg_coeff *= 10
+        else:
+            coeffs = np.linalg.lstsq(gram + reg_coeff * identity, featret)[0]
+        self._coeffs = coeffs
 
     @overrides
     def predict(self, path):
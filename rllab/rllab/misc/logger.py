@@ -4,10 +4,13 @@ from rllab.misc.tabulate import tabulate
 from rllab.misc.console import mkdir_p, colorize
 from rllab.misc.autoargs import get_all_parameters
 from contextlib import contextmanager
+from six.moves import queue
+import atexit
 import numpy as np
 import os
 import os.path as osp
 import sys
+import threading
 import datetime
 import dateutil.tz
 import csv
@@ -34,6 +37,10 @@ _tabular_header_written = set()
 _snapshot_dir = None
 _snapshot_mode = 'all'
 _snapshot_gap = 1
+_snapshot_async = True
+_snapshot_queue = None
+_snapshot_thread = None
+_snapshot_error = None
 
 _log_tabular_only = False
 _header_printed = False
@@ -101,6 +108,13 @@ def set_snapshot_gap(gap):
     global _snapshot_gap
     _snapshot_gap = gap
 
+def get_snapshot_async():
+    return _snapshot_async
+
+def set_snapshot_async(snapshot_async):
+    global _snapshot_async
+    _snapshot_async = snapshot_async
+
 def set_log_tabular_only(log_tabular_only):
     global _log_tabular_only
     _log_tabular_only = log_tabular_only
@@ -213,19 +227,75 @@ def pop_prefix():
     _prefix_str = ''.join(_prefixes)
 
 
+class _Pickled(object):
+    """Holds an already pickled object, which gets unpickled in its place when loaded"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce__(self):
+        return pickle.loads, (self.data,)
+
+
+def _snapshot_worker():
+    global _snapshot_error
+    while True:
+        file_name, data = _snapshot_queue.get()
+        try:
+            joblib.dump(_Pickled(data), file_name, compress=3)
+        except Exception as e:
+            # The writer keeps going, the error is raised by the next _dump_params or
+            # wait_for_snapshots
+            _snapshot_error = e
+        finally:
+            _snapshot_queue.task_done()
+
+
+def _raise_snapshot_error():
+    global _snapshot_error
+    if _snapshot_error is not None:
+        e, _snapshot_error = _snapshot_error, None
+        raise e
+
+
+def wait_for_snapshots():
+    """Blocks until all snapshots handed to the background writer are on disk"""
+    if _snapshot_queue is not None and _snapshot_thread.is_alive():
+        _snapshot_queue.join()
+    _raise_snapshot_error()
+
+
+def _dump_params(params, file_name):
+    if not _snapshot_async:
+        joblib.dump(params, file_name, compress=3)
+        return
+    _raise_snapshot_error()
+    global _snapshot_queue, _snapshot_thread
+    if _snapshot_queue is None:
+        # Bounded, so that training blocks instead of piling up snapshots if the disk is slow
+        _snapshot_queue = queue.Queue(maxsize=2)
+        _snapshot_thread = threading.Thread(target=_snapshot_worker)
+        _snapshot_thread.daemon = True
+        _snapshot_thread.start()
+        atexit.register(wait_for_snapshots)
+    # Pickling reads the parameters out of the session now; compression and IO happen in the
+    # writer thread
+    _snapshot_queue.put((file_name, pickle.dumps(params, protocol=pickle.HIGHEST_PROTOCOL)))
+
+
 def save_itr_params(itr, params):
     if _snapshot_dir:
         if _snapshot_mode == 'all':
             file_name = osp.join(_snapshot_dir, 'itr_%d.pkl' % itr)
-            joblib.dump(params, file_name, compress=3)
+            _dump_params(params, file_name)
         elif _snapshot_mode == 'last':
             # override previous params
             file_name = osp.join(_snapshot_dir, 'params.pkl')
-            joblib.dump(params, file_name, compress=3)
+            _dump_params(params, file_name)
         elif _snapshot_mode == "gap":
             if itr % _snapshot_gap == 0:
                 file_name = osp.join(_snapshot_dir, 'itr_%d.pkl' % itr)
-                joblib.dump(params, file_name, compress=3)
+                _dump_params(params, file_name)
         elif _snapshot_mode == 'none':
             pass
         else:
@@ -132,7 +132,8 @@ class ConjugateGradientOptimizer(Serializable):
             debug_nan=False,
             accept_violation=False,
             hvp_approach=None,
-            num_slices=1):
+            num_slices=1,
+            in_graph_line_search=True):
         """
 
         :param cg_iters: The number of CG iterations used to calculate A^-1 g
@@ -143,6 +144,8 @@ class ConjugateGradientOptimizer(Serializable):
         nan is detected
         :param accept_violation: whether to accept the descent step if it violates the line search condition after
         exhausting all backtracking budgets
+        :param in_graph_line_search: whether backtracking computes the candidate parameters inside the graph from the
+        previous parameters and the descent step, both uploaded once, instead of setting them from numpy every try
         :return:
         """
         Serializable.quick_init(self, locals())
@@ -159,6 +162,7 @@ class ConjugateGradientOptimizer(Serializable):
         self._constraint_name = None
         self._debug_nan = debug_nan
         self._accept_violation = accept_violation
+        self._in_graph_line_search = in_graph_line_search
         if hvp_approach is None:
             hvp_approach = PerlmutterHvp(num_slices)
         self._hvp_approach = hvp_approach
@@ -194,7 +198,12 @@ class ConjugateGradientOptimizer(Serializable):
         self._hvp_approach.update_opt(f=constraint_term, target=target, inputs=inputs + extra_inputs,
                                       reg_coeff=self._reg_coeff)
 
+        if self._in_graph_line_search:
+            self._build_line_search_ops(params)
+
         self._target = target
+        self._input_vars = inputs
+        self._extra_input_vars = extra_inputs
         self._max_constraint_val = constraint_value
         self._constraint_name = constraint_name
 
@@ -221,6 +230,40 @@ class ConjugateGradientOptimizer(Serializable):
             ),
         )
 
+    def _build_line_search_ops(self, params):
+        shapes = [p.get_shape().as_list() for p in params]
+        n_params = sum(int(np.prod(shape)) for shape in shapes)
+        dtype = params[0].dtype.base_dtype
+        # Assigning the staging variables also initializes them, so they may be created after
+        # the variable initialization
+        prev_param = tf.Variable(tf.zeros([n_params], dtype=dtype), trainable=False,
+                                 name="line_search_prev_param")
+        descent_step = tf.Variable(tf.zeros([n_params], dtype=dtype), trainable=False,
+                                   name="line_search_descent_step")
+        self._ls_prev_param = tf.placeholder(dtype, [n_params], name="prev_param")
+        self._ls_descent_step = tf.placeholder(dtype, [n_params], name="descent_step")
+        self._ls_stage = tf.group(tf.assign(prev_param, self._ls_prev_param),
+                                  tf.assign(descent_step, self._ls_descent_step))
+        self._ls_ratio = tf.placeholder(dtype, [], name="backtrack_ratio")
+        new_params = tensor_utils.unflatten_tensor_variables(
+            prev_param - self._ls_ratio * descent_step, shapes, params)
+        self._ls_set_params = tf.group(*[tf.assign(p, new_p) for p, new_p in zip(params, new_params)])
+
+    def _set_backtrack_params(self, prev_param, flat_descent_step, ratio):
+        """Sets the target params to prev_param - ratio * flat_descent_step"""
+        if self._in_graph_line_search:
+            tf.get_default_session().run(self._ls_set_params, {self._ls_ratio: ratio})
+        else:
+            self._target.set_param_values(prev_param - ratio * flat_descent_step, trainable=True)
+
+    def _as_feed(self, values, input_vars):
+        """
+        The values as C-contiguous arrays of their placeholders' dtypes. Converting the batch once
+        saves the copy TF would otherwise make on each of the many calls feeding it.
+        """
+        return tuple(np.require(value, dtype=var.dtype.as_numpy_dtype, requirements='C')
+                     for value, var in zip(values, input_vars))
+
     def loss(self, inputs, extra_inputs=None):
         inputs = tuple(inputs)
         if extra_inputs is None:
@@ -235,9 +278,10 @@ class ConjugateGradientOptimizer(Serializable):
 
     def optimize(self, inputs, extra_inputs=None, subsample_grouped_inputs=None):
         prev_param = np.copy(self._target.get_param_values(trainable=True))
-        inputs = tuple(inputs)
+        inputs = self._as_feed(inputs, self._input_vars)
         if extra_inputs is None:
             extra_inputs = tuple()
+        extra_inputs = self._as_feed(extra_inputs, self._extra_input_vars)
 
         if self._subsample_factor < 1:
             if subsample_grouped_inputs is None:
@@ -276,11 +320,13 @@ class ConjugateGradientOptimizer(Serializable):
 
         logger.log("descent direction computed")
 
+        if self._in_graph_line_search:
+            tf.get_default_session().run(self._ls_stage, {self._ls_prev_param: prev_param,
+                                                          self._ls_descent_step: flat_descent_step})
         n_iter = 0
+        # Stops at the first ratio satisfying the line search condition
         for n_iter, ratio in enumerate(self._backtrack_ratio ** np.arange(self._max_backtracks)):
-            cur_step = ratio * flat_descent_step
-            cur_param = prev_param - cur_step
-            self._target.set_param_values(cur_param, trainable=True)
+            self._set_backtrack_params(prev_param, flat_descent_step, ratio)
             loss, constraint_val = sliced_fun(self._opt_fun["f_loss_constraint"], self._num_slices)(inputs,
                                                                                                     extra_inputs)
             if self._debug_nan and np.isnan(constraint_val):
@@ -299,7 +345,7 @@ class ConjugateGradientOptimizer(Serializable):
                 logger.log("Violated because loss not improving")
             if constraint_val >= self._max_constraint_val:
                 logger.log("Violated because constraint %s is violated" % self._constraint_name)
-            self._target.set_param_values(prev_param, trainable=True)
+            self._set_backtrack_params(prev_param, flat_descent_step, 0.)
         logger.log("backtrack iters: %d" % n_iter)
         logger.log("computing loss after")
         logger.log("optimization finished")
@@ -5,16 +5,32 @@ import numpy as np
 
 from rltools import util
 from rltools.algos import RLAlgorithm
+from rltools.replay import PrioritizedReplayBuffer, ReplayBuffer
 from rltools.samplers import evaluate
 
 
+def _identity(obs):
+    return obs
+
+
+def eps_greedy_actions(sess, q_func, action_space, n_agents, obsfeat_N_Df, eps):
+    """List of the agents' actions, all random with probability `eps`, greedy otherwise"""
+    assert obsfeat_N_Df.shape[0] == n_agents
+    if random.random() < eps:
+        return [action_space.sample() for _ in range(n_agents)]
+    a = q_func.compute_qactions(sess, n_agents, obsfeat_N_Df).tolist()
+    return [a[i][0] for i in range(len(a))]
+
+
 class DQN(RLAlgorithm):
 
     def __init__(self, env, q_func, target_q_func, target_update_step, 
                  eps_start=0.99, eps_end=0.05, eps_fraction=0.5,
-                 obsfeat_fn=lambda obs: obs, max_experience_size=10000, traj_sim_len=500,
+                 obsfeat_fn=_identity, max_experience_size=10000, traj_sim_len=500,
                  batch_size=32, discount=0.99, n_iter=100000, start_iter=0, store_paths=False,
-                 whole_paths=True, double_dqn=False, duel_net=False, n_eval_traj=50, **kwargs):
+                 whole_paths=True, double_dqn=False, duel_net=False, n_eval_traj=50,
+                 prioritized_replay=False, priority_alpha=0.6, priority_beta=0.4,
+                 shared_priorities=True, n_updates_per_step=1, **kwargs):
         self.env = env
         self.q_func = q_func
         self.target_q_func = target_q_func
@@ -37,8 +53,18 @@ class DQN(RLAlgorithm):
 
         self.double_dqn = double_dqn
         self.duel_net = duel_net
-
-        self.memory = []
+        self.n_updates_per_step = n_updates_per_step
+        self.q_func.make_fused_opt_step(self.target_q_func, discount, double_q=double_dqn)
+
+        self.prioritized_replay = prioritized_replay
+        self.priority_beta = priority_beta
+        if prioritized_replay:
+            self.memory = PrioritizedReplayBuffer(
+                max_experience_size, self.env.n_agents, self.env.observation_space.shape,
+                alpha=priority_alpha, beta=priority_beta, shared_priorities=shared_priorities)
+        else:
+            self.memory = ReplayBuffer(max_experience_size, self.env.n_agents,
+                                       self.env.observation_space.shape)
         self.total_time = 0.0
 
         self.debug = True
@@ -51,48 +77,56 @@ class DQN(RLAlgorithm):
                            self.q_func.get_params(sess), self.target_q_func.get_params(sess)))
 
     def _compute_action(self, sess, obsfeat_Df):
-        assert obsfeat_Df.shape[0] == self.env.n_agents
-        if random.random() < self.eps:
-            a = [self.env.action_space.sample() for _ in range(self.env.n_agents)]
-            return a
+        return eps_greedy_actions(sess, self.q_func, self.env.action_space, self.env.n_agents,
+                                  obsfeat_Df, self.eps)
+
+    def _update_schedules(self, itr):
+        # update epsilon
+        if itr < self.eps_fraction * self.n_iter:
+            self.eps = 1 - (1 - self.eps_end) / (self.eps_fraction * self.n_iter) * itr # decay
         else:
-            a = self.q_func.compute_qactions(sess, self.env.n_agents, obsfeat_Df).tolist()
-            actions = [a[i][0] for i in range(len(a))]
-            return actions # To check
-
-    def _pack_into_batch(self, transitions):
-        num = len(transitions) * self.env.n_agents
-        obs_B_Do = np.zeros((num, self.env.observation_space.shape[0]))
-        actions_B_Da = np.zeros((num, 1))
-        rewards_B = np.zeros(num)
-        succ_obs_B_Do = np.zeros((num, self.env.observation_space.shape[0]))
-        done_B = np.zeros(num)
-        # print(transitions)
-        for i, (obs_Do, action_Da, reward, succ_obs_Do, done) in enumerate(transitions):
-            for i_a in range(self.env.n_agents):
-                obs_B_Do[i * self.env.n_agents + i_a, :] = obs_Do[i_a]
-                actions_B_Da[i * self.env.n_agents + i_a, :] = action_Da[i_a]
-                rewards_B[i * self.env.n_agents + i_a] = reward[i_a]
-                succ_obs_B_Do[i * self.env.n_agents + i_a, :] = succ_obs_Do[i_a]
-                done_B[i * self.env.n_agents + i_a] = done
-
-        return obs_B_Do, actions_B_Da, rewards_B, succ_obs_B_Do, done_B
+            self.eps = self.eps_end
+        if self.prioritized_replay:
+            # anneal the importance sampling correction to full at the end of training
+            self.memory.beta = self.priority_beta + (1. - self.priority_beta) * itr / self.n_iter
 
     def train(self, sess, log, save_freq):
         self.initialize(sess)
         for itr in range(self.start_iter, self.n_iter):
             iter_info = self.step(sess, itr)
-
-            # update epsilon
-            if itr < self.eps_fraction * self.n_iter:
-                self.eps = 1 - (1 - self.eps_end) / (self.eps_fraction * self.n_iter) * itr # decay
-            else:
-                self.eps = self.eps_end
+            self._update_schedules(itr)
 
             log.write(iter_info, print_header=itr % 20 == 0)
             if itr % save_freq == 0:
                 log.write_snapshot(sess, self.q_func, itr)
 
+    def _update(self, sess):
+        """Takes `n_updates_per_step` gradient steps on replayed batches, returns the mean loss"""
+        # Stage the batches of all updates at once
+        n_updates = self.n_updates_per_step
+        if self.prioritized_replay:
+            batch, batch_weights_KB, batch_leaves = self.memory.sample(n_updates * self.batch_size)
+        else:
+            batch = self.memory.sample(n_updates * self.batch_size)
+            batch_weights_KB = None
+        batch_obs_KB_Do, batch_actions_KB_Da, batch_rewards_KB, batch_succ_obs_KB_Do, batch_done_KB = batch
+        batch_obsfeat_KB_Df = self.obsfeat_fn(batch_obs_KB_Do)
+        batch_succ_obsfeat_KB_Df = self.obsfeat_fn(batch_succ_obs_KB_Do)
+
+        B = len(batch_rewards_KB) // n_updates
+        mean_loss = 0.
+        for k in range(n_updates):
+            sl = slice(k * B, (k + 1) * B)
+            loss, td_B = self.q_func.fused_opt_step(
+                sess, batch_obsfeat_KB_Df[sl], batch_actions_KB_Da[sl], batch_rewards_KB[sl],
+                batch_succ_obsfeat_KB_Df[sl], batch_done_KB[sl],
+                None if batch_weights_KB is None else batch_weights_KB[sl])
+            mean_loss += loss / n_updates
+            if self.prioritized_replay:
+                L = len(batch_leaves) // n_updates
+                self.memory.update_priorities(batch_leaves[k * L:(k + 1) * L], td_B)
+        return mean_loss
+
     def step(self, sess, itr):
         with util.Timer() as t_all:
             curr_obs_Do = self.env.reset()
@@ -103,25 +137,12 @@ class DQN(RLAlgorithm):
                     next_obs_Do, curr_reward, done, _ = self.env.step(curr_action_Da)
 
                     # Memory (s,a,r,s')
-                    self.memory.append(
-                        (curr_obs_Do, curr_action_Da, curr_reward, next_obs_Do, int(done)))
-                    self.memory = self.memory[-self.max_experience_size:]
+                    self.memory.add(curr_obs_Do, curr_action_Da, curr_reward, next_obs_Do,
+                                    int(done))
 
                     curr_obs_Do = next_obs_Do
 
-                    transitions_B = [self.memory[idx]
-                                     for idx in np.random.choice(
-                                         len(self.memory), size=self.batch_size)]
-                    batch_obs_B_Do, batch_actions_B_Da, batch_rewards_B, batch_succ_obs_B_Do, batch_done_B = \
-                        self._pack_into_batch(transitions_B)
-
-                    batch_succ_target_actions_B_Da = self.target_q_func.compute_qactions(
-                        sess, self.batch_size, self.obsfeat_fn(batch_succ_obs_B_Do))
-                    batch_qtargets_B = batch_rewards_B + self.discount * batch_done_B * self.target_q_func.compute_qvals(
-                        sess, self.obsfeat_fn(batch_succ_obs_B_Do), batch_succ_target_actions_B_Da)
-
-                    q_loss[t] = self.q_func.opt_step(sess, self.obsfeat_fn(batch_obs_B_Do),
-                                                     batch_actions_B_Da, batch_qtargets_B)
+                    q_loss[t] = self._update(sess)
 
                     if done:
                         break
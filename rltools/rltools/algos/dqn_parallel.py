@@ -0,0 +1,252 @@
+from __future__ import absolute_import, print_function
+
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+import gevent
+import numpy as np
+import tensorflow as tf
+import zerorpc
+from six.moves import cPickle
+from zerorpc.gevent_zmq import logger as gevent_log
+
+from rltools import util
+from rltools.algos.dqn import DQN, eps_greedy_actions
+from rltools.samplers import evaluate
+
+gevent_log.setLevel(logging.CRITICAL)
+
+
+class ParallelDQN(DQN):
+    """Actor-learner DQN.
+
+    `n_actors` worker processes step their own copies of the env with the Q parameters last synced
+    to them (every `param_sync_steps` gradient steps) and send their transitions back in blocks of
+    `actor_steps` env steps, which go into the replay memory as they arrive. The learner only takes
+    gradient steps, `traj_sim_len` of them per iteration. Evaluation runs concurrently in one more
+    worker, so the logged return is that of the latest evaluation finished, on slightly older
+    parameters. `env`, `q_func` and `obsfeat_fn` are pickled to the workers.
+    """
+
+    def __init__(self, env, q_func, target_q_func, target_update_step, n_actors=4, actor_steps=50,
+                 param_sync_steps=100, **kwargs):
+        super(ParallelDQN, self).__init__(env, q_func, target_q_func, target_update_step, **kwargs)
+        self.n_actors = n_actors
+        self.actor_steps = actor_steps
+        self.param_sync_steps = param_sync_steps
+        self.actors = []
+        self.evaluator = None
+        self._act_jobs = {}
+        self._eval_job = None
+        self._eval_return = np.nan
+
+    def start_workers(self):
+        self.actors = [
+            ActorProxy(self.env, self.q_func, self.obsfeat_fn, self.traj_sim_len, i, seed=i)
+            for i in range(self.n_actors)
+        ]
+        self.evaluator = ActorProxy(self.env, self.q_func, self.obsfeat_fn, self.traj_sim_len,
+                                    self.n_actors, seed=self.n_actors)
+
+    def initialize(self, sess):
+        super(ParallelDQN, self).initialize(sess)
+        if not self.actors:
+            self.start_workers()
+        self._sync_params(sess)
+        for i_actor in range(self.n_actors):
+            self._dispatch_act(i_actor)
+
+    def train(self, sess, log, save_freq):
+        try:
+            super(ParallelDQN, self).train(sess, log, save_freq)
+        finally:
+            self.close()
+
+    def _sync_params(self, sess):
+        params_str = _dumps(self.q_func.get_params(sess))
+        [actor.client("set_params", params_str, async=True) for actor in self.actors]
+
+    def _dispatch_act(self, i_actor):
+        self._act_jobs[i_actor] = self.actors[i_actor].client("act", self.actor_steps, self.eps,
+                                                              async=True)
+
+    def _collect(self, block=False):
+        """Adds the transitions of the actors that are done to the memory and hands them their next
+        block of steps right away. With `block`, waits for at least one actor first. Returns the
+        number of transitions added.
+        """
+        futures = list(self._act_jobs.values())
+        if block:
+            ready = gevent.wait(futures, count=1)
+        else:
+            ready = gevent.wait(futures, timeout=0)
+        n_added = 0
+        for i_actor, future in list(self._act_jobs.items()):
+            if future not in ready:
+                continue
+            for transition in zip(*_loads(future.get())):
+                self.memory.add(*transition)
+                n_added += 1
+            self._dispatch_act(i_actor)
+        return n_added
+
+    def _poll_eval(self, sess):
+        """Picks up the finished evaluation, if any, and starts the next one on the current
+        parameters. Returns the latest evaluated return.
+        """
+        if self._eval_job is not None:
+            if not self._eval_job.ready():
+                return self._eval_return
+            self._eval_return = self._eval_job.get()
+        self._eval_job = self.evaluator.client(
+            "evaluate", _dumps(self.q_func.get_params(sess)), self.traj_sim_len, self.n_eval_traj,
+            async=True)
+        return self._eval_return
+
+    def step(self, sess, itr):
+        with util.Timer() as t_all:
+            q_loss = np.zeros(self.traj_sim_len)
+            with util.Timer() as t_sim:
+                n_transitions = 0
+                while len(self.memory) < self.batch_size:
+                    n_transitions += self._collect(block=True)
+                for t in range(self.traj_sim_len):
+                    n_transitions += self._collect()
+                    q_loss[t] = self._update(sess)
+                    if t % self.param_sync_steps == self.param_sync_steps - 1:
+                        self._sync_params(sess)
+
+            if itr % self.target_update_step == self.target_update_step - 1:
+                self.target_q_func.copy_params_from_primary(sess)
+
+            with util.Timer() as t_eval:
+                eval_return = self._poll_eval(sess)
+
+        self.total_time += t_all.dt
+
+        fields = [('iter', itr, int),
+                  ('q_loss', q_loss.mean(), float),  # Average q loss
+                  ('ret', eval_return, float),
+                  ('ntrans', n_transitions, int),  # Transitions received from the actors
+                  ('tsim', t_sim.dt, float),  # Time for the gradient steps
+                  ('teval', t_eval.dt, float),
+                  ('ttotal', self.total_time, float)]
+        return fields
+
+    def close(self):
+        for worker in self.actors + [self.evaluator]:
+            if worker is not None:
+                worker.close()
+        self.actors = []
+        self.evaluator = None
+        self._act_jobs = {}
+        self._eval_job = None
+
+
+class ActorProxy(object):
+
+    def __init__(self, env, q_func, obsfeat_fn, max_traj_len, idx, seed):
+        addr = "ipc:///tmp/dqn_{}_{}.ipc".format(os.getpid(), idx)
+
+        self.f = tempfile.NamedTemporaryFile()
+        self.f.write(_dumps((env, q_func, obsfeat_fn, max_traj_len, seed)))
+        self.f.flush()
+
+        oenv = os.environ.copy()
+        oenv["CUDA_VISIBLE_DEVICES"] = ""
+        oenv["OMP_NUM_THREADS"] = "1"
+        oenv["MKL_NUM_THREADS"] = "1"
+
+        self.popen = subprocess.Popen(
+            ["python2", "-m", "rltools.algos.dqn_parallel", self.f.name, addr], env=oenv)
+
+        self.client = zerorpc.Client(heartbeat=60, timeout=1000)
+        self.client.connect(addr)
+
+    def close(self):
+        if self.popen.poll() is None:
+            self.popen.terminate()
+        if not self.f.closed:
+            self.f.close()
+
+    def __del__(self):
+        self.close()
+
+
+class ActorServer(object):
+
+    def __init__(self, sess, env, q_func, obsfeat_fn, max_traj_len, seed):
+        self.sess = sess
+        self.env = env
+        self.q_func = q_func
+        self.obsfeat_fn = obsfeat_fn
+        self.max_traj_len = max_traj_len
+        self.env.seed(seed)
+        np.random.seed(seed)
+        tf.set_random_seed(seed)
+        random.seed(seed)
+        # The episode in progress carries over from one block of steps to the next
+        self._obs = None
+        self._t = 0
+
+    def set_params(self, params_str):
+        self.q_func.set_params(self.sess, _loads(params_str))
+
+    def act(self, n_steps, eps):
+        """Takes `n_steps` epsilon-greedy env steps and returns their transitions as
+        (obs, actions, rewards, successor obs, done) arrays
+        """
+        transitions = []
+        for _ in range(n_steps):
+            if self._obs is None:
+                self._obs = self.env.reset()
+                self._t = 0
+            action_Da = eps_greedy_actions(self.sess, self.q_func, self.env.action_space,
+                                           self.env.n_agents, self.obsfeat_fn(self._obs), eps)
+            next_obs_Do, reward, done, _ = self.env.step(action_Da)
+            self._t += 1
+            transitions.append((self._obs, action_Da, reward, next_obs_Do, int(done)))
+            self._obs = None if done or self._t >= self.max_traj_len else next_obs_Do
+        return _dumps([np.asarray(field) for field in zip(*transitions)])
+
+    def evaluate(self, params_str, max_traj_len, n_traj):
+        self.set_params(params_str)
+        # Evaluation episodes must not cut into an episode of act
+        self._obs = None
+        return float(evaluate(
+            self.env, self.obsfeat_fn,
+            lambda ofeat: self.q_func.compute_qactions(self.sess, self.env.n_agents, ofeat),
+            max_traj_len, n_traj))
+
+
+def _start_server():
+    fname = sys.argv[1]
+    addr = sys.argv[2]
+    with open(fname, 'rb') as fh:
+        s = fh.read()
+
+    tfconfig = tf.ConfigProto(inter_op_parallelism_threads=1, intra_op_parallelism_threads=1)
+
+    with tf.Session(config=tfconfig) as sess:
+        env, q_func, obsfeat_fn, max_traj_len, seed = _loads(s)
+        sess.run(tf.initialize_all_variables())
+        server = zerorpc.Server(ActorServer(sess, env, q_func, obsfeat_fn, max_traj_len, seed),
+                                heartbeat=60)
+        server.bind(addr)
+        server.run()
+
+
+def _loads(s):
+    return cPickle.loads(s)
+
+
+def _dumps(o):
+    return cPickle.dumps(o, protocol=-1)
+
+
+if __name__ == "__main__":
+    _start_server()
@@ -14,7 +14,8 @@ class SamplingPolicyOptimizer(RLAlgorithm):
                  whole_paths=True, sampler_cls=None,
                  sampler_args=dict(max_traj_len=200, n_timesteps=6400, adaptive=False,
                                    n_timesteps_min=1600, n_timesteps_max=12800, timestep_rate=40,
-                                   enable_rewnorm=True), update_curriculum=False, **kwargs):
+                                   enable_rewnorm=True), update_curriculum=False,
+                 traj_store_path=None, **kwargs):
         self.env = env
         self.policy = policy
         self.baseline = baseline
@@ -26,6 +27,8 @@ class SamplingPolicyOptimizer(RLAlgorithm):
         self.center_adv = center_adv
         self.positive_adv = positive_adv
         self.store_paths = store_paths  # TODO
+        # TrajStore receiving every sampled batch
+        self.traj_store = trajutil.TrajStore(traj_store_path) if traj_store_path else None
         self.whole_paths = whole_paths  # TODO
         if sampler_cls is None:
             sampler_cls = SimpleSampler
@@ -34,13 +37,17 @@ class SamplingPolicyOptimizer(RLAlgorithm):
         self.total_time = 0.0
 
     def train(self, sess, log, save_freq, **kwargs):
-        for itr in range(self.start_iter, self.n_iter):
-            iter_info = self.step(sess, itr)
-            log.write(iter_info, print_header=itr % 20 == 0)
-            if itr % save_freq == 0 or itr % self.n_iter:
-                log.write_snapshot(sess, self.policy, itr)
-            if self.update_curriculum:
-                self.env.update_curriculum(itr)
+        try:
+            for itr in range(self.start_iter, self.n_iter):
+                iter_info = self.step(sess, itr)
+                log.write(iter_info, print_header=itr % 20 == 0)
+                if itr % save_freq == 0 or itr % self.n_iter:
+                    log.write_snapshot(sess, self.policy, itr)
+                if self.update_curriculum:
+                    self.env.update_curriculum(itr)
+        finally:
+            if self.traj_store is not None:
+                self.traj_store.close()
 
     def step(self, sess, itr):
         with util.Timer() as t_all:
@@ -53,6 +60,9 @@ class SamplingPolicyOptimizer(RLAlgorithm):
                     self.baseline.update_obsnorm(trajbatch0.obs.stacked, sess=sess)
                     self.sampler.rewnorm.update(trajbatch0.r.stacked[:, None], sess=sess)
                 trajbatch, sample_info_fields = self.sampler.sample(sess, itr)
+                if self.traj_store is not None:
+                    self.traj_store.append(trajbatch)
+                    self.traj_store.flush()
 
             # Compute baseline
             with util.Timer() as t_base:
@@ -98,9 +108,8 @@ def TRPO(max_kl, subsample_hvp_frac=.1, damping=1e-2, grad_stop_tol=1e-6, max_cg
             # standardize advantage
             advpadded_N_H = (advantages.padded(fill=0.) - np.mean(advantages.stacked)) / (
                 np.std(advantages.stacked) + 1e-8)
-            valid = trajutil.RaggedArray([np.ones(trajlen) for trajlen in advantages.lengths])
             feed = (trajbatch.obs.padded(fill=0.), trajbatch.a.padded(fill=0.),
-                    trajbatch.adist.padded(fill=0.), advpadded_N_H, valid.padded(fill=0.))
+                    trajbatch.adist.padded(fill=0.), advpadded_N_H, advantages.mask())
         else:
             # standardize advantage
             advstacked_N = util.standardized(advantages.stacked)
@@ -182,13 +191,16 @@ class ConcurrentPolicyOptimizer(RLAlgorithm):
     def _eval_policy_weights(self, eval_trajs):
         evalrewards = np.zeros(len(self.env.agents))
         n_workers = self.sampler.n_workers if hasattr(self.sampler, 'n_workers') else 4
+        # Reuse the sampler's workers, they run the same env and policies
+        pool = getattr(self.sampler, 'pool', None)
         # Rewards when all agents have the same policy
         for agid, policy in enumerate(self.policies):
             evalrewards[agid] = np.mean(
                 util.evaluate_policy(self.env, [
                     policy for _ in range(len(self.env.agents))
                 ], n_trajs=eval_trajs, deterministic=False, max_traj_len=self.sampler.max_traj_len,
-                                     mode='concurrent', disc=self.discount, n_workers=n_workers)[
+                                     mode='concurrent', disc=self.discount, n_workers=n_workers,
+                                     pool=pool)[
                                          'ret'])
 
         weights = evalrewards / np.sum(evalrewards)
@@ -218,7 +230,8 @@ class ConcurrentPolicyOptimizer(RLAlgorithm):
                                                                             self.gae_lambda,
                                                                             self.baselines[agid])
                     trajbatch_vals_list.append(trajbatch_vals)
-                    base_info_fields_list += base_info_fields
+                    base_info_fields_list += [('{}_{}'.format(name, agid), val, typ)
+                                              for name, val, typ in base_info_fields]
 
             # Take policy steps
             with util.Timer() as t_step:
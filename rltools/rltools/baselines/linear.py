@@ -8,10 +8,13 @@ from rltools.baselines import Baseline
 
 class LinearFeatureBaseline(Baseline):
 
-    def __init__(self, observation_space, enable_obsnorm, reg_coeff=1e-5, varscope_name='linear'):
+    def __init__(self, observation_space, enable_obsnorm, reg_coeff=1e-5, chunk_size=4096,
+                 varscope_name='linear'):
         super(LinearFeatureBaseline, self).__init__(observation_space)
         self.w_Df = None
         self._reg_coeff = reg_coeff
+        # Rows whose features are built at once, so that the full feature matrix never is
+        self.chunk_size = chunk_size
         with tf.variable_scope(varscope_name + '_obsnorm'):
             self.obsnorm = (nn.Standardizer if enable_obsnorm else
                             nn.NoOpStandardizer)(self.observation_space.shape[0])
@@ -26,25 +29,40 @@ class LinearFeatureBaseline(Baseline):
         """Update norms using moving avg"""
         self.obsnorm.update(obs_B_Do, sess=sess)
 
-    def _features(self, sess, trajs):
+    def _feature_chunks(self, sess, trajs):
+        """Yields the row slices of the batch and their features"""
         obs_B_Do = trajs.obs.stacked
-        sobs_B_Do = self.obsnorm.standardize(obs_B_Do)
-        return np.concatenate([
-            sobs_B_Do.reshape(len(sobs_B_Do), np.prod(sobs_B_Do.shape[1:])), 
-            trajs.time.stacked[:, None] / 100., (trajs.time.stacked[:, None] / 100.)**2,
-            np.ones((sobs_B_Do.shape[0], 1))
-        ], axis=1)
+        t_B = trajs.time.stacked
+        Do = int(np.prod(obs_B_Do.shape[1:]))
+        for start in range(0, len(obs_B_Do), self.chunk_size):
+            sl = slice(start, start + self.chunk_size)
+            t_C = t_B[sl] / 100.
+            feat_C_Df = np.empty((len(t_C), Do + 3))
+            feat_C_Df[:, :Do] = self.obsnorm.standardize(obs_B_Do[sl], sess=sess).reshape(-1, Do)
+            feat_C_Df[:, Do] = t_C
+            feat_C_Df[:, Do + 1] = t_C**2
+            feat_C_Df[:, Do + 2] = 1.
+            yield sl, feat_C_Df
+
+    def _num_features(self, trajs):
+        return int(np.prod(trajs.obs.stacked.shape[1:])) + 3
 
     def fit(self, sess, trajs, qvals):
         assert qvals.shape == (trajs.obs.stacked.shape[0],)
-        feat_B_Df = self._features(sess, trajs)
-        self.w_Df = scipy.linalg.solve(
-            feat_B_Df.T.dot(feat_B_Df) + self._reg_coeff * np.eye(feat_B_Df.shape[1]),
-            feat_B_Df.T.dot(qvals), sym_pos=True)
+        Df = self._num_features(trajs)
+        # Normal equations, accumulated in chunks of rows
+        gram_Df_Df = self._reg_coeff * np.eye(Df)
+        featq_Df = np.zeros(Df)
+        for sl, feat_C_Df in self._feature_chunks(sess, trajs):
+            gram_Df_Df += feat_C_Df.T.dot(feat_C_Df)
+            featq_Df += feat_C_Df.T.dot(qvals[sl])
+        self.w_Df = scipy.linalg.cho_solve(scipy.linalg.cho_factor(gram_Df_Df), featq_Df)
         return []
 
     def predict(self, sess, trajs):
-        feat_B_Df = self._features(sess, trajs)
         if self.w_Df is None:
-            self.w_Df = np.zeros(feat_B_Df.shape[1], dtype=trajs.obs.stacked.dtype)
-        return feat_B_Df.dot(self.w_Df)
+            self.w_Df = np.zeros(self._num_features(trajs), dtype=trajs.obs.stacked.dtype)
+        pred_B = np.empty(len(trajs.obs.stacked))
+        for sl, feat_C_Df in self._feature_chunks(sess, trajs):
+            pred_B[sl] = feat_C_Df.dot(self.w_Df)
+        return pred_B
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
 import numpy as np
@@ -10,11 +11,22 @@ from rltools.baselines import Baseline
 class MLPBaseline(Baseline, nn.Model):
     """ Multi Layer Perceptron baseline
 
-    Optimized using natural gradients.
+    Optimized using natural gradients (`fit_mode='trust_region'`), or with `fit_mode='minibatch'` by
+    Adam on minibatches, for up to `max_epochs` epochs over all but a held out `holdout_frac` of the
+    batch. The explained variance on the held out part is checked after every epoch; fitting stops
+    once it reaches `target_r2` or hasn't improved for `patience` epochs, and the best parameters
+    are kept. If the baseline already explains `target_r2` of the new batch, no epoch is run.
+
+    With `async_fit`, `fit` hands the fitting to a background thread and returns the stats of the
+    previous fit, so that it runs while the next batch is sampled; `predict` and `update_obsnorm`
+    wait for it.
     """
 
     def __init__(self, observation_space, hidden_spec, enable_obsnorm, enable_vnorm, max_kl,
-                 damping, varscope_name, subsample_hvp_frac=.1, grad_stop_tol=1e-6, time_scale=1.):
+                 damping, varscope_name, subsample_hvp_frac=.1, grad_stop_tol=1e-6, time_scale=1.,
+                 fit_mode='trust_region', learning_rate=1e-3, minibatch_size=256, max_epochs=10,
+                 holdout_frac=.1, patience=2, target_r2=.98, async_fit=False):
+        assert fit_mode in ('trust_region', 'minibatch'), fit_mode
         self.observation_space = observation_space
         self.hidden_spec = hidden_spec
         self.enable_obsnorm = enable_obsnorm
@@ -24,6 +36,17 @@ class MLPBaseline(Baseline, nn.Model):
         self.subsample_hvp_frac = subsample_hvp_frac
         self.grad_stop_tol = grad_stop_tol
         self.time_scale = time_scale
+        self.fit_mode = fit_mode
+        self.learning_rate = learning_rate
+        self.minibatch_size = minibatch_size
+        self.max_epochs = max_epochs
+        self.holdout_frac = holdout_frac
+        self.patience = patience
+        self.target_r2 = target_r2
+        self.async_fit = async_fit
+        self._fit_executor = ThreadPoolExecutor(max_workers=1) if async_fit else None
+        self._pending_fit = None
+        self._last_fit_info = None
 
         with tf.variable_scope(varscope_name) as self.varscope:
             with tf.variable_scope('obsnorm'):
@@ -42,14 +65,24 @@ class MLPBaseline(Baseline, nn.Model):
             self._val_B = self._make_val_op(self._obs_B_Df, scaled_t_B_1)
 
         # Only code above has trainable vars
-        self._param_vars = self.get_variables(trainable=True)
-        self._num_params = self.get_num_params(trainable=True)
+        self._param_vars = self.get_trainable_variables()
+        self._num_params = self.get_num_params()
         self._curr_params_P = tfutil.flatcat(self._param_vars)
 
         # Squared loss for fitting the value function
         self._target_val_B = tf.placeholder(tf.float32, [batch_size], name='target_val_B')
         self._obj = -tf.reduce_mean(tf.square(self._val_B - self._target_val_B))
         self._objgrad_P = tfutil.flatcat(tf.gradients(self._obj, self._param_vars))
+        # Adam's state is not part of the model: its slots are named after the parameters, so
+        # get_variables leaves them out explicitly
+        self._optimizer_var_names = set()
+        if fit_mode == 'minibatch':
+            var_names0 = set(v.name for v in tf.all_variables())
+            with tf.variable_scope(varscope_name + '_optimizer'):
+                self._minibatch_step = tf.train.AdamOptimizer(
+                    learning_rate=self.learning_rate).minimize(-self._obj,
+                                                               var_list=self._param_vars)
+            self._optimizer_var_names = set(v.name for v in tf.all_variables()) - var_names0
 
         # KL divergence (as Gaussian) and its gradient
         self._old_val_B = tf.placeholder(tf.float32, [batch_size], name='old_val_B')
@@ -57,6 +90,8 @@ class MLPBaseline(Baseline, nn.Model):
 
         # KL gradient
         self._kl_grad_P = tfutil.flatcat(tf.gradients(self._kl, self._param_vars))
+        self._hvp_v_P = tf.placeholder(tf.float32, [self._num_params], name='hvp_v_P')
+        self._kl_hvp_P = tfutil.flathvp(self._kl_grad_P, self._param_vars, self._hvp_v_P)
 
         # Writing params
         self._flatparams_P = tf.placeholder(tf.float32, [self._num_params], name='flatparams_P')
@@ -64,12 +99,14 @@ class MLPBaseline(Baseline, nn.Model):
 
         ins = [self._obs_B_Df, self._t_B, self._target_val_B, self._old_val_B]
         compute_klgrad = tfutil.function(ins, self._kl_grad_P)
+        compute_klhvp = tfutil.function(ins + [self._hvp_v_P], self._kl_hvp_P)
         compute_obj_kl = tfutil.function(ins, [self._obj, self._kl])
         compute_obj_kl_with_grad = tfutil.function(ins, [self._obj, self._kl, self._objgrad_P])
 
         self._ngstep = optim.make_ngstep_func(self, compute_obj_kl=compute_obj_kl,
                                               compute_obj_kl_with_grad=compute_obj_kl_with_grad,
-                                              compute_hvp_helper=compute_klgrad)
+                                              compute_hvp_helper=compute_klgrad,
+                                              compute_klhvp=compute_klhvp)
         self.set_params = tfutil.function([self._flatparams_P], [], [self._assign_params])
         self.get_params = tfutil.function([], self._curr_params_P)
 
@@ -86,8 +123,14 @@ class MLPBaseline(Baseline, nn.Model):
             assert out_layer.output_shape == (1,)
         return out_layer.output[:, 0]
 
+    def get_variables(self):
+        """Variables saved, loaded and hashed: the parameters and norms, not optimizer state"""
+        return [v for v in super(MLPBaseline, self).get_variables()
+                if v.name not in self._optimizer_var_names]
+
     def update_obsnorm(self, obs_B_Do, sess):
         """Update norms using moving avg"""
+        self._wait_fit()
         self.obsnorm.update(obs_B_Do, sess=sess)
 
     @contextmanager
@@ -103,14 +146,44 @@ class MLPBaseline(Baseline, nn.Model):
     def fit(self, sess, trajs, qval_B):
         obs_B_Do = trajs.obs.stacked
         t_B = trajs.time.stacked
-
+        if not self.async_fit:
+            return self._fit(sess, obs_B_Do, t_B, qval_B)
+
+        self._wait_fit()
+        self._pending_fit = self._fit_executor.submit(self._fit_in_session, sess, obs_B_Do, t_B,
+                                                      qval_B)
+        if self._last_fit_info is None:
+            # Nothing fitted yet, but the log needs its columns from the first iteration on
+            return [(name, np.nan if typ is float else 0, typ)
+                    for name, typ in self._fit_field_types()]
+        return self._last_fit_info
+
+    def _fit_in_session(self, sess, obs_B_Do, t_B, qval_B):
+        # The default session is per thread
+        with sess.as_default():
+            return self._fit(sess, obs_B_Do, t_B, qval_B)
+
+    def _wait_fit(self):
+        if self._pending_fit is not None:
+            self._last_fit_info = self._pending_fit.result()
+            self._pending_fit = None
+
+    def _fit_field_types(self):
+        if self.fit_mode == 'minibatch':
+            return [('vf_fit_r2', float), ('vf_fit_r2_0', float), ('vf_fit_epochs', int)]
+        return [('vf_dl', float), ('vf_kl', float), ('vf_gnorm', float), ('vf_bt', int)]
+
+    def _fit(self, sess, obs_B_Do, t_B, qval_B):
         # Update norm
         self.obsnorm.update(obs_B_Do, sess=sess)
         self.vnorm.update(qval_B[:, None], sess=sess)
 
-        # Take step
         sobs_B_Do = self.obsnorm.standardize(obs_B_Do, sess=sess)
         sqval_B = self.vnorm.standardize(qval_B[:, None], sess=sess)[:, 0]
+        if self.fit_mode == 'minibatch':
+            return self._fit_minibatch(sess, sobs_B_Do, t_B, sqval_B)
+
+        # Take step
         feed = (sobs_B_Do, t_B, sqval_B, self._predict_raw(sess, sobs_B_Do, t_B))
         step_info = self._ngstep(sess, feed, max_kl=self.max_kl, damping=self.damping,
                                  subsample_hvp_frac=self.subsample_hvp_frac,
@@ -122,7 +195,46 @@ class MLPBaseline(Baseline, nn.Model):
             ('vf_bt', step_info.bt, int),  # backtracking steps
         ]
 
+    def _fit_minibatch(self, sess, sobs_B_Do, t_B, sqval_B):
+        B = len(sqval_B)
+        perm_B = np.random.permutation(B)
+        n_holdout = min(max(int(self.holdout_frac * B), 1), B - 1)
+        holdout_H, train_N = perm_B[:n_holdout], perm_B[n_holdout:]
+        hobs_H_Do, ht_H, hqval_H = sobs_B_Do[holdout_H], t_B[holdout_H], sqval_B[holdout_H]
+        hqval_var = np.var(hqval_H) + 1e-8
+
+        def holdout_r2():
+            return 1. - np.var(hqval_H - self._predict_raw(sess, hobs_H_Do, ht_H)) / hqval_var
+
+        r2_0 = best_r2 = holdout_r2()
+        best_params_P = self.get_params(sess=sess)
+        n_epochs = n_bad_epochs = 0
+        while (n_epochs < self.max_epochs and best_r2 < self.target_r2 and
+               n_bad_epochs < self.patience):
+            np.random.shuffle(train_N)
+            for start in range(0, len(train_N), self.minibatch_size):
+                idx_M = train_N[start:start + self.minibatch_size]
+                sess.run(self._minibatch_step, {self._obs_B_Df: sobs_B_Do[idx_M],
+                                                self._t_B: t_B[idx_M],
+                                                self._target_val_B: sqval_B[idx_M]})
+            n_epochs += 1
+            r2 = holdout_r2()
+            if r2 > best_r2:
+                best_r2, best_params_P, n_bad_epochs = r2, self.get_params(sess=sess), 0
+            else:
+                n_bad_epochs += 1
+        if n_bad_epochs > 0:
+            # Roll back the epochs that overfit
+            self.set_params(best_params_P, sess=sess)
+
+        return [
+            ('vf_fit_r2', best_r2, float),  # Held out explained variance after fitting
+            ('vf_fit_r2_0', r2_0, float),  # and before
+            ('vf_fit_epochs', n_epochs, int),
+        ]
+
     def predict(self, sess, trajs):
+        self._wait_fit()
         obs_B_Do = trajs.obs.stacked
         t_B = trajs.time.stacked
         sobs_B_Do = self.obsnorm.standardize(obs_B_Do, sess=sess)
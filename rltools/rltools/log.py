@@ -1,7 +1,11 @@
+import atexit
 import os
+import threading
+import time
 
 import tableprint
 import tables
+from six.moves import queue
 
 from rltools import nn, util
 
@@ -33,10 +37,12 @@ def _type_to_col(t, pos):
 class TrainingLog(object):
     """A training log backed by PyTables.
 
-    Stores diagnostics numbers as well as model snapshots
+    Stores diagnostics numbers as well as model snapshots. Rows are flushed to disk every
+    `flush_rows` rows or `flush_secs` seconds, and snapshots are written by a background thread
+    once their values have been read out of the session.
     """
 
-    def __init__(self, filename, attrs, debug=True):
+    def __init__(self, filename, attrs, debug=True, flush_rows=20, flush_secs=30.):
         if filename is None:
             util.warn('WARNING: not writing to any file')
             self.f = None
@@ -47,28 +53,61 @@ class TrainingLog(object):
             for k, v in attrs:
                 self.f.root._v_attrs[k] = v
             self.log_table = None
+            atexit.register(self.close)
 
         self.schema = None  # list of col name / types for display
         self.debug = debug
 
-    def close(self):
+        self.flush_rows = flush_rows
+        self.flush_secs = flush_secs
+        self._n_unflushed = 0
+        self._last_flush = time.time()
+        # PyTables is not thread safe, every access to self.f goes through this lock
+        self._lock = threading.Lock()
+        self._snapshot_queue = None
+        self._snapshot_error = None
+
+    def flush(self):
         if self.f is not None:
+            with self._lock:
+                self._flush()
+
+    def _flush(self):
+        self.f.flush()
+        self._n_unflushed = 0
+        self._last_flush = time.time()
+
+    def close(self):
+        if self.f is None or not self.f.isopen:
+            return
+        if self._snapshot_queue is not None:
+            if self._snapshot_thread.is_alive():
+                self._snapshot_queue.put(None)
+                self._snapshot_thread.join()
+            self._snapshot_queue = None
+        with self._lock:
+            self._flush()
             self.f.close()
+        self._raise_snapshot_error()
 
     def write(self, kvt, display=True, **kwargs):
         # Writing to log
         if self.f is not None:
-            if self.log_table is None:
-                desc = {k: _type_to_col(t, pos)
-                        for pos, (k, _, t) in enumerate(kvt)}  # key, value, type
-                self.log_table = self.f.create_table(self.f.root, 'log', desc)
-
-            row = self.log_table.row
-            for k, v, _ in kvt:
-                row[k] = v
-            row.append()
-
-            self.log_table.flush()
+            with self._lock:
+                if self.log_table is None:
+                    desc = {k: _type_to_col(t, pos)
+                            for pos, (k, _, t) in enumerate(kvt)}  # key, value, type
+                    self.log_table = self.f.create_table(self.f.root, 'log', desc)
+
+                row = self.log_table.row
+                for k, v, _ in kvt:
+                    row[k] = v
+                row.append()
+
+                self._n_unflushed += 1
+                if (self._n_unflushed >= self.flush_rows or
+                        time.time() - self._last_flush >= self.flush_secs):
+                    self._flush()
 
         if display:
             if self.schema is None:
@@ -93,21 +132,49 @@ class TrainingLog(object):
         if not isinstance(model, nn.Model):
             util.warn("WARNING: trying to save a non NN model. Skipping...")
             return
-        # Get var values
+        self._raise_snapshot_error()
+        # Get var values now, the HDF5 write happens in the background
         vs = model.get_variables()
         vals = sess.run(vs)
 
-        # Save all variables into this group
         print(key_iter)
+        if self._snapshot_queue is None:
+            # Bounded, so that training blocks instead of piling up snapshots if the disk is slow
+            self._snapshot_queue = queue.Queue(maxsize=2)
+            self._snapshot_thread = threading.Thread(target=self._snapshot_worker)
+            self._snapshot_thread.daemon = True
+            self._snapshot_thread.start()
+        self._snapshot_queue.put((key_iter, model.varscope.name, [v.name for v in vs], vals))
+
+    def _snapshot_worker(self):
+        while True:
+            item = self._snapshot_queue.get()
+            if item is None:
+                return
+            try:
+                with self._lock:
+                    self._write_snapshot(*item)
+            except Exception as e:
+                # Keep draining the queue so that training doesn't block on it, the error is
+                # raised to the caller of the next write_snapshot or close
+                self._snapshot_error = e
+
+    def _raise_snapshot_error(self):
+        if self._snapshot_error is not None:
+            e, self._snapshot_error = self._snapshot_error, None
+            raise e
+
+    def _write_snapshot(self, key_iter, scope_name, names, vals):
+        # Save all variables into this group
         snapshot_root = '/snapshots/iter%07d' % key_iter
 
-        for v, val in zip(vs, vals):
-            fullpath = snapshot_root + '/' + v.name
+        for name, val in zip(names, vals):
+            fullpath = snapshot_root + '/' + name
             groupname, arrayname = fullpath.rsplit('/', 1)
             self.f.create_array(groupname, arrayname, val, createparents=True)
 
         # Store the model hash as an attribute
-        model_root = snapshot_root + '/' + model.varscope.name
-        self.f.get_node(model_root)._v_attrs.hash = model.savehash(sess)
+        model_root = snapshot_root + '/' + scope_name
+        self.f.get_node(model_root)._v_attrs.hash = nn.Model._hash_name2array(zip(names, vals))
 
-        self.f.flush()
+        self._flush()
@@ -272,7 +272,8 @@ class NoOpStandardizer(object):
     def __init__(self, dim, eps=1e-6):
         pass
 
-    def update(self, points_N_D):
+    # Takes the sess and centered keywords of Standardizer
+    def update(self, points_N_D, **kwargs):
         pass
 
     def standardize_expr(self, x_B_D):
@@ -281,10 +282,10 @@ class NoOpStandardizer(object):
     def unstandardize_expr(self, y_B_D):
         return y_B_D
 
-    def standardize(self, x_B_D):
+    def standardize(self, x_B_D, **kwargs):
         return x_B_D
 
-    def unstandardize(self, y_B_D):
+    def unstandardize(self, y_B_D, **kwargs):
         return y_B_D
 
 
@@ -112,10 +112,15 @@ def ngstep(x0, obj0, objgrad0, obj_and_kl_func, hvpx0_func, max_kl, damping, max
 NGStepInfo = namedtuple('NGStepInfo', 'obj0, kl0, obj1, kl1, gnorm, bt')
 
 
-def make_ngstep_func(model, compute_obj_kl, compute_obj_kl_with_grad, compute_hvp_helper):
+def make_ngstep_func(model, compute_obj_kl, compute_obj_kl_with_grad, compute_hvp_helper,
+                     compute_klhvp=None, feed_stage=None):
     """Make a wrapper for ngstep for classes that implement nn.Model
 
-    Subsamples inputs for faster Hessian-vector products
+    Subsamples inputs for faster Hessian-vector products. With `compute_klhvp`, mapping the inputs
+    and a vector v to the exact KL Hessian-vector product at the current params, each product is
+    a single call; otherwise it is a finite difference of KL gradients (`compute_hvp_helper`) at
+    perturbed params. With `feed_stage` (a tfutil.FeedStage of the inputs), the full feed is
+    copied into the graph once per step and the objective, gradient and KL calls all read it.
     """
     assert isinstance(model, nn.Model)
 
@@ -123,6 +128,11 @@ def make_ngstep_func(model, compute_obj_kl, compute_obj_kl_with_grad, compute_hv
                 max_cg_iter=10, enable_bt=True):
         assert isinstance(feed, tuple)
         params0 = model.get_params(sess=sess)
+        host_feed = feed
+        if feed_stage is not None:
+            feed_stage.stage(feed, sess=sess)
+            feed = (None,) * len(feed)
+
         obj0, kl0, objgrad0 = compute_obj_kl_with_grad(*feed, sess=sess)
         gnorm = util.maxnorm(objgrad0)
         try:
@@ -137,9 +147,11 @@ def make_ngstep_func(model, compute_obj_kl, compute_obj_kl_with_grad, compute_hv
 
         # Data subsampling for hvp
         subsamp_feed = feed if subsample_hvp_frac is None else tfutil.subsample_feed(
-            feed, subsample_hvp_frac)
+            host_feed, subsample_hvp_frac)
 
         def hvpx0_func(v):
+            if compute_klhvp is not None:
+                return compute_klhvp(*(subsamp_feed + (v,)), sess=sess)
 
             def klgrad_func(p):
                 with model.try_params(p):
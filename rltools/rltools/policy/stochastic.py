@@ -42,8 +42,11 @@ class StochasticPolicy(Policy):
                 actiondist_shape = [batch_size, num_actiondist_params]
                 advantage_shape = [batch_size]
 
+            # The optimization inputs can be staged once per step, see optim.make_ngstep_func
+            self._feed_stage = tfutil.FeedStage()
+
             # Action distribution for current policy
-            self._obs = tf.placeholder(tf.float32, obs_shape, name='obs')
+            self._obs = self._feed_stage.placeholder(tf.float32, obs_shape, name='obs')
             with tf.variable_scope('obsnorm'):
                 self.obsnorm = (nn.Standardizer if enable_obsnorm else
                                 nn.NoOpStandardizer)(self.observation_space.shape)
@@ -55,23 +58,24 @@ class StochasticPolicy(Policy):
             else:
                 self._actiondist = self._make_actiondist_ops(self._normalized_obs)
 
-            self._input_action = tf.placeholder(action_type, action_shape,
-                                                name='input_actions')  # Action dims FIXME type
+            self._input_action = self._feed_stage.placeholder(
+                action_type, action_shape, name='input_actions')  # Action dims FIXME type
 
             self._logprobs = self._make_actiondist_logprobs_ops(self._actiondist,
                                                                 self._input_action)
 
             # proposal distribution from old policy
-            self._proposal_actiondist = tf.placeholder(tf.float32, actiondist_shape,
-                                                       name='proposal_actiondist')
+            self._proposal_actiondist = self._feed_stage.placeholder(
+                tf.float32, actiondist_shape, name='proposal_actiondist')
             self._proposal_logprobs = self._make_actiondist_logprobs_ops(self._proposal_actiondist,
                                                                          self._input_action)
 
             # Advantage
-            self._advantage = tf.placeholder(tf.float32, advantage_shape, name='advantage')
+            self._advantage = self._feed_stage.placeholder(tf.float32, advantage_shape,
+                                                           name='advantage')
 
             if self.recurrent:
-                self._valid = tf.placeholder(tf.float32, shape=[None, None], name="valid")
+                self._valid = self._feed_stage.placeholder(tf.float32, [None, None], name="valid")
             else:
                 self._valid = None
 
@@ -113,6 +117,9 @@ class StochasticPolicy(Policy):
 
             # KL gradient for TRPO
             self._kl_grad_P = tfutil.flatcat(tfutil.fixedgradients(self._kl, self._param_vars))
+            # KL Hessian-vector product, i.e. Fisher-vector product at the proposal distribution
+            self._hvp_v_P = tf.placeholder(tf.float32, [self._num_params], name='hvp_v_P')
+            self._kl_hvp_P = tfutil.flathvp(self._kl_grad_P, self._param_vars, self._hvp_v_P)
 
             ins = [self._obs, self._input_action, self._proposal_actiondist, self._advantage]
             if self.recurrent:
@@ -126,6 +133,7 @@ class StochasticPolicy(Policy):
 
             self.compute_kl_cost = tfutil.function(ins, self._kl)
             self.compute_klgrad = tfutil.function(ins, self._kl_grad_P)
+            self.compute_klhvp = tfutil.function(ins + [self._hvp_v_P], self._kl_hvp_P)
             self.compute_reinfobj_kl = tfutil.function(ins, [self._reinfobj, self._kl])
             self.compute_reinfobj_kl_with_grad = tfutil.function(
                 ins, [self._reinfobj, self._kl, self._reinfobj_grad_P])
@@ -133,7 +141,8 @@ class StochasticPolicy(Policy):
             self._ngstep = optim.make_ngstep_func(
                 self, compute_obj_kl=self.compute_reinfobj_kl,
                 compute_obj_kl_with_grad=self.compute_reinfobj_kl_with_grad,
-                compute_hvp_helper=self.compute_klgrad)
+                compute_hvp_helper=self.compute_klgrad, compute_klhvp=self.compute_klhvp,
+                feed_stage=self._feed_stage)
 
             # Writing params
             self._flatparams_P = tf.placeholder(tf.float32, [self._num_params], name='flatparams_P')
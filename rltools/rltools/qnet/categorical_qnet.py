@@ -4,12 +4,16 @@ import tensorflow as tf
 from gym import spaces
 from rltools.nn import Model, FeedforwardNet, AffineLayer
 from rltools import tfutil
+from rltools.util import EzPickle
 
 
-class CategoricalQFunction(Model):
+class CategoricalQFunction(Model, EzPickle):
 
     def __init__(self, obsfeat_space, action_space, hidden_spec, learning_rate, varscope_name,
                  primary_q_func=None, dueling=False):
+        # Unpickled copies (e.g. in actor processes) stand alone, without their primary
+        EzPickle.__init__(self, obsfeat_space, action_space, hidden_spec, learning_rate,
+                          varscope_name, None, dueling)
         self.obsfeat_space = obsfeat_space
         self.action_space = action_space
         self.learning_rate = learning_rate
@@ -44,6 +48,8 @@ class CategoricalQFunction(Model):
             self._loss = tf.reduce_mean(
                 tf.square(tf.clip_by_value(self._delta, self.min_delta, self.max_delta)),
                 name='loss')
+            # Importance sampling weights of prioritized replay in fused_opt_step, ones otherwise
+            self._weights_B = tf.placeholder(tf.float32, [batch_size], name='weights_B')
 
             with tf.variable_scope('optimizer'):
                 self._optimizer = tf.train.AdamOptimizer(
@@ -96,6 +102,69 @@ class CategoricalQFunction(Model):
             qvals_B = out_layer.output[:, 0]
         return qvals_B
 
+    def _make_all_qvals_op(self, obsfeat_B_Df):
+        """Q values of every discrete action, (B, n_actions), reusing this function's variables"""
+        n_actions = self.action_space.n
+        batch_size = tf.shape(obsfeat_B_Df)[0]
+        # Same layout as compute_qactions: action-major blocks of the tiled batch
+        obsfeat_NB_Df = tf.tile(obsfeat_B_Df, [n_actions, 1])
+        action_N_B = tf.tile(tf.expand_dims(tf.range(n_actions), 1), tf.pack([1, batch_size]))
+        action_NB_Da = tf.to_float(tf.reshape(action_N_B, [-1, 1]))
+        with tf.variable_scope(self.varscope, reuse=True):
+            qvals_NB = self._make_qval_op(obsfeat_NB_Df, action_NB_Da)
+        return tf.transpose(tf.reshape(qvals_NB, [n_actions, -1]))
+
+    def make_fused_opt_step(self, target_q_func, discount, double_q=False):
+        """
+        Builds one op computing the Q learning targets of a batch with `target_q_func` and taking
+        the gradient step on them, so that an update is a single session call (fused_opt_step).
+        With `double_q` the successor actions are picked by this function and evaluated by the
+        target one. Must be called before the variables are initialized.
+        """
+        assert isinstance(target_q_func, CategoricalQFunction)
+        with tf.variable_scope(self.varscope), tf.variable_scope('fused_update'):
+            self._fused_rewards_B = tf.placeholder(tf.float32, [None], name='rewards_B')
+            self._fused_succ_obsfeat_B_Df = tf.placeholder(
+                tf.float32, [None] + list(self.obsfeat_space.shape), name='succ_obsfeat_B_Df')
+            self._fused_done_B = tf.placeholder(tf.float32, [None], name='done_B')
+
+            target_qvals_B_N = target_q_func._make_all_qvals_op(self._fused_succ_obsfeat_B_Df)
+            if double_q:
+                n_actions = self.action_space.n
+                succ_actions_B = tf.to_int32(
+                    tf.argmax(self._make_all_qvals_op(self._fused_succ_obsfeat_B_Df), 1))
+                flat_idx_B = tf.range(tf.shape(succ_actions_B)[0]) * n_actions + succ_actions_B
+                succ_qvals_B = tf.gather(tf.reshape(target_qvals_B_N, [-1]), flat_idx_B)
+            else:
+                succ_qvals_B = tf.reduce_max(target_qvals_B_N, 1)
+            qtargets_B = tf.stop_gradient(
+                self._fused_rewards_B + discount * (1. - self._fused_done_B) * succ_qvals_B)
+
+            self._fused_delta_B = self._qvals_B - qtargets_B
+            self._fused_loss = tf.reduce_mean(
+                self._weights_B * tf.square(
+                    tf.clip_by_value(self._fused_delta_B, self.min_delta, self.max_delta)),
+                name='loss')
+            # Separate moments from _optimizer; only one of the two is used in a run
+            self._fused_optimizer = tf.train.AdamOptimizer(
+                learning_rate=self.learning_rate, name='FusedAdam').minimize(
+                    self._fused_loss, var_list=self._param_vars)
+
+    def fused_opt_step(self, sess, obsfeat_B_Df, action_B_Da, rewards_B, succ_obsfeat_B_Df, done_B,
+                       weights_B=None):
+        """Returns the loss and the TD errors (before the step)"""
+        if weights_B is None:
+            weights_B = np.ones(len(rewards_B))
+        loss, delta_B, _ = sess.run(
+            [self._fused_loss, self._fused_delta_B, self._fused_optimizer],
+            {self._obsfeat_B_Df: obsfeat_B_Df,
+             self._action_B_Da: action_B_Da,
+             self._fused_rewards_B: rewards_B,
+             self._fused_succ_obsfeat_B_Df: succ_obsfeat_B_Df,
+             self._fused_done_B: done_B,
+             self._weights_B: weights_B})
+        return loss, delta_B
+
     def compute_qvals(self, sess, obsfeat_B_Df, action_B_Da):
         return sess.run(self._qvals_B, {self._obsfeat_B_Df: obsfeat_B_Df,
                                         self._action_B_Da: action_B_Da})
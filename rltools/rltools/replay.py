@@ -0,0 +1,151 @@
+import numpy as np
+
+
+class ReplayBuffer(object):
+    """
+    Ring buffer of multi-agent transitions (s, a, r, s', done) in preallocated
+    (capacity, n_agents, ...) arrays. Each env step is one write per field, and batches come out
+    flattened to (B*n_agents, ...) rows, agent-minor, ready to be fed.
+    """
+
+    def __init__(self, capacity, n_agents, obs_shape, action_dim=1, obs_dtype=np.float32):
+        self.capacity = capacity
+        self.n_agents = n_agents
+        self._obs = np.zeros((capacity, n_agents) + tuple(obs_shape), dtype=obs_dtype)
+        self._actions = np.zeros((capacity, n_agents, action_dim))
+        self._rewards = np.zeros((capacity, n_agents))
+        self._succ_obs = np.zeros((capacity, n_agents) + tuple(obs_shape), dtype=obs_dtype)
+        self._done = np.zeros(capacity)
+        self._head = 0  # next slot to write
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, obs_N_Do, action_N_Da, reward_N, succ_obs_N_Do, done):
+        """Stores one transition of all agents and returns its index"""
+        idx = self._head
+        self._obs[idx] = obs_N_Do
+        self._actions[idx] = np.reshape(action_N_Da, self._actions.shape[1:])
+        self._rewards[idx] = reward_N
+        self._succ_obs[idx] = succ_obs_N_Do
+        self._done[idx] = done
+        self._head = (self._head + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+        return idx
+
+    def sample_indices(self, batch_size):
+        return np.random.randint(self._size, size=batch_size)
+
+    def gather(self, idx_B):
+        """Returns the obs, actions, rewards, successor obs and done flags of the given
+        transitions as (B*n_agents, ...) arrays
+        """
+        BN = len(idx_B) * self.n_agents
+        return (self._obs[idx_B].reshape((BN,) + self._obs.shape[2:]),
+                self._actions[idx_B].reshape(BN, -1), self._rewards[idx_B].reshape(BN),
+                self._succ_obs[idx_B].reshape((BN,) + self._succ_obs.shape[2:]),
+                np.repeat(self._done[idx_B], self.n_agents))
+
+    def sample(self, batch_size):
+        return self.gather(self.sample_indices(batch_size))
+
+
+class SumTree(object):
+    """
+    Binary tree of sums over `capacity` non-negative leaf values, in a flat array where node i has
+    children 2i and 2i+1 and the leaves start at `self._n`. Updates and prefix-sum lookups are
+    O(log N) and take arrays of leaves, one tree level at a time.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._n = 1
+        while self._n < capacity:
+            self._n *= 2
+        self._tree = np.zeros(2 * self._n)
+
+    @property
+    def total(self):
+        return self._tree[1]
+
+    def __getitem__(self, leaf_idx):
+        return self._tree[self._n + np.asarray(leaf_idx)]
+
+    def update(self, leaf_idx, values):
+        idx = self._n + np.atleast_1d(leaf_idx)
+        self._tree[idx] = values
+        while idx[0] > 1:
+            idx = np.unique(idx // 2)
+            self._tree[idx] = self._tree[2 * idx] + self._tree[2 * idx + 1]
+
+    def find(self, values):
+        """Returns, for each value, the leaf whose prefix-sum interval contains it"""
+        values = np.array(values, dtype=float)
+        idx = np.ones(len(values), dtype=int)
+        while idx[0] < self._n:
+            left = self._tree[2 * idx]
+            go_right = values >= left
+            values -= left * go_right
+            idx = 2 * idx + go_right
+        return idx - self._n
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    ReplayBuffer sampling transitions with probability proportional to priority**alpha, the
+    priority being the last absolute TD error (plus `eps`). New transitions get the highest priority
+    seen so far. With `shared_priorities` all agents of a transition share one priority (the max of
+    their TD errors) and are sampled together; otherwise every agent's row is sampled on its own.
+    """
+
+    def __init__(self, capacity, n_agents, obs_shape, action_dim=1, obs_dtype=np.float32,
+                 alpha=0.6, beta=0.4, eps=1e-6, shared_priorities=True):
+        super(PrioritizedReplayBuffer, self).__init__(capacity, n_agents, obs_shape, action_dim,
+                                                      obs_dtype)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.shared_priorities = shared_priorities
+        self._leaves_per_transition = 1 if shared_priorities else n_agents
+        self._tree = SumTree(capacity * self._leaves_per_transition)
+        self._max_priority = 1.
+
+    def add(self, obs_N_Do, action_N_Da, reward_N, succ_obs_N_Do, done):
+        idx = super(PrioritizedReplayBuffer, self).add(obs_N_Do, action_N_Da, reward_N,
+                                                       succ_obs_N_Do, done)
+        L = self._leaves_per_transition
+        self._tree.update(np.arange(idx * L, (idx + 1) * L), self._max_priority**self.alpha)
+        return idx
+
+    def sample(self, batch_size):
+        """Returns the batch, the importance sampling weights of its (B*n_agents,) rows, and the
+        sampled leaves to pass back to `update_priorities`
+        """
+        n = batch_size * self._leaves_per_transition
+        n_leaves = len(self) * self._leaves_per_transition
+        total = self._tree.total
+        # Stratified: one draw in each of n equal slices of the total priority mass
+        values = (np.arange(n) + np.random.rand(n)) * (total / n)
+        # so that any contiguous part of the batch is spread over the whole buffer too
+        np.random.shuffle(values)
+        leaves = np.minimum(self._tree.find(values), n_leaves - 1)
+
+        weights = (n_leaves * self._tree[leaves] / total)**-self.beta
+        weights /= weights.max()
+        if self.shared_priorities:
+            return self.gather(leaves), np.repeat(weights, self.n_agents), leaves
+
+        idx_BN, agent_BN = np.divmod(leaves, self.n_agents)
+        batch = (self._obs[idx_BN, agent_BN], self._actions[idx_BN, agent_BN],
+                 self._rewards[idx_BN, agent_BN], self._succ_obs[idx_BN, agent_BN],
+                 self._done[idx_BN])
+        return batch, weights, leaves
+
+    def update_priorities(self, leaves, td_errors_BN):
+        td_errors = np.abs(td_errors_BN)
+        if self.shared_priorities:
+            td_errors = td_errors.reshape(-1, self.n_agents).max(axis=1)
+        priorities = td_errors + self.eps
+        self._max_priority = max(self._max_priority, priorities.max())
+        self._tree.update(leaves, priorities**self.alpha)
@@ -3,7 +3,7 @@ from gym import spaces
 
 from rltools import nn
 import rltools.util
-from rltools.trajutil import RaggedArray, TrajBatch, Trajectory
+from rltools.trajutil import RaggedArray, TrajBatch, Trajectory, TrajectoryBuilder
 
 
 class Sampler(object):
@@ -23,6 +23,7 @@ class Sampler(object):
             self.n_timesteps_min = n_timesteps_min
             self.n_timesteps_max = n_timesteps_max
         self.n_episodes = 0
+        self.debug = False
 
     def start(self):
         """Init sampler"""
@@ -33,28 +34,22 @@ class Sampler(object):
         raise NotImplementedError()
 
     def process(self, sess, itr, trajbatch, discount, gae_lambda, baseline):
-        B = len(trajbatch)
-        trajlens = [len(traj) for traj in trajbatch]
-        maxT = max(trajlens)
+        trajlens = trajbatch.r.lengths
 
-        rewards_B_T = self.rewnorm.standardize(
-            trajbatch.r.padded(fill=0.), centered=False, sess=sess)
+        rewards = self.rewnorm.standardize(
+            trajbatch.r.stacked[:, None], centered=False, sess=sess)[:, 0]
         assert not self.algo.discount is None
-        qvals_zfilled_B_T = rltools.util.discount(rewards_B_T, discount)
-        assert qvals_zfilled_B_T.shape == (B, maxT)
-        q = RaggedArray([qvals_zfilled_B_T[i, :len(traj)] for i, traj in enumerate(trajbatch)])
-        q_B_T = q.padded(fill=np.nan)  # q vals padded with nans in the end
-        assert q_B_T.shape == (B, maxT)
+        q = RaggedArray(rltools.util.discount_stacked(rewards, trajlens, discount),
+                        lengths=trajlens)
 
         # Time-dependent baseline
-        simplev_B_T = np.tile(np.nanmean(q_B_T, axis=0, keepdims=True), (B, 1))
-        assert simplev_B_T.shape == (B, maxT)
-        simplev = RaggedArray([simplev_B_T[i, :len(traj)] for i, traj in enumerate(trajbatch)])
+        t_stacked = trajbatch.time.stacked.astype(int)
+        simplev_T = np.bincount(t_stacked, weights=q.stacked) / np.bincount(t_stacked)
+        simplev = RaggedArray(simplev_T[t_stacked], lengths=trajlens)
 
         # State-dependent baseline
         v_stacked = baseline.predict(sess, trajbatch)
         assert v_stacked.ndim == 1
-        v = RaggedArray(v_stacked, lengths=trajlens)
 
         # Compare squared loss of value function to that of time-dependent value function
         # Explained variance
@@ -70,17 +65,26 @@ class Sampler(object):
 
         # XXX HACK
         if vfunc_r2 < 0:
-            v = simplev
+            v_stacked = simplev.stacked
 
         # Compute advantage -- GAE(gamma,lambda) estimator
-        v_B_T = v.padded(fill=0.)
-        v_B_Tp1 = np.concatenate([v_B_T, np.zeros((B, 1))], axis=1)
-        #assert v_B_Tp1.shape == (B, maxT + 1)
-        delta_B_T = rewards_B_T + discount * v_B_Tp1[:, 1:] - v_B_Tp1[:, :-1]
-        adv_B_T = rltools.util.discount(delta_B_T, discount * gae_lambda)
-        #assert adv_B_T.shape == (B, maxT)
-        adv = RaggedArray([adv_B_T[i, :l] for i, l in enumerate(trajlens)])
-        assert np.allclose(adv.padded(fill=0), adv_B_T)
+        vnext_stacked = np.zeros_like(v_stacked)
+        vnext_stacked[:-1] = v_stacked[1:]
+        vnext_stacked[np.cumsum(trajlens) - 1] = 0.  # no bootstrapping past the end of a traj
+        delta_stacked = rewards + discount * vnext_stacked - v_stacked
+        adv = RaggedArray(rltools.util.discount_stacked(delta_stacked, trajlens,
+                                                        discount * gae_lambda), lengths=trajlens)
+
+        if self.debug:
+            # Check against the padded computation
+            rewards_B_T = RaggedArray(rewards, lengths=trajlens).padded(fill=0.)
+            assert np.allclose(q.padded(fill=0.), rltools.util.discount(rewards_B_T, discount))
+            delta_B_T = RaggedArray(delta_stacked, lengths=trajlens).padded(fill=0.)
+            assert np.allclose(
+                adv.padded(fill=0.), rltools.util.discount(delta_B_T, discount * gae_lambda))
+            q_B_T = q.padded(fill=np.nan)
+            assert np.allclose(simplev.padded(fill=0.),
+                               np.where(np.isnan(q_B_T), 0., np.nanmean(q_B_T, axis=0)))
 
         # Fit for the next time step
         baseline_info = baseline.fit(sess, trajbatch, q.stacked)
@@ -91,103 +95,70 @@ class Sampler(object):
         raise NotImplementedError()
 
 
+def _find_stats_env(env):
+    """Returns the first env in the wrapper chain that keeps mergeable running statistics"""
+    while env is not None:
+        if hasattr(env, 'merge_stats'):
+            return env
+        env = getattr(env, '_unwrapped', None)
+    return None
+
+
 def centrollout(env, policy, max_traj_len, action_space):
     policy.reset()
-    obs, actions, actiondists, rewards = [], [], [], []
-    traj_info_list = []
-    obs.append(np.c_[env.reset()].ravel()[None, ...].copy())
+    builder = TrajectoryBuilder(max_traj_len)
+    obs = np.c_[env.reset()].ravel()[None, ...]
 
     for itr in range(max_traj_len):
-        a, adist = policy.sample_actions(obs[-1])
-        actions.append(a)
-        actiondists.append(adist)
+        a, adist = policy.sample_actions(obs)
         if isinstance(action_space, spaces.Discrete):
             ndim = 1 if not hasattr(action_space, 'ndim') else action_space.ndim
             assert a.ndim == 2 and a.dtype in (np.int32, np.int64)
             if ndim == 1:
-                o2, r, done, info = env.step(actions[-1][0, 0])  # XXX
+                o2, r, done, info = env.step(a[0, 0])  # XXX
             else:
-                o2, r, done, info = env.step(actions[-1][0, :ndim])  # XXX
+                o2, r, done, info = env.step(a[0, :ndim])  # XXX
         else:
-            o2, r, done, info = env.step(actions[-1][0])
+            o2, r, done, info = env.step(a[0])
 
         if isinstance(r, list) or isinstance(r, np.ndarray):
+            r = np.asarray(r)
             assert (r == r[0]).all()
-            rewards.append(r[0])
-        else:
-            rewards.append(r)
+            r = r[0]
 
-        if info:
-            traj_info_list.append(info)
+        builder.add(obs, a, adist, r, info)
 
         if done:
             break
-        if itr != max_traj_len - 1:
-            obs.append(np.c_[o2].ravel()[None, ...])
-
-    traj_info = rltools.util.stack_dict_list(traj_info_list)
-    obs_T_Do = np.concatenate(obs)
-    assert obs_T_Do.shape[0] == len(obs), '{} != {}'.format(obs_T_Do.shape, len(obs))
-    adist_T_Pa = np.concatenate(actiondists)
-    assert adist_T_Pa.ndim == 2 and adist_T_Pa.shape[0] == len(obs)
-    a_T_Da = np.concatenate(actions)
-    assert a_T_Da.shape[0] == len(obs)
-    r_T = np.asarray(rewards)
-    assert r_T.shape == (len(obs),)
+        obs = np.c_[o2].ravel()[None, ...]
 
-    return Trajectory(obs_T_Do, adist_T_Pa, a_T_Da, r_T, traj_info)
-
-
-def get_lists(nl, na):
-    l = []
-    for i in range(nl):
-        l.append([[] for j in range(na)])
-    return l
+    return builder.finish()[0]
 
 
 def decrollout(env, policy, max_traj_len, action_space):
     assert not isinstance(policy, list)
     policy.reset(dones=[True] * len(env.agents))
-    trajs = []
+    builder = TrajectoryBuilder(max_traj_len, n_agents=len(env.agents))
     old_obs = env.reset()
-    obs, actions, actiondists, rewards = get_lists(4, len(env.agents))
-    traj_info_list = []
 
     for itr in range(max_traj_len):
-        agent_actions, adist_list = policy.sample_actions(np.asarray(old_obs))
+        obs = np.asarray(old_obs)
+        agent_actions, adist_list = policy.sample_actions(obs)
         comp_actions = np.array(agent_actions)
-        for i, agent_obs in enumerate(old_obs):
-            obs[i].append(np.expand_dims(agent_obs, 0))
-            actions[i].append(agent_actions[i])
-            actiondists[i].append(adist_list[i])
 
         if isinstance(action_space, spaces.Discrete):
             new_obs, r, done, info = env.step(comp_actions[:, 0])
         else:
             new_obs, r, done, info = env.step(comp_actions)
 
-        if info:
-            traj_info_list.append(info)
-
-        for i, o in enumerate(old_obs):
-            if o is None:
-                continue
-            rewards[i].append(r[i])
+        builder.add(obs, agent_actions, adist_list, r, info)
 
         old_obs = new_obs
 
         if done:
             break
 
-    traj_info = rltools.util.stack_dict_list(traj_info_list)
-    for agnt in range(len(env.agents)):
-        obs_T_Do = np.concatenate(obs[agnt])
-        adist_T_Pa = np.concatenate(np.expand_dims(np.asarray(actiondists[agnt]), 0))
-        a_T_Da = np.concatenate(np.expand_dims(np.asarray(actions[agnt]), 0))
-        r_T = np.asarray(rewards[agnt])
-        trajs.append(Trajectory(obs_T_Do, adist_T_Pa, a_T_Da, r_T, traj_info))
-
-    return trajs
+    return builder.finish()
 
 
 def concrollout(env, policies, max_traj_len, action_space):
@@ -195,10 +166,9 @@ def concrollout(env, policies, max_traj_len, action_space):
 
     for policy in policies:
         policy.reset()
-    trajs = []
+    # One builder per agent, as the agents' observation and action shapes can differ
+    builders = [TrajectoryBuilder(max_traj_len) for _ in policies]
     old_obs = env.reset()
-    obs, actions, actiondists, rewards = get_lists(4, len(env.agents))
-    traj_info_list = []
     for itr in range(max_traj_len):
         agent_actions, adist_list = [], []
         for i, agent_obs in enumerate(old_obs):
@@ -207,37 +177,94 @@ def concrollout(env, policies, max_traj_len, action_space):
             adist_list.append(adist)
 
         comp_actions = np.array(agent_actions)
-        for i, agent_obs in enumerate(old_obs):
-            obs[i].append(np.expand_dims(agent_obs, 0))
-            actions[i].append(agent_actions[i])
-            actiondists[i].append(adist_list[i])
-
         if isinstance(action_space, spaces.Discrete):
             new_obs, r, done, info = env.step(comp_actions[:, 0, 0])
         else:
             new_obs, r, done, info = env.step(comp_actions)
 
-        if info:  # XXX what if some infos are none in a traj?
-            traj_info_list.append(info)
-
-        for i, o in enumerate(old_obs):
-            if o is None:
-                continue
-            rewards[i].append(r[i])
+        # XXX what if some infos are none in a traj?
+        for i, builder in enumerate(builders):
+            builder.add(np.asarray(old_obs[i])[None], agent_actions[i], adist_list[i], [r[i]],
+                        info)
 
         old_obs = new_obs
 
         if done:
             break
 
-    traj_info = rltools.util.stack_dict_list(traj_info_list)
-    for agnt in range(len(env.agents)):
-        a_T_Da = np.concatenate(np.asarray(actions[agnt]))
-        r_T = np.asarray(rewards[agnt])
-        trajs.append(Trajectory(obs_T_Do, adist_T_Pa, a_T_Da, r_T, traj_info))
+    return [builder.finish()[0] for builder in builders]
+
+
+def vecrollout(envs, policy, max_traj_len, action_space, n_timesteps, mode='decentralized'):
+    """Runs episodes on all `envs` in lockstep until at least `n_timesteps` have been collected.
+
+    At every step the observations of all live envs (and all their agents in decentralized mode)
+    go through a single `policy.sample_actions` call and the actions are routed back to the envs.
+    An env whose episode ends has its trajectories retired and is reset, unless the finished and
+    running episodes already cover `n_timesteps`, in which case it is left idle. Episodes are never
+    cut short, so the result can overshoot `n_timesteps` like the serial samplers do.
+    """
+    assert mode in ('centralized', 'decentralized')
+    assert not policy.recurrent, 'Recurrent policies need a fixed batch of hidden states'
+    if isinstance(action_space, spaces.Discrete):
+        ndim = 1 if not hasattr(action_space, 'ndim') else action_space.ndim
+
+    def observe(o):
+        if mode == 'decentralized':
+            return np.asarray(o)
+        return np.c_[o].ravel()[None, ...]
+
+    def env_action(a_N_Da):
+        if mode == 'decentralized':
+            return a_N_Da[:, 0] if isinstance(action_space, spaces.Discrete) else a_N_Da
+        if isinstance(action_space, spaces.Discrete):
+            return a_N_Da[0, 0] if ndim == 1 else a_N_Da[0, :ndim]
+        return a_N_Da[0]
+
+    def env_reward(r):
+        if mode == 'decentralized':
+            return r
+        if isinstance(r, list) or isinstance(r, np.ndarray):
+            r = np.asarray(r)
+            assert (r == r[0]).all()
+            r = r[0]
+        return r
+
+    curr_obs = [observe(env.reset()) for env in envs]
+    builders = [TrajectoryBuilder(max_traj_len, n_agents=obs.shape[0]) for obs in curr_obs]
+    live = list(range(len(envs)))
+    trajs = []
+    timesteps_sofar = 0
+    while live:
+        obs_B_Do = np.concatenate([curr_obs[k] for k in live])
+        a_B_Da, adist_B_Pa = policy.sample_actions(obs_B_Do)
+        bounds = np.cumsum([0] + [curr_obs[k].shape[0] for k in live])
+
+        still_live = []
+        for j, k in enumerate(live):
+            rows = slice(bounds[j], bounds[j + 1])
+            new_obs, r, done, info = envs[k].step(env_action(a_B_Da[rows]))
+            builders[k].add(curr_obs[k], a_B_Da[rows], adist_B_Pa[rows], env_reward(r), info)
+
+            if not done and len(builders[k]) < max_traj_len:
+                curr_obs[k] = observe(new_obs)
+                still_live.append(k)
+                continue
+
+            # Retire the episode, one trajectory per agent
+            ep_trajs = builders[k].finish()
+            trajs.extend(ep_trajs)
+            timesteps_sofar += sum(len(traj) for traj in ep_trajs)
+
+            running = sum(len(builders[l]) * builders[l].n_agents for l in live)
+            if timesteps_sofar + running < n_timesteps:
+                curr_obs[k] = observe(envs[k].reset())
+                still_live.append(k)
+        live = still_live
 
     return trajs
-    
+
+
 def evaluate(env, obsfeat_fn, action_fn, max_traj_len, n_traj):
     rs = np.zeros(n_traj)
     for t in range(n_traj):
@@ -1,20 +1,20 @@
+import glob
 import logging
 import os
 import random
 import subprocess
 import sys
 import tempfile
-import time
 from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import tensorflow as tf
 import zerorpc
-from gevent import Timeout
+import gevent
 from zerorpc.gevent_zmq import logger as gevent_log
 from multiprocessing import cpu_count
 
-from rltools.samplers import Sampler, decrollout, centrollout, concrollout
+from rltools.samplers import Sampler, decrollout, centrollout, concrollout, _find_stats_env
 from rltools.trajutil import TrajBatch, Trajectory
 from six.moves import cPickle
 
@@ -25,27 +25,28 @@ class ParallelSampler(Sampler):
 
     def __init__(self, algo, n_timesteps, max_traj_len, timestep_rate, n_timesteps_min,
                  n_timesteps_max, adaptive=False, enable_rewnorm=True, n_workers=4,
-                 mode='centralized', discard_extra=False):
+                 mode='centralized', discard_extra=False, merge_env_stats=False):
         super(ParallelSampler, self).__init__(algo, n_timesteps, max_traj_len, timestep_rate,
                                               n_timesteps_min, n_timesteps_max, adaptive,
                                               enable_rewnorm)
         self.n_workers = n_workers
         self.mode = mode
         self.discard_extra = discard_extra
-        self.workers = self.start_workers()
+        self.merge_env_stats = merge_env_stats
+        self.pool = self.start_workers()
+        self.workers = self.pool.workers
         self.seed_idx = 0
         self.seed_idx2 = 0
 
     def start_workers(self):
-        sidx = np.random.randint(cpu_count())
-        # yapf: disable
-        proxies = [RolloutProxy(self.algo.env,
-                                self.algo.policies if self.mode == 'concurrent' else self.algo.policy,
-                                self.max_traj_len,
-                                self.mode, i,sidx)
-                   for i in range(self.n_workers)]
-        # yapf: enable
-        return proxies
+        # Rows each of a worker's trajectory segments starts with. In concurrent mode every agent
+        # has its own segment, as the agents' observation and action shapes can differ.
+        n_trajs = len(self.algo.env.agents) if self.mode == 'decentralized' else 1
+        capacity = (self.n_timesteps // self.n_workers + self.max_traj_len) * n_trajs
+        return RolloutPool(self.algo.env,
+                           self.algo.policies if self.mode == 'concurrent' else self.algo.policy,
+                           self.max_traj_len, self.mode, self.n_workers,
+                           segment_capacity=capacity)
 
     def sample(self, sess, itr):
         if self.adaptive and itr > 0 and self.n_timesteps < self.n_timesteps_max:
@@ -53,80 +54,73 @@ class ParallelSampler(Sampler):
                 self.n_timesteps *= 2
 
         if self.mode == 'concurrent':
-            state_str = _dumps([policy.get_state() for policy in self.algo.policies])
+            self.pool.set_state([policy.get_state() for policy in self.algo.policies])
         else:
-            state_str = _dumps(self.algo.policy.get_state())
-        [worker.client("set_state", state_str, async=True) for worker in self.workers]
+            self.pool.set_state(self.algo.policy.get_state())
 
         self.seed_idx2 = self.seed_idx
         timesteps_sofar = 0
         seed2traj = {}
         worker2job = {}
+        # Next free row in each of the workers' trajectory segments
+        n_segments = len(self.algo.env.agents) if self.mode == 'concurrent' else 1
+        worker2offsets = [[0] * n_segments for _ in range(self.n_workers)]
 
         def assign_job_to(i_worker):
-            worker2job[i_worker] = (self.seed_idx2, self.workers[i_worker].client("sample",
-                                                                                  self.seed_idx2,
-                                                                                  async=True))
+            worker2job[i_worker] = (self.seed_idx2, self.workers[i_worker].client(
+                "sample_to_segment", self.seed_idx2, worker2offsets[i_worker], async=True))
             self.seed_idx2 += 1
 
+        def finish_job(i_worker, traj_string):
+            seed_idx = worker2job[i_worker][0]
+            meta = _loads(traj_string)
+            worker2offsets[i_worker] = meta['ends']
+            seed2traj[seed_idx] = (i_worker, meta)
+            if self.mode == 'decentralized':
+                return np.sum(meta['lengths'])
+            # One trajectory in centralized mode, one per agent of equal length in concurrent mode
+            return meta['lengths'][0]
+
         # Start jobs
         for i_worker in range(self.n_workers):
             assign_job_to(i_worker)
 
-        while True:
-            for i_worker in range(self.n_workers):
-                try:
-                    (seed_idx, future) = worker2job[i_worker]
-                    traj_string = future.get(timeout=1e-3)  # XXX
-                except Timeout:
-                    pass
-                else:
-                    traj = _loads(traj_string)
-                    seed2traj[seed_idx] = traj
-                    if self.mode == 'centralized':
-                        timesteps_sofar += len(traj)
-                    elif self.mode == 'decentralized':
-                        assert isinstance(traj, list)
-                        timesteps_sofar += np.sum(map(len, traj))
-                    elif self.mode == 'concurrent':
-                        assert isinstance(traj, list)
-                        timesteps_sofar += len(traj[0])
-                    else:
-                        raise NotImplementedError()
-                    if timesteps_sofar >= self.n_timesteps:
-                        break
-                    else:
-                        assign_job_to(i_worker)
-            if timesteps_sofar >= self.n_timesteps:
-                break
-            time.sleep(0.01)
+        while timesteps_sofar < self.n_timesteps:
+            # Block until some worker is done and hand it its next job right away
+            ready = gevent.wait([future for _, future in worker2job.values()], count=1)
+            for i_worker, (seed_idx, future) in list(worker2job.items()):
+                if future not in ready:
+                    continue
+                timesteps_sofar += finish_job(i_worker, future.get())
+                if timesteps_sofar >= self.n_timesteps:
+                    break
+                assign_job_to(i_worker)
 
         # Wait until all jobs finish
-        for seed_idx, future in worker2job.values():
-            seed2traj[seed_idx] = _loads(future.get())
-
-        trajs = []
-        if self.mode == 'concurrent':
-            trajs = [[] for _ in self.algo.env.agents]
-        for (seed, traj) in seed2traj.items():
-            if self.mode == 'centralized':
-                trajs.append(traj)
-                timesteps_sofar += len(traj)
-            elif self.mode == 'decentralized':
-                trajs.extend(traj)
-                timesteps_sofar += np.sum(map(len, traj))
-            elif self.mode == 'concurrent':
-                assert isinstance(traj, list)
-                for tid, tr in enumerate(traj):
-                    trajs[tid].append(tr)
-
-                timesteps_sofar += len(traj[0])
+        for i_worker, (seed_idx, future) in worker2job.items():
+            if seed_idx not in seed2traj:
+                finish_job(i_worker, future.get())
+
+        # (worker, segment, offset, length) of every trajectory, per batch
+        slices, infos = [[] for _ in range(n_segments)], [[] for _ in range(n_segments)]
+        for (seed, (i_worker, meta)) in seed2traj.items():
+            for i_segment, offset, length, info in zip(meta['segments'], meta['offsets'],
+                                                       meta['lengths'], meta['info']):
+                slices[i_segment].append((i_worker, i_segment, offset, length))
+                infos[i_segment].append(info)
+                timesteps_sofar += length
             self.seed_idx += 1
             if self.discard_extra and timesteps_sofar >= self.n_timesteps:
                 break
 
+        segments = [[_open_segment(spec) for spec in _loads(worker.client("segment_specs"))]
+                    for worker in self.workers]
+        trajbatches = [_gather_trajbatch(segments, sl, inf) for sl, inf in zip(slices, infos)]
+
+        if self.merge_env_stats:
+            self.sync_env_stats()
+
         if self.mode == 'concurrent':
-            trajbatches = [TrajBatch.FromTrajs(ts) for ts in trajs]
             self.n_episodes += len(trajbatches[0])
             return (
                 trajbatches,
@@ -147,7 +141,7 @@ class ParallelSampler(Sampler):
                  ('ravg', np.mean([trajbatch.r.stacked.mean() for trajbatch in trajbatches]), float)
                 ] + [(info[0], np.mean(info[1]), float) for info in trajbatches[0].info])
         else:
-            trajbatch = TrajBatch.FromTrajs(trajs)
+            trajbatch = trajbatches[0]
             self.n_episodes += len(trajbatch)
             return (
                 trajbatch,
@@ -164,16 +158,97 @@ class ParallelSampler(Sampler):
                 ] + [(info[0], np.mean(info[1]), float) for info in trajbatch.info])
 
 
+    def sync_env_stats(self):
+        """Merges the running env statistics (e.g. of a StandardizedEnv) of all workers and
+        hands the merged statistics back to the workers and the local env.
+        """
+        statsenv = _find_stats_env(self.algo.env)
+        if statsenv is None:
+            return
+        stats = [_loads(worker.client("get_env_stats")) for worker in self.workers]
+        merged = statsenv.merge_stats(stats)
+        statsenv.set_stats(merged)
+        stats_str = _dumps(merged)
+        [worker.client("set_env_stats", stats_str, async=True) for worker in self.workers]
+
+
+class RolloutPool(object):
+    """Long-lived set of rollout worker processes.
+
+    Starting a worker means pickling env and policy, starting Python and building the TF graph,
+    so the same pool is meant to be reused across training iterations and evaluations: policy
+    weights are swapped in with `set_state`.
+    """
+
+    def __init__(self, env, policy, max_traj_len, mode, n_workers, segment_capacity=None):
+        self.max_traj_len = max_traj_len
+        self.mode = mode
+        sidx = np.random.randint(cpu_count())
+        self.workers = [
+            RolloutProxy(env, policy, max_traj_len, mode, i, sidx,
+                         segment_capacity=segment_capacity) for i in range(n_workers)
+        ]
+
+    @property
+    def n_workers(self):
+        return len(self.workers)
+
+    def set_state(self, state):
+        """Policy state, or list of per-agent policy states in concurrent mode"""
+        state_str = _dumps(state)
+        [worker.client("set_state", state_str, async=True) for worker in self.workers]
+
+    def sample_trajs(self, n_trajs, seed_idx=0, max_traj_len=None):
+        """Samples `n_trajs` rollouts (lists of per-agent trajectories unless centralized) with
+        consecutive seeds starting at `seed_idx`, of at most `max_traj_len` steps (by default the
+        pool's).
+        """
+        seed2traj = {}
+        worker2job = {}
+
+        def assign_job_to(i_worker, seed):
+            worker2job[i_worker] = (seed, self.workers[i_worker].client("sample", seed,
+                                                                        max_traj_len, async=True))
+            return seed + 1
+
+        next_seed = seed_idx
+        for i_worker in range(min(self.n_workers, n_trajs)):
+            next_seed = assign_job_to(i_worker, next_seed)
+
+        while len(seed2traj) < n_trajs:
+            # Block until some worker is done and hand it its next job right away
+            ready = gevent.wait([future for _, future in worker2job.values()], count=1)
+            for i_worker, (seed, future) in list(worker2job.items()):
+                if future not in ready:
+                    continue
+                seed2traj[seed] = _loads(future.get())
+                del worker2job[i_worker]
+                if next_seed < seed_idx + n_trajs:
+                    next_seed = assign_job_to(i_worker, next_seed)
+
+        return [seed2traj[seed] for seed in sorted(seed2traj)]
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+
+
 class RolloutProxy(object):
 
-    def __init__(self, env, policy, max_traj_len, mode, idx, sidx):
+    def __init__(self, env, policy, max_traj_len, mode, idx, sidx, segment_capacity=None):
+        pid = os.getpid()
+        addr = "ipc:///tmp/{}_{}.ipc".format(pid, idx)
+        # Trajectory segment files, in shared memory where available
+        shmdir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.segment_prefix = os.path.join(shmdir, 'rltools_{}_{}'.format(pid, idx))
+
         self.f = tempfile.NamedTemporaryFile()
-        args = (env, policy, max_traj_len, mode)
+        args = (env, policy, max_traj_len, mode, self.segment_prefix,
+                segment_capacity or 16 * max_traj_len)
         self.f.write(_dumps(args))
         self.f.flush()
 
-        pid = os.getpid()
-        addr = "ipc:///tmp/{}_{}.ipc".format(pid, idx)
         oenv = os.environ.copy()
         oenv["CUDA_VISIBLE_DEVICES"] = ""
         oenv["OMP_NUM_THREADS"] = "1"
@@ -190,15 +265,88 @@ class RolloutProxy(object):
         self.client = zerorpc.Client(heartbeat=60, timeout=1000)
         self.client.connect(addr)
 
+    def close(self):
+        if self.popen.poll() is None:
+            self.popen.terminate()
+        if not self.f.closed:
+            self.f.close()
+        for fname in glob.glob(self.segment_prefix + '_*'):
+            os.remove(fname)
+
     def __del__(self):
-        self.popen.terminate()
-        self.f.close()
+        self.close()
+
+
+class TrajSegment(object):
+    """Append-only, file-backed storage for the trajectories sampled by one worker.
+
+    Each trajectory field is a memory-mapped array under `prefix`, so the sampler process can map
+    the same files and read the trajectories without them being pickled. The arrays grow (by
+    doubling) if `capacity` rows are not enough.
+    """
+    FIELDS = ('obs_T_Do', 'adist_T_Pa', 'a_T_Da', 'r_T')
+
+    def __init__(self, prefix, capacity):
+        self.prefix = prefix
+        self.capacity = capacity
+        self.arrays = {}
+
+    def write(self, offset, traj):
+        end = offset + len(traj)
+        if not self.arrays:
+            self._resize(traj, max(end, self.capacity))
+        elif end > self.capacity:
+            self._resize(traj, max(end, 2 * self.capacity))
+        for field in self.FIELDS:
+            self.arrays[field][offset:end] = getattr(traj, field)
+        return end
+
+    def _resize(self, traj, capacity):
+        for field in self.FIELDS:
+            eg = getattr(traj, field)
+            path = '{}_{}'.format(self.prefix, field)
+            newarr = np.memmap(path + '.tmp', dtype=eg.dtype, mode='w+',
+                               shape=(capacity,) + eg.shape[1:])
+            if field in self.arrays:
+                newarr[:self.capacity] = self.arrays[field]
+            os.rename(path + '.tmp', path)
+            self.arrays[field] = newarr
+        self.capacity = capacity
+
+    @property
+    def spec(self):
+        return {
+            field: ('{}_{}'.format(self.prefix, field), arr.dtype.str, arr.shape)
+            for field, arr in self.arrays.items()
+        }
+
+
+def _open_segment(spec):
+    return {
+        field: np.memmap(path, dtype=np.dtype(dtype), mode='r', shape=shape)
+        for field, (path, dtype, shape) in spec.items()
+    }
+
+
+def _gather_trajbatch(segments, slices, infos):
+    """Copies the (worker, segment, offset, length) slices of the worker segments into one
+    batch
+    """
+    stacked = [
+        np.concatenate([segments[i_worker][i_segment][field][offset:offset + length]
+                        for i_worker, i_segment, offset, length in slices])
+        for field in TrajSegment.FIELDS
+    ]
+    return TrajBatch.FromStacked(*stacked, lengths=[sl[3] for sl in slices], infos=infos)
 
 
 class RolloutServer(object):
 
-    def __init__(self, sess, env, policy, max_traj_len, action_space, mode='centralized'):
+    def __init__(self, sess, env, policy, max_traj_len, action_space, mode='centralized',
+                 segments=None):
         self.sess = sess
+        # One trajectory segment per agent in concurrent mode, a single one otherwise
+        self.segments = segments
         self.env = env
         self.policy = policy
         self.max_traj_len = max_traj_len
@@ -211,15 +359,39 @@ class RolloutServer(object):
         elif self.mode == 'concurrent':
             self.rollout_fn = concrollout
 
-    def sample(self, seed):
+    def _sample(self, seed, max_traj_len=None):
         self.env.seed(seed)
         np.random.seed(seed)
         tf.set_random_seed(seed)
         random.seed(seed)
 
-        traj = self.rollout_fn(self.env, self.policy, self.max_traj_len, self.action_space)
+        return self.rollout_fn(self.env, self.policy, max_traj_len or self.max_traj_len,
+                               self.action_space)
 
-        return _dumps(traj)
+    def sample(self, seed, max_traj_len=None):
+        return _dumps(self._sample(seed, max_traj_len))
+
+    def sample_to_segment(self, seed, offsets):
+        """Writes the sampled trajectories to the segments, each starting at its row in
+        `offsets`, and only returns where they are.
+        """
+        trajs = self._sample(seed)
+        if self.mode == 'centralized':
+            trajs = [trajs]
+        ends = list(offsets)
+        segment_ids, traj_offsets, lengths, infos = [], [], [], []
+        for tid, traj in enumerate(trajs):
+            i_segment = tid if self.mode == 'concurrent' else 0
+            segment_ids.append(i_segment)
+            traj_offsets.append(ends[i_segment])
+            lengths.append(len(traj))
+            infos.append(traj.info_D)
+            ends[i_segment] = self.segments[i_segment].write(ends[i_segment], traj)
+        return _dumps(dict(segments=segment_ids, offsets=traj_offsets, lengths=lengths,
+                           info=infos, ends=ends))
+
+    def segment_specs(self):
+        return _dumps([segment.spec for segment in self.segments])
 
     def set_state(self, state_str):
         if self.mode == 'concurrent':
@@ -228,6 +400,13 @@ class RolloutServer(object):
         else:
             self.policy.set_state(_loads(state_str))
 
+    def get_env_stats(self):
+        statsenv = _find_stats_env(self.env)
+        return _dumps(statsenv.get_stats() if statsenv is not None else None)
+
+    def set_env_stats(self, stats_str):
+        _find_stats_env(self.env).set_stats(_loads(stats_str))
+
 
 def _start_server():
     fname = sys.argv[1]
@@ -238,14 +417,20 @@ def _start_server():
     tfconfig = tf.ConfigProto(inter_op_parallelism_threads=1, intra_op_parallelism_threads=1)
 
     with tf.Session(config=tfconfig) as sess:
-        env, policy, max_traj_len, mode = _loads(s)
+        env, policy, max_traj_len, mode, segment_prefix, segment_capacity = _loads(s)
         sess.run(tf.initialize_all_variables())
         if isinstance(policy, list):
             action_space = policy[0].action_space
         else:
             action_space = policy.action_space
+        if mode == 'concurrent':
+            segments = [TrajSegment('{}_{}'.format(segment_prefix, agid), segment_capacity)
+                        for agid in range(len(policy))]
+        else:
+            segments = [TrajSegment(segment_prefix, segment_capacity)]
         server = zerorpc.Server(
-            RolloutServer(sess, env, policy, max_traj_len, action_space, mode), heartbeat=60)
+            RolloutServer(sess, env, policy, max_traj_len, action_space, mode, segments),
+            heartbeat=60)
         server.bind(addr)
         server.run()
 
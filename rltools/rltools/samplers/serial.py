@@ -2,8 +2,10 @@ import copy
 import random
 
 import numpy as np
+from six.moves import cPickle
 
-from rltools.samplers import Sampler, centrollout, decrollout, concrollout
+from rltools.samplers import (Sampler, centrollout, decrollout, concrollout, vecrollout,
+                              _find_stats_env)
 from rltools.trajutil import TrajBatch, Trajectory
 
 
@@ -130,6 +132,67 @@ class ConcSampler(Sampler):
             [(info[0], np.mean(info[1]), float) for info in trajbatches[0].info])
 
 
+class VectorizedSampler(Sampler):
+    """
+    Steps `n_envs` copies of the env in lockstep and samples the actions of all of them with one
+    policy call per timestep
+    """
+    mode = None
+
+    def __init__(self, algo, n_timesteps, max_traj_len, timestep_rate, n_timesteps_min,
+                 n_timesteps_max, adaptive=False, enable_rewnorm=True, n_envs=8):
+        super(VectorizedSampler, self).__init__(algo, n_timesteps, max_traj_len, timestep_rate,
+                                                n_timesteps_min, n_timesteps_max, adaptive,
+                                                enable_rewnorm)
+        self.n_envs = n_envs
+        env_str = cPickle.dumps(self.algo.env, protocol=-1)
+        self.envs = [self.algo.env] + [cPickle.loads(env_str) for _ in range(n_envs - 1)]
+
+    def sample(self, sess, itr):
+        if self.adaptive and itr > 0 and self.n_timesteps < self.n_timesteps_max:
+            if itr % self.timestep_rate == 0:
+                self.n_timesteps *= 2
+
+        trajs = vecrollout(self.envs, self.algo.policy, self.max_traj_len,
+                           self.algo.policy.action_space, self.n_timesteps, mode=self.mode)
+        self.sync_env_stats()
+
+        trajbatch = TrajBatch.FromTrajs(trajs)
+        self.n_episodes += len(trajbatch)
+        return (trajbatch,
+                [('ret', trajbatch.r.padded(fill=0.).sum(axis=1).mean(), float
+                 ),  # average return for batch of traj
+                 ('batch', len(trajbatch), int),  # batch size
+                 ('n_episodes', self.n_episodes, int),  # total number of episodes
+                 ('avglen', int(np.mean([len(traj) for traj in trajbatch])), int
+                 ),  # average traj length
+                 ('maxlen', int(np.max([len(traj) for traj in trajbatch])), int),  # max traj length
+                 ('minlen', int(np.min([len(traj) for traj in trajbatch])), int),  # min traj length
+                 ('ravg', trajbatch.r.stacked.mean(), int
+                 )  # avg reward encountered per time step (probably not that useful)
+                ] + [(info[0], np.mean(info[1]), float) for info in trajbatch.info])
+
+
+    def sync_env_stats(self):
+        """Merges the running env statistics (e.g. of a StandardizedEnv) of all env copies and
+        hands the merged statistics back to all of them.
+        """
+        statsenvs = [_find_stats_env(env) for env in self.envs]
+        if statsenvs[0] is None:
+            return
+        merged = statsenvs[0].merge_stats([statsenv.get_stats() for statsenv in statsenvs])
+        for statsenv in statsenvs:
+            statsenv.set_stats(merged)
+
+
+class VectorizedCentSampler(VectorizedSampler):
+    mode = 'centralized'
+
+
+class VectorizedDecSampler(VectorizedSampler):
+    mode = 'decentralized'
+
+
 class ImportanceWeightedSampler(SimpleSampler):
     """
     Alternate between sampling iterations using simple sampler and importance sampling iterations
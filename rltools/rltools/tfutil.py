@@ -64,6 +64,14 @@ def fixedgradients(loss, params):
     return grads
 
 
+def flathvp(flatgrad_P, params, v_P):
+    """
+    Exact Hessian-vector product of the loss whose flattened gradient is `flatgrad_P`, computed as
+    the gradient of flatgrad_P . v_P (Pearlmutter's trick) and flattened the same way.
+    """
+    return flatcat(fixedgradients(tf.reduce_sum(flatgrad_P * v_P), params))
+
+
 def unflatten_into_tensors(flatparams_P, output_shapes, name=None):
     """
     Unflattens a vector produced by flatcat into a list of tensors of the specified shapes.
@@ -100,6 +108,39 @@ def subsample_feed(feed, frac):
     return tuple(a[subsamp_inds, ...] for a in feed)
 
 
+class FeedStage(object):
+    """
+    Placeholders that read the arrays last staged into the graph with `stage` when they are not
+    fed. Functions built on them can then be called with None for those inputs and reuse one copy
+    of a large batch in the TF runtime, instead of copying it on every call.
+
+    The staging variables are kept out of the variable collections, so they are neither
+    initialized with the model nor part of its params; staging assigns (and so initializes) them.
+    """
+
+    def __init__(self):
+        self.placeholders = []
+        self._inputs = []
+        self._assigns = []
+
+    def placeholder(self, dtype, shape, name):
+        init_shape = [0 if dim is None else dim for dim in shape]
+        var = tf.Variable(tf.zeros(init_shape, dtype=dtype), trainable=False, collections=[],
+                          validate_shape=False, name=name + '_staged')
+        input_ = tf.placeholder(dtype, shape, name=name + '_stage_input')
+        ph = tf.placeholder_with_default(var, shape, name=name)
+        self.placeholders.append(ph)
+        self._inputs.append(input_)
+        self._assigns.append(tf.assign(var, input_, validate_shape=False))
+        return ph
+
+    def stage(self, values, sess=None):
+        """Copies `values`, one per placeholder in order of creation, into the graph"""
+        assert len(values) == len(self._inputs)
+        sess = sess or tf.get_default_session()
+        sess.run(self._assigns, feed_dict=dict(util.safezip(self._inputs, values)))
+
+
 def function(inputs, outputs, updates=None):
     if isinstance(outputs, list):
         return TFFunction(inputs, outputs, updates)
@@ -119,8 +160,10 @@ class TFFunction(object):
         self._updates = [] if updates is None else updates
 
     def __call__(self, *inputs_, **kwargs):
+        """None inputs are not fed, e.g. to use the value staged for them (see FeedStage)"""
         assert len(inputs_) == len(self._inputs)
-        feed_dict = dict(zip(self._inputs, inputs_))
+        feed_dict = {input_: value for input_, value in zip(self._inputs, inputs_)
+                     if value is not None}
         sess = kwargs.pop('sess', tf.get_default_session())
         results = sess.run(self._outputs + self._updates, feed_dict=feed_dict)
         if any(result is not None and np.isnan(result).any() for result in results):
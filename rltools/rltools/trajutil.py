@@ -1,6 +1,7 @@
 import copy
 import random
 
+import h5py
 import numpy as np
 
 from rltools import util
@@ -27,13 +28,90 @@ class Trajectory(object):
         grp.create_dataset('adist_T_Pa', data=self.adist_T_Pa, **kwargs)
         grp.create_dataset('a_T_Da', data=self.a_T_Da, **kwargs)
         grp.create_dataset('r_T', data=self.r_T, **kwargs)
+        if self.info_D:
+            _save_info_h5(grp.require_group('info_D'), self.info_D, **kwargs)
 
     @classmethod
     def LoadH5(cls, grp):
         """
         """
         obs_T_Do = grp['obs_T_Do'][...]
-        return cls(obs_T_Do, grp['adist_T_Pa'][...], grp['a_T_Da'][...], grp['r_T'][...])
+        info_D = _load_info_h5(grp['info_D']) if 'info_D' in grp else {}
+        return cls(obs_T_Do, grp['adist_T_Pa'][...], grp['a_T_Da'][...], grp['r_T'][...], info_D)
+
+
+def _save_info_h5(grp, info_D, **kwargs):
+    for k, v in info_D.items():
+        if isinstance(v, dict):
+            _save_info_h5(grp.require_group(k), v, **kwargs)
+        else:
+            grp.create_dataset(k, data=v, **kwargs)
+
+
+def _load_info_h5(grp, sl=Ellipsis):
+    return {
+        k: _load_info_h5(v, sl) if isinstance(v, h5py.Group) else v[sl]
+        for k, v in grp.items()
+    }
+
+
+def _info_len(info_D):
+    """Number of (info-carrying) steps in a stacked info dict"""
+    if not info_D:
+        return 0
+    v = next(iter(info_D.values()))
+    return _info_len(v) if isinstance(v, dict) else len(v)
+
+
+class TrajectoryBuilder(object):
+    """
+    Accumulates the steps of one episode of `n_agents` agents into preallocated
+    (n_agents, max_traj_len, ...) buffers. The buffers are allocated on the first step, from the
+    shapes and dtypes of what the policy returns, and handed over to the Trajectory objects returned
+    by `finish`, which are trimmed views into them.
+    """
+
+    def __init__(self, max_traj_len, n_agents=1):
+        self.max_traj_len = max_traj_len
+        self.n_agents = n_agents
+        self.reset()
+
+    def reset(self):
+        self._t = 0
+        self._bufs = None
+        self._infos = []
+
+    def __len__(self):
+        return self._t
+
+    def _alloc(self, *step_arrays):
+        T, N = self.max_traj_len, self.n_agents
+        self._bufs = [
+            np.empty((N, T) + np.shape(x)[1:], dtype=np.asarray(x).dtype) for x in step_arrays
+        ]
+
+    def add(self, obs_N_Do, a_N_Da, adist_N_Pa, r_N, info=None):
+        """Records one step: the observations the agents acted on, their actions and action
+        distributions, and the rewards they got for them.
+        """
+        assert self._t < self.max_traj_len
+        r_N = np.asarray(r_N, dtype=float).reshape(self.n_agents)
+        if self._bufs is None:
+            self._alloc(obs_N_Do, adist_N_Pa, a_N_Da, r_N)
+        for buf, x in zip(self._bufs, (obs_N_Do, adist_N_Pa, a_N_Da, r_N)):
+            buf[:, self._t] = x
+        if info:
+            self._infos.append(info)
+        self._t += 1
+
+    def finish(self):
+        """Returns one Trajectory per agent and starts a new episode"""
+        assert self._t > 0
+        info_D = util.stack_dict_list(self._infos)
+        obs, adist, a, r = [buf[:, :self._t] for buf in self._bufs]
+        trajs = [Trajectory(obs[i], adist[i], a[i], r[i], info_D) for i in range(self.n_agents)]
+        self.reset()
+        return trajs
 
 
 def raggedstack(arrays, fill=0., axis=0, raggedaxis=1):
@@ -61,23 +139,29 @@ def raggedstack(arrays, fill=0., axis=0, raggedaxis=1):
 
 
 class RaggedArray(object):
+    """
+    Sequences of different lengths stored back to back in a single `stacked` array, the i-th one
+    spanning `stacked[boundaries[i]:boundaries[i + 1]]`. Per-sequence arrays are views into
+    `stacked`. The padded and mask forms are built on first use and cached (read-only); call
+    `invalidate` after writing into `stacked`.
+    """
 
     def __init__(self, arrays, lengths=None):
         if lengths is None:
             # Without provided lengths, `arrays` is interpreted as a list of arrays
             # and self.lengths is set to the list of lengths for those arrays
-            self.arrays = arrays
-            self.stacked = np.concatenate(arrays, axis=0)
-            self.lengths = np.array([len(a) for a in arrays])
-        else:
-            # With provided lengths, `arrays` is interpreted as concatenated data
-            # and self.lengths is set to the provided lengths.
-            self.arrays = np.split(arrays, np.cumsum(lengths)[:-1])
-            self.stacked = arrays
-            self.lengths = np.asarray(lengths, dtype=int)
-            assert all(len(a) == l for a, l in util.safezip(self.arrays, self.lengths))
-            self.boundaries = np.concatenate([[0], np.cumsum(self.lengths)])
-            assert self.boundaries[-1] == len(self.stacked)
+            lengths = [len(a) for a in arrays]
+            arrays = np.concatenate(arrays, axis=0)
+        # With provided lengths, `arrays` is interpreted as concatenated data and is not copied
+        self.stacked = arrays
+        self.lengths = np.asarray(lengths, dtype=int)
+        self.boundaries = np.concatenate([[0], np.cumsum(self.lengths)])
+        assert self.boundaries[-1] == len(self.stacked)
+        self._arrays = None
+        self.invalidate()
+
+    def invalidate(self):
+        self._padded = {}
 
     def __len__(self):
         return len(self.lengths)
@@ -85,8 +169,35 @@ class RaggedArray(object):
     def __getitem__(self, idx):
         return self.stacked[self.boundaries[idx]:self.boundaries[idx + 1], ...]
 
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = [self[i] for i in range(len(self))]
+        return self._arrays
+
+    def _padded_index(self):
+        """Row and column of every stacked element in the padded form"""
+        rows = np.repeat(np.arange(len(self)), self.lengths)
+        return rows, np.arange(len(self.stacked)) - self.boundaries[rows]
+
     def padded(self, fill=0.):
-        return raggedstack(self.arrays, fill=fill, axis=0, raggedaxis=1)
+        key = repr(float(fill))  # also matches nan fills
+        if key not in self._padded:
+            out = np.full((len(self), self.lengths.max()) + self.stacked.shape[1:], fill,
+                          dtype=self.stacked.dtype)
+            out[self._padded_index()] = self.stacked
+            out.flags.writeable = False
+            self._padded[key] = out
+        return self._padded[key]
+
+    def mask(self):
+        """1. at the valid entries of the padded form, 0. past the end of each sequence"""
+        if 'mask' not in self._padded:
+            mask = np.zeros((len(self), self.lengths.max()))
+            mask[self._padded_index()] = 1.
+            mask.flags.writeable = False
+            self._padded['mask'] = mask
+        return self._padded['mask']
 
 
 class TrajBatch(object):
@@ -96,16 +207,43 @@ class TrajBatch(object):
 
     @classmethod
     def FromTrajs(cls, trajs):
+        """Copies the trajectories into one preallocated buffer per field; the trajectories of the
+        batch are views into them.
+        """
         assert all(isinstance(traj, Trajectory) for traj in trajs)
-        obs = RaggedArray([t.obs_T_Do for t in trajs])
-        adist = RaggedArray([t.adist_T_Pa for t in trajs])
-        a = RaggedArray([t.a_T_Da for t in trajs])
-        r = RaggedArray([t.r_T for t in trajs])
-        time = RaggedArray([np.arange(len(t), dtype=float) for t in trajs])
+        lengths = np.array([len(t) for t in trajs])
+        fields = [[getattr(t, f) for t in trajs]
+                  for f in ('obs_T_Do', 'adist_T_Pa', 'a_T_Da', 'r_T')]
+        bufs = [
+            np.empty((lengths.sum(),) + arrs[0].shape[1:], dtype=np.result_type(*arrs))
+            for arrs in fields
+        ]
+        pos = 0
+        for i, l in enumerate(lengths):
+            for buf, arrs in zip(bufs, fields):
+                buf[pos:pos + l] = arrs[i]
+            pos += l
+        return cls.FromStacked(*bufs, lengths=lengths, infos=[t.info_D for t in trajs])
+
+    @classmethod
+    def FromStacked(cls, obs, adist, a, r, lengths, infos):
+        """Builds a batch from already concatenated trajectory data; per-trajectory arrays are
+        views into the stacked ones.
+        """
+        obs = RaggedArray(obs, lengths=lengths)
+        adist = RaggedArray(adist, lengths=lengths)
+        a = RaggedArray(a, lengths=lengths)
+        r = RaggedArray(r, lengths=lengths)
+        trajs = [
+            Trajectory(*args)
+            for args in util.safezip(obs.arrays, adist.arrays, a.arrays, r.arrays, infos)
+        ]
+        _, t_N = r._padded_index()
+        time = RaggedArray(t_N.astype(float), lengths=lengths)
         info = {}
-        if trajs[0].info_D:
+        if infos[0]:
             # FIXME: takes sum of info vars (useful for pursuit)
-            info = [(k, [np.sum(t.info_D[k]) for t in trajs]) for k in trajs[0].info_D.keys()]
+            info = [(k, [np.sum(info_D.get(k, 0.)) for info_D in infos]) for k in infos[0].keys()]
         return cls(trajs, obs, adist, a, r, time, info)
 
     def with_replaced_reward(self, new_r):
@@ -135,3 +273,121 @@ class TrajBatch(object):
     @classmethod
     def LoadH5(cls, dset):
         return cls.FromTrajs([Trajectory.LoadH5(v) for k, v in dset.iteritems()])
+
+
+class TrajStore(object):
+    """
+    Append-only HDF5 trajectory store.
+
+    The steps of all trajectories are concatenated into flat, chunked and compressed datasets, one
+    per Trajectory field plus one per info key under `info_D/`. `offsets` (and `info_offsets` for
+    the info rows, which are only recorded on steps that had an info dict) index where each
+    trajectory starts. Appends only touch the end of the datasets and the index is written last,
+    so an interrupted append is ignored and overwritten on reopening. Reads fetch only the requested
+    trajectories.
+    """
+    FIELDS = (('obs_T_Do', 'obs'), ('adist_T_Pa', 'adist'), ('a_T_Da', 'a'), ('r_T', 'r'))
+
+    def __init__(self, filename, mode='a', chunk_bytes=2**20, compression='gzip'):
+        self.f = h5py.File(filename, mode)
+        self.chunk_bytes = chunk_bytes
+        self.compression = compression
+        if 'offsets' in self.f:
+            self._offsets = self.f['offsets'][...]
+            self._info_offsets = self.f['info_offsets'][:len(self._offsets)]
+        else:
+            self._offsets = np.zeros(1, dtype=np.int64)
+            self._info_offsets = np.zeros(1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    @property
+    def n_steps(self):
+        return int(self._offsets[-1])
+
+    def _write(self, grp, name, start, data):
+        """Writes `data` at row `start` of the dataset, creating or growing it as needed"""
+        data = np.asarray(data)
+        if name not in grp:
+            row_bytes = max(1, data[0:1].nbytes)
+            chunk_rows = max(1, min(self.chunk_bytes // row_bytes, 2**16))
+            grp.create_dataset(name, shape=(0,) + data.shape[1:],
+                               maxshape=(None,) + data.shape[1:], dtype=data.dtype,
+                               chunks=(chunk_rows,) + data.shape[1:],
+                               compression=self.compression)
+        dset = grp[name]
+        dset.resize(start + len(data), axis=0)
+        dset[start:] = data
+
+    def _write_info(self, grp, start, infos):
+        for k, v in infos[0].items():
+            if isinstance(v, dict):
+                self._write_info(grp.require_group(k), start, [info_D[k] for info_D in infos])
+            else:
+                self._write(grp, k, start, np.concatenate([info_D[k] for info_D in infos]))
+
+    def append(self, trajs):
+        """Appends a TrajBatch or a list of Trajectory objects"""
+        if not isinstance(trajs, TrajBatch):
+            trajs = TrajBatch.FromTrajs(trajs)
+        if len(trajs) == 0:
+            return
+        for name, attr in self.FIELDS:
+            self._write(self.f, name, self.n_steps, getattr(trajs, attr).stacked)
+
+        infos = [traj.info_D for traj in trajs]
+        info_lengths = [_info_len(info_D) for info_D in infos]
+        if sum(info_lengths) > 0:
+            self._write_info(
+                self.f.require_group('info_D'), int(self._info_offsets[-1]),
+                [info_D for info_D, l in zip(infos, info_lengths) if l > 0])
+
+        # Index last, so that a partial append is never visible
+        n_written = len(self._offsets) if 'offsets' in self.f else 0
+        self._offsets = np.concatenate(
+            [self._offsets, self._offsets[-1] + np.cumsum(trajs.r.lengths)])
+        self._info_offsets = np.concatenate(
+            [self._info_offsets, self._info_offsets[-1] + np.cumsum(info_lengths)])
+        self._write(self.f, 'info_offsets', n_written, self._info_offsets[n_written:])
+        self._write(self.f, 'offsets', n_written, self._offsets[n_written:])
+
+    def _read_trajs(self, indices):
+        lengths = np.diff(self._offsets)[indices]
+        if len(indices) == len(self) and np.all(np.diff(indices) == 1):
+            fields = [self.f[name][:self.n_steps] for name, _ in self.FIELDS]
+        else:
+            fields = [
+                np.concatenate([self.f[name][self._offsets[i]:self._offsets[i + 1]]
+                                for i in indices]) for name, _ in self.FIELDS
+            ]
+        infos = [
+            _load_info_h5(self.f['info_D'], slice(self._info_offsets[i], self._info_offsets[i + 1]))
+            if self._info_offsets[i + 1] > self._info_offsets[i] else {} for i in indices
+        ]
+        return fields, lengths, infos
+
+    def load(self, indices=None):
+        """Reads the given trajectories (all of them by default) into a TrajBatch"""
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices, dtype=int)
+        fields, lengths, infos = self._read_trajs(indices)
+        return TrajBatch.FromStacked(*fields, lengths=lengths, infos=infos)
+
+    def sample(self, n_trajs, rng=np.random):
+        """Reads a batch of `n_trajs` trajectories drawn uniformly without replacement"""
+        return self.load(np.sort(rng.choice(len(self), size=n_trajs, replace=False)))
+
+    def __getitem__(self, idx):
+        return self.load([idx])[0]
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -6,6 +6,7 @@ import timeit
 
 import h5py
 import numpy as np
+import scipy.signal
 from colorama import Fore, Style
 
 
@@ -80,6 +81,25 @@ def discount(r_N_T_D, gamma):
     return q_N_T_D
 
 
+def discount_stacked(x_N, lengths, gamma):
+    '''
+    Like `discount`, for sequences of the given lengths concatenated along the first axis, without
+    padding them to a common length.
+    y_N[t] == x_N[t] + gamma*y_N[t+1] + ... up to the end of the sequence containing t
+    '''
+    lengths = np.asarray(lengths, dtype=int)
+    N = len(x_N)
+    assert lengths.sum() == N
+    # One reverse-time first order IIR filter over all sequences, which carries each sequence's
+    # discounted sum into the ones before it...
+    z_N = scipy.signal.lfilter([1.], [1., -gamma], x_N[::-1], axis=0)[::-1]
+    # ...so subtract, at every step, the discounted value z takes at the end of its sequence
+    end_N = np.repeat(np.cumsum(lengths), lengths)
+    carry_N = np.concatenate([z_N, np.zeros((1,) + x_N.shape[1:])])[end_N]
+    decay_N = np.power(float(gamma), end_N - np.arange(N)).reshape((N,) + (1,) * (x_N.ndim - 1))
+    return z_N - decay_N * carry_N
+
+
 def standardized(a):
     out = a.copy()
     out -= a.mean()
@@ -138,67 +158,30 @@ def stack_dict_list(dict_list):
     return ret
 
 
-def evaluate_policy(env, policy, n_trajs, deterministic, max_traj_len, mode, disc, n_workers=4):
+def evaluate_policy(env, policy, n_trajs, deterministic, max_traj_len, mode, disc, n_workers=4,
+                    pool=None):
+    """Evaluates the policy on `n_trajs` rollouts sampled by a `RolloutPool`.
+    Pass a `pool` that already runs this env and policy architecture to avoid starting new
+    worker processes; otherwise a temporary pool of `n_workers` workers is used.
+    """
     ok('Sampling {} trajs (max len {}) from policy in {}'.format(n_trajs, max_traj_len, env))
 
     # Sample
-    from rltools.samplers.parallel import RolloutProxy
-    from six.moves import cPickle
-    import time
-    from gevent import Timeout
+    from rltools.samplers.parallel import RolloutPool
     from rltools.trajutil import TrajBatch
-    proxies = [RolloutProxy(env, policy, max_traj_len, mode, i, 0) for i in range(n_workers)]
+    own_pool = pool is None
+    if own_pool:
+        pool = RolloutPool(env, policy, max_traj_len, mode, n_workers)
 
-    if mode == 'concurrent':
-        state_str = cPickle.dumps([p.get_state() for p in policy])
-    else:
-        state_str = cPickle.dumps(policy.get_state(), protocol=-1)
-    for proxy in proxies:
-        proxy.client("set_state", state_str, async=True)
-
-    seed_idx = 0
-    seed_idx2 = seed_idx
-    worker2job = {}
-
-    def assign_job_to(i_worker, seed):
-        worker2job[i_worker] = (seed, proxies[i_worker].client("sample", seed, async=True))
-        seed += 1
-        return seed
-
-    # Start jobs
-    for i_worker in range(n_workers):
-        seed_idx2 = assign_job_to(i_worker, seed_idx2)
-
-    trajs_so_far = 0
-    seed2traj = {}
-    while True:
-        for i_worker in range(n_workers):
-            try:
-                (seed_idx, future) = worker2job[i_worker]
-                traj_string = future.get(timeout=1e-3)  # XXX
-            except Timeout:
-                pass
-            else:
-                traj = cPickle.loads(traj_string)
-                seed2traj[seed_idx] = traj
-                trajs_so_far += 1
-                if trajs_so_far >= n_trajs:
-                    break
-                else:
-                    seed_idx2 = assign_job_to(i_worker, seed_idx2)
-        if trajs_so_far >= n_trajs:
-            break
-        time.sleep(0.01)
-
-    # Wait until all jobs finish
-    for seed_idx, future in worker2job.values():
-        seed2traj[seed_idx] = cPickle.loads(future.get())
-
-    trajs = []
-
-    for (seed, traj) in seed2traj.items():
-        trajs.append(traj)
-        trajs_so_far += 1
+    try:
+        if mode == 'concurrent':
+            pool.set_state([p.get_state() for p in policy])
+        else:
+            pool.set_state(policy.get_state())
+        trajs = pool.sample_trajs(n_trajs, max_traj_len=max_traj_len)
+    finally:
+        if own_pool:
+            pool.close()
 
     # Trajs
     if mode == 'centralized':
@@ -0,0 +1,46 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+from .context import rltools
+import numpy as np
+
+import rltools.util
+
+
+def padded(x_N, lengths):
+    """(n_sequences, max_len, ...) zero padded form of stacked sequences"""
+    out = np.zeros((len(lengths), max(lengths)) + x_N.shape[1:])
+    start = 0
+    for i, l in enumerate(lengths):
+        out[i, :l] = x_N[start:start + l]
+        start += l
+    return out
+
+
+def unpadded(x_N_T, lengths):
+    return np.concatenate([x_N_T[i, :l] for i, l in enumerate(lengths)])
+
+
+def test_discount_stacked():
+    rng = np.random.RandomState(0)
+    for gamma in [.5, .9, .99, 1.]:
+        lengths = rng.randint(1, 200, size=30)
+        x_N = rng.randn(lengths.sum()) + 1.
+        expected = unpadded(rltools.util.discount(padded(x_N, lengths), gamma), lengths)
+        assert np.allclose(rltools.util.discount_stacked(x_N, lengths, gamma), expected)
+
+
+def test_discount_stacked_multidim():
+    rng = np.random.RandomState(1)
+    lengths = [5, 1, 17, 3]
+    x_N_D = rng.randn(sum(lengths), 3)
+    expected = unpadded(rltools.util.discount(padded(x_N_D, lengths), .9), lengths)
+    assert np.allclose(rltools.util.discount_stacked(x_N_D, lengths, .9), expected)
+
+
+def test_discount_stacked_trivial():
+    x_N = np.arange(10.)
+    # Length-1 sequences are their own discounted sums
+    assert np.allclose(rltools.util.discount_stacked(x_N, [1] * 10, .99), x_N)
+    # and so is every step with gamma = 0
+    assert np.allclose(rltools.util.discount_stacked(x_N, [4, 6], 0.), x_N)
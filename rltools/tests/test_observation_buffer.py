@@ -0,0 +1,81 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+from .context import rltools
+import numpy as np
+from gym import spaces
+
+from madrl_environments import AbstractMAEnv, ObservationBuffer
+
+
+class CountingAgent(object):
+
+    def __init__(self, obs_dim):
+        self.observation_space = spaces.Box(low=-np.inf, high=np.inf, shape=(obs_dim,))
+
+
+class CountingEnv(AbstractMAEnv):
+    """Every agent observes the number of steps taken since reset, offset by its index"""
+
+    def __init__(self, n_agents, obs_dim):
+        self._agents = [CountingAgent(obs_dim) for _ in range(n_agents)]
+        self._obs_dim = obs_dim
+        self._t = 0
+
+    @property
+    def agents(self):
+        return self._agents
+
+    def _obs(self):
+        return [np.full(self._obs_dim, self._t + 100. * agid) for agid in range(len(self._agents))]
+
+    def reset(self):
+        self._t = 0
+        return self._obs()
+
+    def step(self, actions):
+        self._t += 1
+        return self._obs(), [0.] * len(self._agents), False, {}
+
+
+def expected_history(t, n_agents, obs_dim, buffer_size):
+    # Steps before the reset are filled with the first observation
+    steps = np.maximum(np.arange(t - buffer_size + 1, t + 1), 0)
+    agents = 100. * np.arange(n_agents)
+    return np.tile((agents[:, None] + steps[None, :])[:, None, :], (1, obs_dim, 1))
+
+
+def test_observation_buffer_wraparound():
+    n_agents, obs_dim, buffer_size = 2, 3, 4
+    env = ObservationBuffer(CountingEnv(n_agents, obs_dim), buffer_size)
+
+    obs = env.reset()
+    assert obs.shape == (n_agents, obs_dim, buffer_size)
+    assert np.array_equal(obs, expected_history(0, n_agents, obs_dim, buffer_size))
+    # Several times around the ring buffer
+    for t in range(1, 3 * buffer_size + 2):
+        obs, _, _, _ = env.step(None)
+        assert np.array_equal(obs, expected_history(t, n_agents, obs_dim, buffer_size))
+
+    # Starts over after a reset
+    assert np.array_equal(env.reset(), expected_history(0, n_agents, obs_dim, buffer_size))
+
+
+def test_observation_buffer_copies():
+    env = ObservationBuffer(CountingEnv(2, 3), 4)
+    obs0 = env.reset()
+    obs1, _, _, _ = env.step(None)
+    # Returned histories don't change with later steps
+    assert np.array_equal(obs0, expected_history(0, 2, 3, 4))
+    obs1[...] = -1.
+    obs2, _, _, _ = env.step(None)
+    assert np.array_equal(obs2, expected_history(2, 2, 3, 4))
+
+
+def test_observation_buffer_readonly_views():
+    env = ObservationBuffer(CountingEnv(2, 3), 4, readonly_views=True)
+    env.reset()
+    for t in range(1, 10):
+        obs, _, _, _ = env.step(None)
+        assert not obs.flags.writeable
+        assert np.array_equal(obs, expected_history(t, 2, 3, 4))
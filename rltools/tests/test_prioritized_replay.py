@@ -0,0 +1,65 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+from .context import rltools
+import numpy as np
+
+from rltools.replay import PrioritizedReplayBuffer
+
+
+def fill(buf, n):
+    for i in range(n):
+        obs = np.full((buf.n_agents, 2), float(i))
+        buf.add(obs, np.zeros((buf.n_agents, 1)), np.full(buf.n_agents, float(i)), obs, 0)
+
+
+def test_prioritized_replay_new_transitions_max_priority():
+    buf = PrioritizedReplayBuffer(8, 2, (2,), alpha=1.)
+    fill(buf, 2)
+    _, _, leaves = buf.sample(2)
+    buf.update_priorities(leaves, np.full(4, 5.))
+    fill(buf, 1)
+    # The new transition has the highest priority seen so far
+    assert np.isclose(buf._tree[2], 5. + buf.eps)
+
+
+def test_prioritized_replay_proportions_and_weights():
+    np.random.seed(0)
+    n_agents, n = 2, 10
+    buf = PrioritizedReplayBuffer(16, n_agents, (2,), alpha=.5, beta=1.)
+    fill(buf, n)
+    priorities = np.arange(1., n + 1)
+    buf.update_priorities(np.arange(n), np.repeat(priorities, n_agents))
+
+    counts = np.zeros(n)
+    for _ in range(200):
+        (obs, actions, rewards, succ_obs, done), weights, leaves = buf.sample(32)
+        assert len(weights) == len(rewards) == 32 * n_agents
+        # Agents of a transition are sampled together and share their weight
+        assert np.all(rewards[::n_agents] == rewards[1::n_agents])
+        assert np.all(weights[::n_agents] == weights[1::n_agents])
+        assert np.array_equal(rewards[::n_agents], leaves)
+        counts += np.bincount(leaves, minlength=n)
+
+        # Importance sampling weights (N * P(i))**-beta, normalized by their max
+        probs = priorities**.5 / np.sum(priorities**.5)
+        expected = (n * probs[leaves])**-1.
+        assert np.allclose(weights[::n_agents], expected / expected.max())
+
+    assert np.allclose(counts / counts.sum(), probs, atol=1e-2)
+
+
+def test_prioritized_replay_per_agent_priorities():
+    np.random.seed(1)
+    n_agents, n = 3, 4
+    buf = PrioritizedReplayBuffer(4, n_agents, (2,), alpha=1., shared_priorities=False)
+    fill(buf, n)
+    # Only the last agent of each transition is worth sampling, the others keep priority eps
+    td_errors = np.zeros((n, n_agents))
+    td_errors[:, -1] = 1.
+    buf.update_priorities(np.arange(n * n_agents), td_errors.ravel())
+
+    (obs, actions, rewards, succ_obs, done), weights, leaves = buf.sample(10)
+    assert len(rewards) == len(weights) == len(leaves) == 10 * n_agents
+    assert np.all(leaves % n_agents == n_agents - 1)
+    assert np.array_equal(rewards, leaves // n_agents)
@@ -0,0 +1,67 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+from .context import rltools
+import numpy as np
+import pytest
+
+from rltools.trajutil import RaggedArray
+
+
+def make_arrays(lengths, dim=2):
+    rng = np.random.RandomState(0)
+    return [rng.randn(l, dim) for l in lengths]
+
+
+def test_ragged_array_from_arrays():
+    arrays = make_arrays([3, 1, 5])
+    ra = RaggedArray(arrays)
+    assert len(ra) == 3
+    assert np.array_equal(ra.lengths, [3, 1, 5])
+    assert np.array_equal(ra.boundaries, [0, 3, 4, 9])
+    assert np.array_equal(ra.stacked, np.concatenate(arrays))
+    for a, b in zip(ra.arrays, arrays):
+        assert np.array_equal(a, b)
+
+
+def test_ragged_array_views():
+    stacked = np.arange(10.)
+    ra = RaggedArray(stacked, lengths=[4, 6])
+    # No copies of the stacked data
+    assert ra.stacked is stacked
+    assert np.shares_memory(ra[1], stacked)
+    assert np.array_equal(ra[1], [4., 5., 6., 7., 8., 9.])
+
+
+def test_ragged_array_padded_and_mask():
+    lengths = [3, 1, 5]
+    arrays = make_arrays(lengths)
+    ra = RaggedArray(arrays)
+
+    padded = ra.padded(fill=np.nan)
+    assert padded.shape == (3, 5, 2)
+    mask = ra.mask()
+    assert mask.shape == (3, 5)
+    for i, (a, l) in enumerate(zip(arrays, lengths)):
+        assert np.array_equal(padded[i, :l], a)
+        assert np.all(np.isnan(padded[i, l:]))
+        assert np.all(mask[i, :l] == 1.) and np.all(mask[i, l:] == 0.)
+    assert np.all(ra.padded(fill=0.)[np.isnan(padded)] == 0.)
+
+
+def test_ragged_array_cache():
+    ra = RaggedArray([np.arange(3.), np.arange(2.)])
+    padded = ra.padded(fill=0.)
+    # Cached per fill value, nan included, and read-only
+    assert ra.padded(fill=0.) is padded
+    assert ra.padded(fill=np.nan) is ra.padded(fill=np.nan)
+    assert ra.padded(fill=1.) is not padded
+    assert ra.mask() is ra.mask()
+    with pytest.raises(ValueError):
+        padded[0, 0] = 1.
+
+    # Writes into stacked show up after invalidate
+    ra.stacked[:] += 10.
+    assert np.array_equal(ra.padded(fill=0.), padded)
+    ra.invalidate()
+    assert np.array_equal(ra.padded(fill=0.), [[10., 11., 12.], [10., 11., 0.]])
@@ -0,0 +1,63 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+from .context import rltools
+import numpy as np
+
+from rltools.replay import ReplayBuffer
+
+
+def transition(i, n_agents, obs_dim):
+    """Transition whose fields all encode its number `i`"""
+    obs = np.full((n_agents, obs_dim), i) + np.arange(n_agents)[:, None]
+    return obs, np.full((n_agents, 1), i), np.full(n_agents, float(i)), obs + .5, i % 2
+
+
+def test_replay_buffer_ring():
+    capacity, n_agents, obs_dim = 5, 2, 3
+    buf = ReplayBuffer(capacity, n_agents, (obs_dim,))
+    for i in range(capacity + 3):
+        idx = buf.add(*transition(i, n_agents, obs_dim))
+        assert idx == i % capacity
+        assert len(buf) == min(i + 1, capacity)
+
+    # The oldest transitions were overwritten
+    obs, actions, rewards, succ_obs, done = buf.gather(np.arange(capacity))
+    assert sorted(set(rewards)) == [3., 4., 5., 6., 7.]
+
+
+def test_replay_buffer_gather():
+    capacity, n_agents, obs_dim = 10, 3, 2
+    buf = ReplayBuffer(capacity, n_agents, (obs_dim,))
+    for i in range(capacity):
+        buf.add(*transition(i, n_agents, obs_dim))
+
+    idx_B = np.array([4, 0, 7])
+    obs, actions, rewards, succ_obs, done = buf.gather(idx_B)
+    BN = len(idx_B) * n_agents
+    assert obs.shape == succ_obs.shape == (BN, obs_dim)
+    assert actions.shape == (BN, 1)
+    assert rewards.shape == done.shape == (BN,)
+    # Agent-minor rows
+    for row in range(BN):
+        i, agid = idx_B[row // n_agents], row % n_agents
+        exp_obs, exp_a, exp_r, exp_succ_obs, exp_done = transition(i, n_agents, obs_dim)
+        assert np.array_equal(obs[row], exp_obs[agid])
+        assert np.array_equal(actions[row], exp_a[agid])
+        assert rewards[row] == exp_r[agid]
+        assert np.array_equal(succ_obs[row], exp_succ_obs[agid])
+        assert done[row] == exp_done
+
+
+def test_replay_buffer_sample():
+    buf = ReplayBuffer(100, 2, (4,))
+    for i in range(30):
+        buf.add(*transition(i, 2, 4))
+    np.random.seed(0)
+    # Only filled slots are sampled
+    idx = buf.sample_indices(1000)
+    assert idx.min() >= 0 and idx.max() < 30
+    obs, actions, rewards, succ_obs, done = buf.sample(64)
+    assert obs.shape == (128, 4)
+    # Rows of each transition stay together
+    assert np.all(rewards[::2] == rewards[1::2])
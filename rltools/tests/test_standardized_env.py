@@ -0,0 +1,99 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+from .context import rltools
+import numpy as np
+from gym import spaces
+
+from madrl_environments import AbstractMAEnv, StandardizedEnv
+
+
+class RandomAgent(object):
+
+    def __init__(self, obs_dim):
+        self.observation_space = spaces.Box(low=-np.inf, high=np.inf, shape=(obs_dim,))
+
+
+class RandomEnv(AbstractMAEnv):
+
+    def __init__(self, n_agents, obs_dim, seed=0):
+        self._agents = [RandomAgent(obs_dim) for _ in range(n_agents)]
+        self._obs_dim = obs_dim
+        self._rng = np.random.RandomState(seed)
+
+    @property
+    def agents(self):
+        return self._agents
+
+    def _obs(self):
+        return [self._rng.randn(self._obs_dim) * (agid + 1) + agid
+                for agid in range(len(self._agents))]
+
+    def reset(self):
+        return self._obs()
+
+    def step(self, actions):
+        return self._obs(), list(self._rng.randn(len(self._agents))), False, {}
+
+
+def test_running_estimates():
+    n_agents, obs_dim, alpha = 3, 4, 0.01
+    env = StandardizedEnv(RandomEnv(n_agents, obs_dim), enable_obsnorm=True, enable_rewnorm=True,
+                          obs_alpha=alpha, rew_alpha=alpha)
+    unwrapped = RandomEnv(n_agents, obs_dim)
+
+    # Per-agent exponential moving estimates, one agent at a time
+    obs_mean, obs_var = np.zeros((n_agents, obs_dim)), np.ones((n_agents, obs_dim))
+    rew_mean, rew_var = np.zeros(n_agents), np.ones(n_agents)
+
+    def update(mean, var, x):
+        mean[...] = (1 - alpha) * mean + alpha * x
+        var[...] = (1 - alpha) * var + alpha * np.square(x - mean)
+
+    env.reset()
+    for agid, obs in enumerate(unwrapped.reset()):
+        update(obs_mean[agid], obs_var[agid], obs)
+    for _ in range(50):
+        stdobs, stdrew, _, _ = env.step(None)
+        obs, rew, _, _ = unwrapped.step(None)
+        for agid in range(n_agents):
+            update(obs_mean[agid], obs_var[agid], obs[agid])
+            update(rew_mean[agid:agid + 1], rew_var[agid:agid + 1], rew[agid])
+            assert np.allclose(stdobs[agid], (obs[agid] - obs_mean[agid]) /
+                               (np.sqrt(obs_var[agid]) + 1e-8))
+        assert np.allclose(stdrew, rew / (np.sqrt(rew_var) + 1e-8))
+
+    stats = env.get_stats()
+    assert np.allclose(stats['obs_mean'], obs_mean)
+    assert np.allclose(stats['obs_var'], obs_var)
+    assert np.allclose(stats['rew_mean'], rew_mean)
+    assert np.allclose(stats['rew_var'], rew_var)
+
+
+def test_merge_stats():
+    # Equally sized samples: the merged statistics are those of all samples together
+    rng = np.random.RandomState(0)
+    samples = [rng.randn(1000, 2, 5) * (i + 1) + i for i in range(3)]
+    rew_samples = [rng.randn(1000, 2) * (i + 1) - i for i in range(3)]
+    stats_list = [
+        dict(obs_mean=x.mean(axis=0), obs_var=x.var(axis=0), rew_mean=r.mean(axis=0),
+             rew_var=r.var(axis=0)) for x, r in zip(samples, rew_samples)
+    ]
+    merged = StandardizedEnv.merge_stats(stats_list)
+
+    allx = np.concatenate(samples)
+    allr = np.concatenate(rew_samples)
+    assert np.allclose(merged['obs_mean'], allx.mean(axis=0))
+    assert np.allclose(merged['obs_var'], allx.var(axis=0))
+    assert np.allclose(merged['rew_mean'], allr.mean(axis=0))
+    assert np.allclose(merged['rew_var'], allr.var(axis=0))
+
+
+def test_set_stats():
+    env = StandardizedEnv(RandomEnv(2, 3), enable_obsnorm=True)
+    other = StandardizedEnv(RandomEnv(2, 3, seed=1), enable_obsnorm=True)
+    for _ in range(10):
+        other.step(None)
+    env.set_stats(other.get_stats())
+    for k, v in other.get_stats().items():
+        assert np.array_equal(env.get_stats()[k], v)
@@ -0,0 +1,44 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+from .context import rltools
+import numpy as np
+
+from rltools.replay import SumTree
+
+
+def test_sum_tree_update():
+    # Not a power of two
+    tree = SumTree(6)
+    tree.update(np.arange(6), [1., 2., 3., 4., 5., 6.])
+    assert tree.total == 21.
+    tree.update([1, 4], [0., 10.])
+    assert tree.total == 24.
+    assert np.array_equal(tree[[0, 1, 4]], [1., 0., 10.])
+    # Single leaves too
+    tree.update(5, 1.)
+    assert tree.total == 19.
+
+
+def test_sum_tree_find():
+    tree = SumTree(5)
+    tree.update(np.arange(5), [1., 0., 2., 3., 0.])
+    # Prefix-sum intervals [0, 1), [1, 3), [3, 6); empty leaves are never found
+    values = [0., .5, .999, 1., 2.9, 3., 5.9]
+    assert np.array_equal(tree.find(values), [0, 0, 0, 2, 2, 3, 3])
+
+
+def test_sum_tree_sampling_proportions():
+    rng = np.random.RandomState(0)
+    capacity = 37
+    priorities = rng.rand(capacity)
+    priorities[[3, 20]] = 0.
+    tree = SumTree(capacity)
+    tree.update(np.arange(capacity), priorities)
+    assert np.isclose(tree.total, priorities.sum())
+
+    n = 200000
+    leaves = tree.find(rng.rand(n) * tree.total)
+    freqs = np.bincount(leaves, minlength=capacity) / float(n)
+    assert freqs[3] == freqs[20] == 0.
+    assert np.allclose(freqs, priorities / priorities.sum(), atol=5e-3)
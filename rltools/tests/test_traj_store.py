@@ -0,0 +1,90 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+from .context import rltools
+import numpy as np
+
+from rltools.trajutil import Trajectory, TrajBatch, TrajStore
+
+
+def make_trajs(n_trajs, seed, with_info=True):
+    rng = np.random.RandomState(seed)
+    trajs = []
+    for i in range(n_trajs):
+        T = rng.randint(1, 20)
+        # Every other trajectory has no info
+        info_D = {}
+        if with_info and i % 2 == 0:
+            info_D = {'x': rng.randn(T), 'sub': {'y': rng.randint(10, size=(T, 2))}}
+        trajs.append(Trajectory(rng.randn(T, 3).astype(np.float32), rng.randn(T, 2),
+                                rng.randint(2, size=(T, 1)), rng.randn(T), info_D))
+    return trajs
+
+
+def assert_same_trajs(trajs, expected):
+    assert len(trajs) == len(expected)
+    for traj, exp in zip(trajs, expected):
+        for field in ('obs_T_Do', 'adist_T_Pa', 'a_T_Da', 'r_T'):
+            assert np.array_equal(getattr(traj, field), getattr(exp, field))
+            assert getattr(traj, field).dtype == getattr(exp, field).dtype
+        assert_same_info(traj.info_D, exp.info_D)
+
+
+def assert_same_info(info_D, expected):
+    assert set(info_D.keys()) == set(expected.keys())
+    for k, v in expected.items():
+        if isinstance(v, dict):
+            assert_same_info(info_D[k], v)
+        else:
+            assert np.array_equal(info_D[k], v)
+
+
+def test_traj_store_roundtrip(tmpdir):
+    filename = str(tmpdir.join('trajs.h5'))
+    batch1, batch2 = make_trajs(5, seed=0), make_trajs(4, seed=1)
+
+    with TrajStore(filename) as store:
+        store.append(TrajBatch.FromTrajs(batch1))
+        store.append(batch2)
+        assert len(store) == 9
+        assert store.n_steps == sum(len(traj) for traj in batch1 + batch2)
+        assert_same_trajs(store.load().trajs, batch1 + batch2)
+
+    # Reopening appends after what is there
+    batch3 = make_trajs(3, seed=2)
+    with TrajStore(filename) as store:
+        assert len(store) == 9
+        store.append(batch3)
+
+    with TrajStore(filename, mode='r') as store:
+        all_trajs = batch1 + batch2 + batch3
+        assert_same_trajs(store.load().trajs, all_trajs)
+        assert_same_trajs(store.load([7, 2, 10]).trajs, [all_trajs[i] for i in (7, 2, 10)])
+        assert_same_trajs([store[4]], [all_trajs[4]])
+
+
+def test_traj_store_sample(tmpdir):
+    trajs = make_trajs(10, seed=3, with_info=False)
+    with TrajStore(str(tmpdir.join('trajs.h5'))) as store:
+        store.append(trajs)
+        sample = store.sample(4, rng=np.random.RandomState(0))
+        assert len(sample) == 4
+        # Drawn without replacement, so all distinct trajectories of the store
+        r0 = [traj.r_T[0] for traj in trajs]
+        picked = [r0.index(traj.r_T[0]) for traj in sample.trajs]
+        assert len(set(picked)) == 4
+        assert_same_trajs(sample.trajs, [trajs[i] for i in picked])
+
+
+def test_traj_store_ignores_unindexed_append(tmpdir):
+    filename = str(tmpdir.join('trajs.h5'))
+    trajs = make_trajs(3, seed=4)
+    with TrajStore(filename) as store:
+        store.append(trajs[:2])
+        # An append interrupted before the index was written
+        store._write(store.f, 'r', store.n_steps, trajs[2].r_T)
+
+    with TrajStore(filename) as store:
+        assert len(store) == 2
+        store.append(trajs[2:])
+        assert_same_trajs(store.load().trajs, trajs)
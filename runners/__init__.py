@@ -141,6 +141,7 @@ class RunnerParser(object):
 
         parser.add_argument('--sampler', type=str, default='simple')
         parser.add_argument('--sampler_workers', type=int, default=1)
+        parser.add_argument('--sampler_envs', type=int, default=8)
         parser.add_argument('--max_traj_len', type=int, default=500)
         parser.add_argument('--n_timesteps', type=int, default=12000)
 
@@ -155,6 +156,10 @@ class RunnerParser(object):
         parser.add_argument('--max_kl', type=float, default=0.01)
         parser.add_argument('--vf_max_kl', type=float, default=0.01)
         parser.add_argument('--vf_cg_damping', type=float, default=0.01)
+        parser.add_argument('--vf_fit_mode', type=str, default='trust_region')
+        parser.add_argument('--vf_learning_rate', type=float, default=1e-3)
+        parser.add_argument('--vf_max_epochs', type=int, default=10)
+        parser.add_argument('--vf_async_fit', action='store_true', default=False)
         parser.add_argument('--enable_obsnorm', action='store_true')
         parser.add_argument('--enable_rewnorm', action='store_true')
         parser.add_argument('--enable_vnorm', action='store_true')
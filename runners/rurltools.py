@@ -14,7 +14,8 @@ from rltools.baselines.zero import ZeroBaseline
 from rltools.policy.categorical import CategoricalMLPPolicy, CategoricalGRUPolicy
 from rltools.policy.gaussian import GaussianGRUPolicy, GaussianMLPPolicy
 from rltools.samplers.parallel import ParallelSampler
-from rltools.samplers.serial import DecSampler, SimpleSampler, ConcSampler
+from rltools.samplers.serial import (DecSampler, SimpleSampler, ConcSampler,
+                                     VectorizedCentSampler, VectorizedDecSampler)
 
 from runners import tonamedtuple
 
@@ -145,6 +146,9 @@ class RLToolsRunner(object):
                                 enable_obsnorm=args.enable_obsnorm, enable_vnorm=args.enable_vnorm,
                                 max_kl=args.vf_max_kl, damping=args.vf_cg_damping,
                                 time_scale=1. / args.max_traj_len,
+                                fit_mode=args.vf_fit_mode,
+                                learning_rate=args.vf_learning_rate,
+                                max_epochs=args.vf_max_epochs, async_fit=args.vf_async_fit,
                                 varscope_name='{}_baseline'.format(agid))
                     for agid in range(len(env.agents))
                 ]
@@ -154,7 +158,11 @@ class RLToolsRunner(object):
                                        enable_obsnorm=args.enable_obsnorm,
                                        enable_vnorm=args.enable_vnorm, max_kl=args.vf_max_kl,
                                        damping=args.vf_cg_damping,
-                                       time_scale=1. / args.max_traj_len, varscope_name='baseline')
+                                       time_scale=1. / args.max_traj_len,
+                                       fit_mode=args.vf_fit_mode,
+                                       learning_rate=args.vf_learning_rate,
+                                       max_epochs=args.vf_max_epochs,
+                                       async_fit=args.vf_async_fit, varscope_name='baseline')
 
         elif args.baseline_type == 'zero':
             if args.control == 'concurrent':
@@ -189,6 +197,18 @@ class RLToolsRunner(object):
                                 timestep_rate=args.timestep_rate, adaptive=args.adaptive_batch,
                                 enable_rewnorm=args.enable_rewnorm, n_workers=args.sampler_workers,
                                 mode=args.control, discard_extra=False)
+        elif args.sampler == 'vectorized':
+            if args.control == 'centralized':
+                sampler_cls = VectorizedCentSampler
+            elif args.control == 'decentralized':
+                sampler_cls = VectorizedDecSampler
+            else:
+                raise NotImplementedError()
+            sampler_args = dict(max_traj_len=args.max_traj_len, n_timesteps=args.n_timesteps,
+                                n_timesteps_min=args.n_timesteps_min,
+                                n_timesteps_max=args.n_timesteps_max,
+                                timestep_rate=args.timestep_rate, adaptive=args.adaptive_batch,
+                                enable_rewnorm=args.enable_rewnorm, n_envs=args.sampler_envs)
 
         else:
             raise NotImplementedError()
@@ -7,6 +7,7 @@ import numpy as np
 import tensorflow as tf
 
 import rltools.algos.dqn
+import rltools.algos.dqn_parallel
 import rltools.log
 import rltools.util
 from rltools.qnet.categorical_qnet import CategoricalQFunction
@@ -34,6 +35,9 @@ def main():
     parser.add_argument('--traj_sim_len', type=int, default=300)
     parser.add_argument('--n_eval_traj', type=int, default=2)
     parser.add_argument('--n_agents', type=int, default=5)
+    parser.add_argument('--n_actors', type=int, default=0)  # > 0 for actor-learner training
+    parser.add_argument('--actor_steps', type=int, default=50)
+    parser.add_argument('--param_sync_steps', type=int, default=100)
 
     parser.add_argument('--reward_mech', type=str, default='local')
     parser.add_argument('--rew_arrival', type=float, default=2)
@@ -75,20 +79,27 @@ def main():
                                             dueling=False,
                                             varscope_name='target_q_func')
 
-    def convert_obs(obs):
-        return np.array(obs)
-
-    dqn_opt = rltools.algos.dqn.DQN(env=env,
-                                q_func=q_func,
-                                target_q_func=target_q_func,
-                                obsfeat_fn=convert_obs, 
-                                target_update_step=args.target_update_step, 
-                                batch_size=args.batch_size,
-                                discount=args.discount,
-                                n_iter=args.n_iter,
-                                max_experience_size=args.max_experience_size,
-                                traj_sim_len=args.traj_sim_len,
-                                n_eval_traj=args.n_eval_traj)
+    # Module-level function, so that actor processes can unpickle it
+    convert_obs = np.asarray
+
+    dqn_kwargs = dict(env=env,
+                      q_func=q_func,
+                      target_q_func=target_q_func,
+                      obsfeat_fn=convert_obs,
+                      target_update_step=args.target_update_step,
+                      batch_size=args.batch_size,
+                      discount=args.discount,
+                      n_iter=args.n_iter,
+                      max_experience_size=args.max_experience_size,
+                      traj_sim_len=args.traj_sim_len,
+                      n_eval_traj=args.n_eval_traj)
+    if args.n_actors > 0:
+        dqn_opt = rltools.algos.dqn_parallel.ParallelDQN(n_actors=args.n_actors,
+                                                         actor_steps=args.actor_steps,
+                                                         param_sync_steps=args.param_sync_steps,
+                                                         **dqn_kwargs)
+    else:
+        dqn_opt = rltools.algos.dqn.DQN(**dqn_kwargs)
 
     args_ = {'eps_decay': True,
             'arch': 'LARGE_VAL_ARCH'}
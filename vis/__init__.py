@@ -76,7 +76,16 @@ class Evaluator(PolicyLoad):
     def __init__(self, *args, **kwargs):
         super(Evaluator, self).__init__(*args, **kwargs)
 
+    def rollout_pool(self, n_workers=4):
+        """Worker pool that can be passed to successive calls, e.g. to evaluate several snapshots
+        of the same policy without restarting the workers every time.
+        """
+        from rltools.samplers.parallel import RolloutPool
+        policy = self.policies if self.control == 'concurrent' else self.policy
+        return RolloutPool(self.env, policy, self.max_traj_len, self.control, n_workers)
+
     def __call__(self, filename, **kwargs):
+        pool = kwargs.pop('pool', None)
         if self.mode == 'rltools':
             file_key = kwargs.pop('file_key', None)
             same_con_pol = kwargs.pop('same_con_pol', None)
@@ -98,7 +107,7 @@ class Evaluator(PolicyLoad):
                                                     deterministic=self.deterministic,
                                                     disc=self.disc, mode=self.control,
                                                     max_traj_len=self.max_traj_len,
-                                                    n_trajs=self.n_trajs)
+                                                    n_trajs=self.n_trajs, pool=pool)
         elif self.mode == 'rllab':
             import joblib
             import rllab.misc.evaluate